@@ -0,0 +1,70 @@
+"""
+Compare bytes on the wire against encode/decode time for the compression
+codecs, on small and large repetitive JSON telemetry messages.
+
+    python benchmarks/bench_compression.py [-n NUMBER]
+"""
+import argparse
+import random
+from timeit import Timer
+
+from asyncipc.compression import Compression, codecs
+from asyncipc.message import BaseMessage, message_types
+from asyncipc.serializer import Serialize
+
+
+class Telemetry(BaseMessage):
+    _fields = ['host', 'timestamp', 'readings']
+
+
+def make_message(rng, nreadings):
+    readings = [
+        {'sensor': f'temp-{i}', 'unit': 'celsius', 'status': 'ok',
+         'value': round(rng.uniform(20, 30), 2)}
+        for i in range(nreadings)
+    ]
+    return Telemetry(f'host-{rng.randrange(10)}', 1500000000 + rng.random(), readings)
+
+
+def bench(label, serial, msg, number):
+    b_header, b_data = serial.dump_iter(msg)
+    loader = serial.load(b_header).data_loader
+    t_dump = Timer(lambda: list(serial.dump_iter(msg)))
+    t_load = Timer(lambda: loader(b_data))
+    dump_us = min(t_dump.repeat(3, number)) / number * 1e6
+    load_us = min(t_load.repeat(3, number)) / number * 1e6
+    print(f'{label:>14}: {len(b_data):6d} bytes '
+          f'{dump_us:9.2f} us encode {load_us:9.2f} us decode')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    args = parser.parse_args(args)
+    rng = random.Random(1)
+    samples = [make_message(rng, 4) for _ in range(200)]
+    for nreadings in (4, 200):
+        msg = make_message(rng, nreadings)
+        print(f'{nreadings} readings')
+        bench('raw', Serialize(**message_types), msg, args.number)
+        for name, codec in codecs.items():
+            if not codec.available():
+                print(f'{name:>14}: skipped (not available)')
+                continue
+            levels = (1, 6, 9) if name == 'zlib' else (None,)
+            for level in levels:
+                label = name if level is None else f'{name}-{level}'
+                compression = Compression(name, threshold=0, level=level)
+                serial = Serialize(compression=compression, **message_types)
+                try:
+                    bench(label, serial, msg, args.number)
+                    if codec.dictionaries:
+                        serial.train_compression(samples)
+                        bench(f'{label}+dict', serial, msg, args.number)
+                except ImportError as e:
+                    print(f'{label:>14}: skipped ({e})')
+                    break
+
+
+if __name__ == '__main__':
+    main()
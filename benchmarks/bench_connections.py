@@ -0,0 +1,93 @@
+"""
+Compare messages/sec for one-connection-per-message, persistent and
+batching clients.
+
+    python benchmarks/bench_connections.py [-n COUNT] [--metrics]
+
+--metrics runs the server with metrics enabled, to measure their overhead.
+"""
+import argparse
+import asyncio
+import threading
+import time
+from os import getpid
+
+from asyncipc.client import Client
+from asyncipc.message import BaseMessage, message_types
+from asyncipc.server import Server
+
+
+class Sample(BaseMessage):
+    _fields = ['seq', 'value']
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+        self.target = 0
+        self.done = threading.Event()
+
+    def reset(self, target):
+        self.count = 0
+        self.target = target
+        self.done.clear()
+
+    def __call__(self, msg):
+        self.count += 1
+        if self.count == self.target:
+            self.done.set()
+
+
+def start_server(socket_name, counter, metrics=False):
+    serv = Server(socket_name, message_types, metrics=metrics)
+    serv.register(Sample, counter)
+    loop = asyncio.new_event_loop()
+    serv(loop)
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return serv
+
+
+def one_per_connection(socket_name, count):
+    for i in range(count):
+        with Client(socket_name) as client:
+            client.send(Sample(i, 1.5))
+
+
+def persistent(socket_name, count):
+    with Client(socket_name) as client:
+        for i in range(count):
+            client.send(Sample(i, 1.5))
+
+
+def batched(socket_name, count, batch_size=100):
+    with Client(socket_name) as client:
+        for start in range(0, count, batch_size):
+            stop = min(start + batch_size, count)
+            client.send_batch([Sample(i, 1.5) for i in range(start, stop)])
+
+
+def run(mode, socket_name, counter, count):
+    counter.reset(count)
+    t0 = time.perf_counter()
+    mode(socket_name, count)
+    counter.done.wait()
+    elapsed = time.perf_counter() - t0
+    print(f'{mode.__name__:>20}: {count / elapsed:12,.0f} msg/s')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=20000)
+    parser.add_argument('--metrics', action='store_true')
+    args = parser.parse_args(args)
+    socket_name = f'asyncipc-bench-{getpid()}'
+    counter = Counter()
+    start_server(socket_name, counter, args.metrics)
+    time.sleep(0.1)
+    for mode in (one_per_connection, persistent, batched):
+        run(mode, socket_name, counter, args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare message construction, as_dict and repr with the generated methods
+against the original Signature.bind() based implementation.
+
+    python benchmarks/bench_message.py [-n NUMBER]
+"""
+import argparse
+from timeit import Timer
+
+from asyncipc.message import BaseMessage
+
+
+class Sample(BaseMessage):
+    _fields = ['seq', 'timestamp', 'value']
+    _kwfields = {'flags': 0}
+
+
+class BoundSample(Sample):
+    "Sample using the Signature.bind() implementation"
+    def __init__(self, *args, **kwargs):
+        bound_values = self.__signature__.bind(*args, **kwargs)
+        bound_values.apply_defaults()
+        for name, value in bound_values.arguments.items():
+            setattr(self, name, value)
+
+    @property
+    def as_dict(self):
+        return {x:getattr(self, x) for x in self.__slots__}
+
+    def __repr__(self):
+        sig = self.__signature__
+        bound = sig.bind(**self.as_dict)
+        kwargs = (f'{key}={val!r}' for key,val in bound.arguments.items())
+        inner = ', '.join(kwargs)
+        cname = self.__class__.__name__
+        return f'{cname}({inner})'
+
+
+def bench(label, fn, number):
+    usec = min(Timer(fn).repeat(3, number)) / number * 1e6
+    print(f'{label:>24}: {usec:8.3f} us')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    args = parser.parse_args(args)
+    n = args.number
+    data = {'seq': 1, 'timestamp': 2.0, 'value': 3.0, 'flags': 4}
+    values = tuple(data.values())
+    for cls in (BoundSample, Sample):
+        name = cls.__name__
+        bench(f'{name}(*args)', lambda: cls(1, 2.0, 3.0, flags=4), n)
+        bench(f'{name}(**data)', lambda: cls(**data), n)
+        msg = cls(**data)
+        bench(f'{name}.as_dict', lambda: msg.as_dict, n)
+        bench(f'repr({name})', lambda: repr(msg), n)
+    bench('Sample._from_tuple', lambda: Sample._from_tuple(values), n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Overload a server with a slow observer and report the delivery latency of
+bulk and (higher priority) control messages under each overload policy.
+
+    python benchmarks/bench_overload.py [-n COUNT] [--maxsize SIZE]
+"""
+import argparse
+import asyncio
+import threading
+import time
+from os import getpid
+
+from asyncipc.client import Client
+from asyncipc.message import BaseMessage, message_types
+from asyncipc.server import Server
+
+
+class Sample(BaseMessage):
+    _fields = ['seq', 'sent']
+
+
+class Control(BaseMessage):
+    _fields = ['seq', 'sent']
+
+
+class Recorder:
+    def __init__(self, work):
+        self.work = work
+        self.latencies = {'Sample': [], 'Control': []}
+        self.last = time.perf_counter()
+
+    def __call__(self, msg):
+        now = time.perf_counter()
+        self.latencies[msg.__class__.__name__].append(now - msg.sent)
+        self.last = now
+        # Simulate an observer that hogs the event loop
+        end = now + self.work
+        while time.perf_counter() < end:
+            pass
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(policy, count, maxsize, work):
+    socket_name = f'asyncipc-bench-{getpid()}-{policy}'
+    serv = Server(socket_name, message_types, maxsize=maxsize,
+                  overload=policy, priorities={Control: 1})
+    recorder = Recorder(work)
+    serv.register(Sample, recorder, ordered=True)
+    serv.register(Control, recorder, ordered=True)
+    loop = asyncio.new_event_loop()
+    serv(loop)
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    with Client(socket_name) as client:
+        for i in range(count):
+            msgtype = Control if i % 100 == 0 else Sample
+            client.send(msgtype(i, time.perf_counter()))
+        while time.perf_counter() - recorder.last < 0.5:
+            time.sleep(0.1)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+
+    for name, latencies in recorder.latencies.items():
+        ms = [x * 1e3 for x in latencies]
+        print(f'{policy:>12} {name:>8}: {len(ms):6d} delivered '
+              f'p50 {percentile(ms, 50):8.2f} ms '
+              f'p99 {percentile(ms, 99):8.2f} ms '
+              f'max {percentile(ms, 100):8.2f} ms')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=20000)
+    parser.add_argument('--maxsize', type=int, default=100)
+    parser.add_argument('--work', type=float, default=50e-6,
+                        help='seconds of work per message in the observer')
+    args = parser.parse_args(args)
+    for policy in Server.overload_policies:
+        run(policy, args.count, args.maxsize, args.work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Compare encoded size and encode/decode time of the serializer backends.
+
+    python benchmarks/bench_serializer.py [-n NUMBER]
+"""
+import argparse
+from timeit import Timer
+
+from asyncipc.message import BaseMessage, message_types
+from asyncipc.serializer import Serialize, backends
+
+
+class Sample(BaseMessage):
+    _fields = ['seq', 'timestamp', 'value']
+    _kwfields = {'flags': 0}
+    _struct = {'seq': 'Q', 'timestamp': 'd', 'value': 'd', 'flags': 'B'}
+
+
+def bench(serial, msg, formatter, number):
+    b_header, b_data = serial.dump_iter(msg, formatter)
+    loader = serial.load(b_header).data_loader
+    t_dump = Timer(lambda: list(serial.dump_iter(msg, formatter)))
+    t_load = Timer(lambda: loader(b_data))
+    dump_us = min(t_dump.repeat(3, number)) / number * 1e6
+    load_us = min(t_load.repeat(3, number)) / number * 1e6
+    print(f'{formatter:>8}: {len(b_data):5d} bytes '
+          f'{dump_us:8.2f} us encode {load_us:8.2f} us decode')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    args = parser.parse_args(args)
+    serial = Serialize(formatters=backends, **message_types)
+    msg = Sample(123456, 1500000000.25, 3.5, flags=2)
+    for formatter in backends:
+        try:
+            bench(serial, msg, formatter, args.number)
+        except (ImportError, TypeError) as e:
+            # A missing optional module, or a backend for other messages
+            print(f'{formatter:>8}: skipped ({e})')
+
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,7 @@ setup(
     py_modules=[splitext(basename(path))[0] for path in glob('src/*.py')],
     include_package_data=True,
     zip_safe=False,
+    python_requires='>=3.7',
     classifiers=[
         # complete classifier list: http://pypi.python.org/pypi?%3Aaction=list_classifiers
         'Development Status :: 5 - Production/Stable',
@@ -67,6 +68,9 @@ setup(
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
+        'msgpack': ['msgpack'],
+        'zstd': ['zstandard'],
+        'uvloop': ['uvloop'],
     },
     entry_points={
         'console_scripts': [
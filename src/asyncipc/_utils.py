@@ -4,7 +4,12 @@ def _runtime_dir():
     if rundir:
         return rundir
     return '/run/user/{:d}'.format(getuid())
-RUNTIME_DIR = _runtime_dir()
+
+def __getattr__(name):
+    # RUNTIME_DIR is looked up when used rather than when importing
+    if name == 'RUNTIME_DIR':
+        return _runtime_dir()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_logger():
     from sys import _getframe
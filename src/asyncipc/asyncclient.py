@@ -0,0 +1,376 @@
+"""
+Clients sending messages to a Server from an asyncio event loop.
+"""
+import asyncio
+from itertools import count as _count
+from os import path as _path
+
+from . import _utils
+from .client import RemoteError, _frames, _make_spool, _next_id
+from .framing import FrameProtocol
+from .message import message_types as _message_types
+from .schema import Hello as _Hello
+from .schema import SchemaError
+from .serializer import BATCH, ERROR, MESSAGE, REQUEST, STREAM, Serialize
+from .streams import _aiter
+
+
+class ClientProtocol(FrameProtocol):
+    """Match reply frames to the pending requests of an AsyncClient
+
+    Also implements write flow control so that drain() waits while the
+    transport's write buffer is above its high-water mark.
+
+    Messages published by a Broker are put in the published queue. Once
+    it holds max_published messages the protocol stops reading, leaving
+    the broker to buffer or drop further ones, until they are taken out
+    with receive().
+    """
+    max_published = 1000
+
+    def __init__(self, serial):
+        super().__init__(serial)
+        self.pending = {}
+        self.formatters = {}  # msg_id of a pending request -> its formatter
+        self.published_formatter = None  # Formatter subscribed with, if any
+        self.published = asyncio.Queue()
+        self._write_paused = False
+        self._drain_waiter = None
+
+    def accept(self, header):
+        """Decode answers in the formatter of their request and published
+        messages in the formatter of the subscription
+        """
+        kind = header.kind
+        tag = header.tag.decode()
+        if kind == MESSAGE or kind == BATCH:
+            return tag == self.published_formatter
+        return self.formatters.get(header.msg_id) == tag
+
+    def frame_received(self, header, body):
+        kind = header.kind
+        if kind == MESSAGE or kind == BATCH:
+            msg = header.data_loader(body)
+            published = self.published
+            if kind == MESSAGE:
+                published.put_nowait(msg)
+            else:
+                for item in msg:
+                    published.put_nowait(item)
+            if published.qsize() >= self.max_published:
+                self.pause('published')
+            return
+        if header.msg_id == 0 and kind == ERROR:
+            error = header.data_loader(body)
+            self.logr.warning('Server refused a message: %s', error)
+            return
+        future = self.pending.pop(header.msg_id, None)
+        if future is None or future.done():
+            self.logr.debug('Dropping reply to unknown request %d', header.msg_id)
+            return
+        try:
+            value = header.data_loader(body)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if header.kind == ERROR:
+            future.set_exception(RemoteError(value))
+        else:
+            future.set_result(value)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._wake_drain()
+
+    async def drain(self):
+        if self.transport is None:
+            raise ConnectionError('Connection to server lost')
+        if not self._write_paused:
+            return
+        if self._drain_waiter is None:
+            self._drain_waiter = asyncio.get_event_loop().create_future()
+        await asyncio.shield(self._drain_waiter)
+
+    def _wake_drain(self, exc=None):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is None or waiter.done():
+            return
+        if exc is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(exc)
+
+    async def receive(self):
+        "Return the next published message"
+        msg = await self.published.get()
+        if isinstance(msg, ConnectionError):
+            self.published.put_nowait(msg)
+            raise msg
+        if self.published.qsize() < self.max_published:
+            self.resume('published')
+        return msg
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        lost = ConnectionError('Connection to server lost')
+        self.published.put_nowait(lost)
+        self._wake_drain(lost)
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(lost)
+
+
+class AsyncClient:
+    """Send messages and requests to a Server from an asyncio event loop
+
+    Any number of concurrent requests share the one connection; each
+    request carries its own msg_id and its reply is matched back to it.
+    shm_threshold, compression, compact, spool and formatters are as for
+    Client; messages from a Broker are also accepted in the formatter they
+    were subscribed with.
+    """
+    def __init__(self, socket_name, message_types=None, formatter='json',
+                 shm_threshold=None, compression=None, compact=False, spool=None,
+                 formatters=None):
+        self.socket_path = _path.join(_utils.RUNTIME_DIR, socket_name)
+        self.formatter = formatter
+        if message_types is None:
+            message_types = _message_types
+        self.serial = Serialize(
+            shm_threshold=shm_threshold, compression=compression,
+            formatters=formatters, **message_types,
+        )
+        self.compact = compact
+        self.spool = _make_spool(spool)
+        if spool is not None:
+            self._spool_serial = Serialize(compression=compression, **message_types)
+        self.protocol = None
+        self._ids = _count(1)
+        self._lock = None
+
+    async def connect(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            protocol = self.protocol
+            if protocol is None or protocol.transport is None:
+                loop = asyncio.get_event_loop()
+                _, protocol = await loop.create_unix_connection(
+                    lambda: ClientProtocol(self.serial),
+                    path=self.socket_path,
+                )
+                if self.compact:
+                    await self._handshake(protocol)
+                if self.spool is not None:
+                    await self._replay(protocol)
+                self.protocol = protocol
+        return protocol
+
+    async def _replay(self, protocol):
+        spool = self.spool
+        sent = []
+        for seq, frame in spool.pending():
+            protocol.transport.write(frame)
+            sent.append(seq)
+        await protocol.drain()
+        for seq in sent:
+            spool.done(seq)
+        spool.sync()
+
+    async def _spool_send(self, dump):
+        try:
+            protocol = await self.connect()
+            protocol.transport.writelines(dump(self.serial))
+            await protocol.drain()
+        except OSError:
+            self.close()
+            self.spool.append(b''.join(dump(self._spool_serial)))
+
+    async def _handshake(self, protocol):
+        serial = self.serial
+        serial.compact = False
+        try:
+            table = await self._request(protocol, _Hello(serial.schema.fingerprints()))
+        except RemoteError as e:
+            protocol.transport.close()
+            raise SchemaError(str(e)) from None
+        serial.adopt(table)
+
+    async def send(self, message, formatter=None):
+        "Send a message without waiting for any answer"
+        formatter = formatter or self.formatter
+        if self.spool is not None:
+            await self._spool_send(lambda serial: serial.dump_iter(message, formatter))
+            return
+        protocol = await self.connect()
+        frame = self.serial.dump_iter(message, formatter)
+        protocol.transport.writelines(frame)
+        await protocol.drain()
+
+    async def send_many(self, messages, formatter=None):
+        "Send an iterable of messages in one write"
+        formatter = formatter or self.formatter
+        if self.spool is not None:
+            messages = list(messages)
+            await self._spool_send(lambda serial: _frames(serial, messages, formatter))
+            return
+        protocol = await self.connect()
+        frames = _frames(self.serial, messages, formatter)
+        protocol.transport.writelines(frames)
+        await protocol.drain()
+
+    async def send_batch(self, messages, formatter=None):
+        "Send messages together in a single BATCH frame"
+        formatter = formatter or self.formatter
+        if self.spool is not None:
+            await self._spool_send(
+                lambda serial: serial.dump_batch_iter(messages, formatter))
+            return
+        protocol = await self.connect()
+        frame = self.serial.dump_batch_iter(messages, formatter)
+        protocol.transport.writelines(frame)
+        await protocol.drain()
+
+    async def send_stream(self, message, chunks, formatter=None):
+        """Send message with a body streamed from chunks
+
+        chunks is an iterable or async iterable of bytes; the next chunk is
+        only taken once the previous one could be written. If chunks raises,
+        the connection is closed so the server knows the stream failed.
+        """
+        protocol = await self.connect()
+        stream_id = _next_id(self._ids)
+        serial = self.serial
+        write = protocol.transport.writelines
+        write(serial.dump_iter(message, formatter or self.formatter, STREAM, stream_id))
+        try:
+            async for chunk in _aiter(chunks):
+                if chunk:
+                    write(serial.dump_chunk_iter(stream_id, chunk))
+                    await protocol.drain()
+        except BaseException:
+            self.close()
+            raise
+        write(serial.dump_chunk_iter(stream_id, b''))
+        await protocol.drain()
+
+    async def request(self, message, formatter=None):
+        "Send message and return the result of the server's observer"
+        protocol = await self.connect()
+        return await self._request(protocol, message, formatter)
+
+    async def _request(self, protocol, message, formatter=None):
+        msg_id = _next_id(self._ids, protocol.pending)
+        formatter = formatter or self.formatter
+        frame = self.serial.dump_iter(message, formatter, REQUEST, msg_id)
+        future = asyncio.get_event_loop().create_future()
+        protocol.pending[msg_id] = future
+        # The reply comes back in the formatter we asked with
+        protocol.formatters[msg_id] = formatter
+        protocol.transport.writelines(frame)
+        try:
+            await protocol.drain()
+            return await future
+        finally:
+            protocol.pending.pop(msg_id, None)
+            protocol.formatters.pop(msg_id, None)
+
+    async def subscribe(self, *msgtypes, maxsize=1000, policy='drop-oldest',
+                        formatter=None):
+        """Ask a Broker to send this client messages of msgtypes
+
+        msgtypes are message classes or their names; subclasses of them are
+        delivered too. The messages are read with receive() or messages().
+        maxsize and policy set how the broker treats them while this client
+        falls behind (see broker.Subscription).
+        """
+        from .broker import Subscribe
+        types = [getattr(x, '__name__', x) for x in msgtypes]
+        formatter = formatter or self.formatter
+        msg = Subscribe(types, formatter=formatter, maxsize=maxsize, policy=policy)
+        protocol = await self.connect()
+        previous, protocol.published_formatter = protocol.published_formatter, formatter
+        try:
+            await self._request(protocol, msg)
+        except BaseException:
+            protocol.published_formatter = previous
+            raise
+
+    async def unsubscribe(self, *msgtypes):
+        from .broker import Unsubscribe
+        await self.request(Unsubscribe([getattr(x, '__name__', x) for x in msgtypes]))
+
+    async def receive(self):
+        "Return the next message published to this client by a Broker"
+        protocol = await self.connect()
+        return await protocol.receive()
+
+    async def messages(self):
+        "Iterate over published messages until the connection is lost"
+        protocol = await self.connect()
+        while True:
+            try:
+                msg = await protocol.receive()
+            except ConnectionError:
+                return
+            yield msg
+
+    def close(self):
+        protocol, self.protocol = self.protocol, None
+        if protocol is not None and protocol.transport is not None:
+            protocol.transport.close()
+        if self.spool is not None:
+            self.spool.sync()
+
+    async def __aenter__(self):
+        try:
+            await self.connect()
+        except OSError:
+            if self.spool is None:
+                raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class AsyncClientPool:
+    """Share one AsyncClient per socket path
+
+    An AsyncClient multiplexes concurrent requests over its connection,
+    so a single client per socket path is enough.
+    """
+    def __init__(self, message_types=None, formatter='json'):
+        self.message_types = message_types
+        self.formatter = formatter
+        self.clients = {}
+
+    def get(self, socket_name):
+        socket_path = _path.join(_utils.RUNTIME_DIR, socket_name)
+        try:
+            return self.clients[socket_path]
+        except KeyError:
+            client = AsyncClient(socket_path, self.message_types, self.formatter)
+            self.clients[socket_path] = client
+            return client
+
+    async def send(self, socket_name, message, formatter=None):
+        await self.get(socket_name).send(message, formatter)
+
+    async def send_many(self, socket_name, messages, formatter=None):
+        await self.get(socket_name).send_many(messages, formatter)
+
+    async def send_batch(self, socket_name, messages, formatter=None):
+        await self.get(socket_name).send_batch(messages, formatter)
+
+    async def request(self, socket_name, message, formatter=None):
+        return await self.get(socket_name).request(message, formatter)
+
+    def close(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            client.close()
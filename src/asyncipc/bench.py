@@ -0,0 +1,321 @@
+"""
+Load generator measuring the throughput and latency of a Server.
+
+    python -m asyncipc bench [-n COUNT] [-c CONCURRENCY] [--mode MODE]
+                             [-f FORMATTER] [--mix small=3,large=1]
+                             [--size BYTES] [--json PATH]
+
+A server is forked with one observer and driven by CONCURRENCY clients,
+each on its own connection, sending COUNT messages in total. Every message
+carries the time it was sent, so the latency of one-way messages is
+measured up to their observer and that of requests up to their reply.
+The modes are:
+
+- 'persistent': send messages one by one over a persistent connection
+- 'batch': send BATCH frames of --batch-size messages
+- 'request': send requests and wait for each reply
+- 'connect': open a new connection for every message
+- 'codec': no server, only encode and decode the messages with Serialize,
+  reporting the throughput of each
+
+--fast runs the server with inline observers on server.new_event_loop().
+--json writes the configuration and results as JSON (to stdout for '-')
+so that runs of different releases can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import signal
+import sys
+from time import perf_counter as _perf_counter
+
+from . import __version__
+from .asyncclient import AsyncClient
+from .message import BaseMessage, message_types
+from .serializer import Serialize, backends
+from .server import Server, new_event_loop
+
+modes = ('persistent', 'batch', 'request', 'connect', 'codec')
+
+
+class Small(BaseMessage):
+    _fields = ['seq', 'sent']
+    _struct = {'seq': 'Q', 'sent': 'd'}
+
+
+class Large(Small):
+    "Small with a payload of --size bytes"
+    _fields = ['payload']
+
+
+class Report(BaseMessage):
+    "Request answered with the results once expected messages were observed"
+    _fields = ['expected']
+
+
+def percentiles(samples):
+    "Return the mean, p50, p99, p999 and max of samples (in seconds)"
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    count = len(samples)
+    def pct(p):
+        return samples[min(count - 1, int(count * p / 100))]
+    return {
+        'mean': sum(samples) / count,
+        'p50': pct(50),
+        'p99': pct(99),
+        'p999': pct(99.9),
+        'max': samples[-1],
+    }
+
+
+class Recorder:
+    "Observer recording the latency of every message it is called with"
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = []
+        self.last = None
+
+    def __call__(self, msg):
+        now = self.last = _perf_counter()
+        self.latencies.append(now - msg.sent)
+        return msg.seq
+
+    async def report(self, msg):
+        while len(self.latencies) < msg.expected:
+            await asyncio.sleep(0.001)
+        result = {
+            'received': len(self.latencies),
+            'last': self.last,
+            'latency': percentiles(self.latencies),
+        }
+        self.reset()
+        return result
+
+
+def serve(socket_name, fast=False, formatter='json'):
+    """Run the benchmark server in a forked process and return its pid
+
+    The server accepts formatter and json, which the clients connect and
+    ask for the report with.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 1
+    try:
+        loop = new_event_loop() if fast else asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = Server(
+            socket_name, message_types, inline=fast, formatters=[formatter, 'json'],
+        )
+        recorder = Recorder()
+        server.register(Small, recorder)
+        server.register(Report, recorder.report)
+        server(loop)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            os.unlink(server.socket_path)
+        code = 0
+    finally:
+        os._exit(code)
+
+
+def message_factory(mix, size):
+    "Return a function making the seq-th message of mix"
+    payload = 'x' * size
+    pattern = []
+    for name, weight in mix:
+        pattern.extend([name] * weight)
+    npattern = len(pattern)
+
+    def make(seq):
+        if pattern[seq % npattern] == 'large':
+            return Large(payload, seq, _perf_counter())
+        return Small(seq, _perf_counter())
+    return make
+
+
+async def connect(socket_name, timeout=5.0):
+    "Wait until the server accepts connections"
+    deadline = _perf_counter() + timeout
+    while True:
+        client = AsyncClient(socket_name)
+        try:
+            await client.connect()
+            return client
+        except OSError:
+            if _perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.01)
+
+
+async def sender(args, make, seqs, latencies):
+    "Send the messages numbered seqs over one connection"
+    socket_name, formatter = args.socket_name, args.formatter
+    if args.mode == 'connect':
+        for seq in seqs:
+            async with AsyncClient(socket_name, formatter=formatter) as client:
+                await client.send(make(seq))
+        return
+    async with AsyncClient(socket_name, formatter=formatter) as client:
+        if args.mode == 'persistent':
+            for seq in seqs:
+                await client.send(make(seq))
+        elif args.mode == 'batch':
+            size = args.batch_size
+            for start in range(0, len(seqs), size):
+                await client.send_batch([make(seq) for seq in seqs[start:start + size]])
+        else:
+            for seq in seqs:
+                msg = make(seq)
+                await client.request(msg)
+                latencies.append(_perf_counter() - msg.sent)
+
+
+async def run(args, count):
+    "Send count messages and return the results"
+    make = message_factory(args.mix, args.size)
+    concurrency = args.concurrency
+    latencies = []
+    t0 = _perf_counter()
+    await asyncio.gather(*[
+        sender(args, make, range(start, count, concurrency), latencies)
+        for start in range(concurrency)
+    ])
+    async with AsyncClient(args.socket_name) as client:
+        report = await client.request(Report(count))
+    if args.mode == 'request':
+        elapsed = _perf_counter() - t0
+        latency = percentiles(latencies)
+    else:
+        elapsed = report['last'] - t0
+        latency = report['latency']
+    return {
+        'count': count,
+        'elapsed': elapsed,
+        'throughput': count / elapsed,
+        'latency': latency,
+    }
+
+
+def codec(args):
+    "Encode and decode messages in this process and return the results"
+    serial = Serialize(formatters=[args.formatter], **message_types)
+    dump_iter, load = serial.dump_iter, serial.load
+    header_length = serial.header_length
+    formatter = args.formatter
+    make = message_factory(args.mix, args.size)
+    count = args.count
+
+    def run(count):
+        msgs = [make(seq) for seq in range(count)]
+        t0 = _perf_counter()
+        frames = [b''.join(dump_iter(msg, formatter)) for msg in msgs]
+        t1 = _perf_counter()
+        for frame in frames:
+            load(frame).data_loader(memoryview(frame)[header_length:])
+        return t1 - t0, _perf_counter() - t1
+
+    run(args.warmup)
+    encode, decode = run(count)
+    return {
+        'count': count,
+        'encode': {'elapsed': encode, 'throughput': count / encode},
+        'decode': {'elapsed': decode, 'throughput': count / decode},
+    }
+
+
+async def bench(args):
+    client = await connect(args.socket_name)
+    client.close()
+    if args.warmup:
+        await run(args, args.warmup)
+    return await run(args, args.count)
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ('small', 'large'):
+            raise argparse.ArgumentTypeError(f"Unknown message kind {name!r}")
+        mix.append((name, int(weight or 1)))
+    return mix
+
+
+parser = argparse.ArgumentParser(
+    prog='asyncipc bench', description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+parser.add_argument('-n', '--count', type=int, default=20000)
+parser.add_argument('-c', '--concurrency', type=int, default=4)
+parser.add_argument('-m', '--mode', choices=modes, default='persistent')
+# The columns backend only encodes ColumnMessages, which the bench doesn't send
+parser.add_argument('-f', '--formatter', default='json',
+                    choices=sorted(name for name in backends if name != 'columns'))
+parser.add_argument('--mix', type=parse_mix, default='small=3,large=1',
+                    help='kinds of messages and their weights')
+parser.add_argument('--size', type=int, default=4096,
+                    help='payload size of large messages')
+parser.add_argument('--batch-size', type=int, default=100)
+parser.add_argument('--warmup', type=int, default=1000,
+                    help='messages sent before measuring')
+parser.add_argument('--fast', action='store_true',
+                    help='use inline observers and the fastest event loop')
+parser.add_argument('--json', metavar='PATH',
+                    help="write the results as JSON to PATH, or stdout for '-'")
+
+
+def serve_and_run(args):
+    "Fork a server, run the benchmark against it and return the results"
+    args.socket_name = f'asyncipc-bench-{os.getpid()}'
+    pid = serve(args.socket_name, args.fast, args.formatter)
+    try:
+        return asyncio.run(bench(args))
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    if args.formatter == 'struct' and any(name == 'large' for name, _ in args.mix):
+        parser.error('the struct formatter can only send small messages')
+    out = sys.stderr if args.json == '-' else sys.stdout
+    if args.mode == 'codec':
+        results = codec(args)
+        print(f"codec {args.formatter}: encode {results['encode']['throughput']:,.0f}"
+              f" msg/s, decode {results['decode']['throughput']:,.0f} msg/s", file=out)
+    else:
+        results = serve_and_run(args)
+        latency = results['latency']
+        print(f"{args.mode} {args.formatter} x{args.concurrency}: "
+              f"{results['throughput']:,.0f} msg/s, latency "
+              + ' '.join(f'{k} {latency[k] * 1e6:,.0f}us' for k in ('p50', 'p99', 'p999')),
+              file=out)
+    if args.json:
+        config = {
+            key: value for key, value in vars(args).items()
+            if key not in ('json', 'socket_name')
+        }
+        config['mix'] = dict(args.mix)
+        output = {
+            'asyncipc': __version__,
+            'python': platform.python_version(),
+            'config': config,
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(output, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
@@ -0,0 +1,268 @@
+"""
+Publish/subscribe fan-out on top of Server.
+
+Clients subscribe to message types by sending a Subscribe message over a
+connection they keep open; every message published to the broker (sent to
+it like to any Server) is then written to each subscriber of its type or
+of one of its base classes.
+"""
+from collections import deque as _deque
+
+from .message import BaseMessage
+from .serializer import MESSAGE, HeaderFormat, LazyMessage, Serialize
+from .server import Server, ServerProtocol
+
+
+class Subscribe(BaseMessage):
+    """Subscribe the sending connection to the message types named in types
+
+    Published messages are encoded with formatter. While the connection
+    can't keep up, up to maxsize messages wait for it in the broker; when
+    more arrive, policy decides what happens (see Subscription).
+    """
+    _fields = ['types']
+    _kwfields = {'formatter': 'json', 'maxsize': 1000, 'policy': 'drop-oldest'}
+
+
+class Unsubscribe(BaseMessage):
+    "Stop sending the message types named in types to this connection"
+    _fields = ['types']
+
+
+class Subscription:
+    """The message types and outgoing buffer of one subscriber connection
+
+    Frames are written straight to the transport unless it has paused
+    writing, in which case they wait in a buffer of maxsize frames. When
+    the buffer is full policy is applied to a new frame:
+
+    - 'drop-oldest': discard the oldest buffered frame
+    - 'drop-newest': discard the new frame
+    - 'disconnect': close the subscriber's connection
+    """
+    policies = ('drop-oldest', 'drop-newest', 'disconnect')
+
+    def __init__(self, protocol, formatter='json', maxsize=1000, policy='drop-oldest',
+                 types=()):
+        self.protocol = protocol
+        self.types = set()
+        self.buffer = _deque()
+        self.dropped = 0
+        self.configure(formatter, maxsize, policy, types)
+
+    def configure(self, formatter, maxsize, policy, types=()):
+        """Set the formatter, maxsize and policy of the subscription
+
+        Raises ValueError if policy or maxsize is invalid, or if formatter
+        can't encode the known message types of types or of the types
+        already subscribed to, including their subclasses.
+        """
+        if policy not in self.policies:
+            raise ValueError(f"Unknown subscriber policy {policy!r}")
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be at least 1, not {maxsize}")
+        serial = self.protocol.serial
+        backend = serial.get_backend(formatter)
+        names = self.types.union(types)
+        for msgtype in serial.message_types.values():
+            if names.isdisjoint(klass.__name__ for klass in msgtype.__mro__):
+                continue
+            try:
+                backend.encoder(msgtype)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Can't publish with {formatter!r}: {e}") from None
+        self.formatter = formatter
+        self.maxsize = maxsize
+        self.policy = policy
+
+    def push(self, frame):
+        "Write frame, or buffer it if the subscriber isn't keeping up"
+        protocol = self.protocol
+        buffer = self.buffer
+        if not buffer and not protocol.writing_paused:
+            protocol.write_frame(frame)
+            return
+        if len(buffer) >= self.maxsize:
+            policy = self.policy
+            self.dropped += 1
+            if policy == 'drop-newest':
+                return
+            elif policy == 'drop-oldest':
+                buffer.popleft()
+            else:
+                protocol.logr.warning('Disconnecting a subscriber that fell behind')
+                protocol.transport.close()
+                buffer.clear()
+                return
+        buffer.append(frame)
+
+    def flush(self):
+        "Write buffered frames until the transport pauses writing again"
+        protocol = self.protocol
+        buffer = self.buffer
+        while buffer and not protocol.writing_paused:
+            protocol.write_frame(buffer.popleft())
+
+
+class Broker(Server):
+    """Server that also fans messages out to subscribed connections
+
+    Published messages are dispatched to observers as usual and then
+    forwarded to every subscriber of their type or of a base class of it,
+    so subscribing to Alpha also delivers messages of a subclass Beta.
+    Each message is encoded once per formatter in use by its subscribers
+    and the same frame is written to all of them. Since a shared memory
+    segment can only be read once, published frames never use one.
+
+    Messages that only go to subscribers, or to lazy observers, aren't
+    decoded: subscribers using the formatter they were sent with get the
+    received body as is.
+    """
+    def __init__(self, socket_name, message_types, *args, **kwargs):
+        message_types = dict(message_types)
+        message_types['Subscribe'] = Subscribe
+        message_types['Unsubscribe'] = Unsubscribe
+        super().__init__(socket_name, message_types, *args, **kwargs)
+        self.publish_serial = Serialize(
+            compression=self.serial.compression, **self.serial.message_types,
+        )
+        self.subscriptions = {}  # protocol -> Subscription
+        self._by_type = {}  # message type name -> set of Subscriptions
+        self._targets = {}  # message class -> list of Subscriptions
+
+    def _protocol(self):
+        return BrokerProtocol(self)
+
+    def subscribe(self, protocol, msg):
+        sub = self.subscriptions.get(protocol)
+        if sub is None:
+            sub = Subscription(protocol, msg.formatter, msg.maxsize, msg.policy, msg.types)
+            self.subscriptions[protocol] = sub
+        else:
+            sub.configure(msg.formatter, msg.maxsize, msg.policy, msg.types)
+        for name in msg.types:
+            sub.types.add(name)
+            self._by_type.setdefault(name, set()).add(sub)
+        self._targets.clear()
+        self._handling.clear()
+
+    def unsubscribe(self, protocol, types=None):
+        "Remove types (all of them if None) from protocol's subscription"
+        sub = self.subscriptions.get(protocol)
+        if sub is None:
+            return
+        if types is None:
+            types = list(sub.types)
+        for name in types:
+            sub.types.discard(name)
+            subs = self._by_type.get(name)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._by_type[name]
+        if not sub.types:
+            del self.subscriptions[protocol]
+        self._targets.clear()
+        self._handling.clear()
+
+    def targets(self, msgtype):
+        "Return the subscriptions receiving messages of class msgtype"
+        try:
+            return self._targets[msgtype]
+        except KeyError:
+            pass
+        by_type = self._by_type
+        subs = set()
+        for klass in msgtype.__mro__:
+            subs.update(by_type.get(klass.__name__, ()))
+        targets = self._targets[msgtype] = list(subs)
+        return targets
+
+    def frame_handling(self, msgtype):
+        handling = super().frame_handling(msgtype)
+        if handling == 'drop':
+            if msgtype is Subscribe or msgtype is Unsubscribe:
+                handling = 'decode'
+            elif self.targets(msgtype):
+                handling = 'lazy'
+            self._handling[msgtype] = handling
+        return handling
+
+    def offer(self, item, protocol):
+        msg, reply = item
+        cls = msg.__class__
+        if cls is not Subscribe and cls is not Unsubscribe:
+            return super().offer(item, protocol)
+        self._done(msg)
+        try:
+            if cls is Subscribe:
+                self.subscribe(protocol, msg)
+            else:
+                self.unsubscribe(protocol, msg.types)
+        except Exception as e:
+            if reply is not None:
+                reply.error(f'{e.__class__.__name__}: {e}')
+            return True
+        if reply is not None:
+            reply.send(True)
+        return True
+
+    def dispatch(self, msgtype, msgs, reply=None, done=None):
+        if reply is not None or self.observers_for(msgtype):
+            super().dispatch(msgtype, msgs, reply, done)
+        if self.subscriptions:
+            self.publish(msgs)
+
+    def publish(self, msgs):
+        """Write msgs to all of their subscribers
+
+        A message that can't be encoded with a subscriber's formatter is
+        logged and not sent to that subscriber.
+        """
+        dump_iter = self.publish_serial.dump_iter
+        targets = self.targets
+        for msg in msgs:
+            subs = targets(msg.__class__)
+            if not subs:
+                continue
+            frames = {}
+            if type(msg) is LazyMessage:
+                header = msg._header
+                if not header.flags:
+                    # A plain frame can be forwarded without decoding it
+                    frames[header.tag.decode()] = [HeaderFormat.pack(
+                        header.tag, header.data_length, MESSAGE, 0, 0, header.type_id,
+                    ), msg._body]
+            for sub in subs:
+                formatter = sub.formatter
+                try:
+                    frame = frames[formatter]
+                except KeyError:
+                    try:
+                        frame = list(dump_iter(msg, formatter))
+                    except Exception:
+                        self.logr.exception('Unable to publish %r with %r', msg, formatter)
+                        frame = None
+                    frames[formatter] = frame
+                if frame is not None:
+                    sub.push(frame)
+
+
+class BrokerProtocol(ServerProtocol):
+    "ServerProtocol that tracks write flow control for its Subscription"
+    def __init__(self, server):
+        super().__init__(server)
+        self.writing_paused = False
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.server.unsubscribe(self)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        sub = self.server.subscriptions.get(self)
+        if sub is not None:
+            sub.flush()
@@ -15,12 +15,55 @@ Why does this file exist, and why not put this in __main__?
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
 """
 import argparse
+import sys
 
 parser = argparse.ArgumentParser(description='Command description.')
 parser.add_argument('names', metavar='NAME', nargs=argparse.ZERO_OR_MORE,
                     help="A name of something.")
 
+send_parser = argparse.ArgumentParser(
+    prog='asyncipc send',
+    description='Send one message, given by its type name and its fields as '
+                'a JSON object, to the server listening on SOCKET_NAME.',
+)
+send_parser.add_argument('socket_name', metavar='SOCKET_NAME')
+send_parser.add_argument('type', metavar='TYPE')
+send_parser.add_argument('fields', metavar='FIELDS', nargs='?', default='{}')
+send_parser.add_argument('--request', action='store_true',
+                         help='wait for the reply and print it as JSON')
+
+
+def send(args):
+    "Send the message described by args (see send_parser)"
+    import json
+    from .client import Client
+    from .message import BaseMessage
+    args = send_parser.parse_args(args)
+    try:
+        fields = json.loads(args.fields)
+    except ValueError as e:
+        send_parser.error(f'FIELDS is not valid JSON: {e}')
+    if not isinstance(fields, dict):
+        send_parser.error('FIELDS must be a JSON object')
+    # The server decodes the message by name with its own class
+    try:
+        msgtype = type(args.type, (BaseMessage,), {'_fields': list(fields)})
+    except ValueError as e:
+        send_parser.error(f'FIELDS: {e}')
+    with Client(args.socket_name) as client:
+        if not args.request:
+            client.send(msgtype(**fields))
+            return
+        print(json.dumps(client.request(msgtype(**fields))))
+
 
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] == 'bench':
+        from .bench import main as bench_main
+        return bench_main(args[1:])
+    if args and args[0] == 'send':
+        return send(args[1:])
     args = parser.parse_args(args=args)
     print(args.names)
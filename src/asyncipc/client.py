@@ -0,0 +1,393 @@
+"""
+Clients sending messages to a Server.
+
+Client and ClientPool block; AsyncClient and AsyncClientPool are for
+asyncio code and live in asyncipc.asyncclient, which is only imported
+once one of them is used, so that short-lived processes that send with
+a Client don't pay for importing asyncio.
+"""
+from contextlib import contextmanager as _contextmanager
+from itertools import chain as _chain
+from itertools import count as _count
+from os import path as _path
+from socket import AF_UNIX as _AF_UNIX
+from socket import SOCK_STREAM as _SOCK_STREAM
+from socket import socket as _socket
+
+from . import _utils
+from .frames import FrameReader
+from .message import message_types as _message_types
+from .schema import Hello as _Hello
+from .schema import SchemaError
+from .serializer import ERROR, REPLY, REQUEST, STREAM, Serialize
+from .spool import Spool
+
+# Upper bound on the number of buffers handed to a single sendmsg() call
+_IOV_MAX = 1024
+# msg_id is an unsigned 32-bit header field
+_MAX_ID = 0xFFFFFFFF
+
+
+class RemoteError(Exception):
+    "The server failed to answer a request"
+
+
+def _sendmsg_all(sock, buffers, progress=None):
+    """Send every buffer with sendmsg(), carrying on after partial writes
+
+    If progress (a list) is given, the number of bytes sent so far is kept
+    in progress[0], so that it is known how far sending got if it fails.
+    """
+    # Empty buffers would never be seen as sent, leave them out
+    buffers = [memoryview(x).cast('B') for x in buffers if len(x)]
+    idx, end = 0, len(buffers)
+    while idx < end:
+        sent = sock.sendmsg(buffers[idx:idx + _IOV_MAX])
+        if progress is not None:
+            progress[0] += sent
+        while sent:
+            nbytes = len(buffers[idx])
+            if sent < nbytes:
+                buffers[idx] = buffers[idx][sent:]
+                break
+            sent -= nbytes
+            idx += 1
+
+
+def _next_id(ids, in_flight=()):
+    """Return the next msg_id from the counter ids, wrapped to fit the header
+
+    0 (no id) and the ids in in_flight are skipped.
+    """
+    while True:
+        msg_id = next(ids) & _MAX_ID
+        if msg_id and msg_id not in in_flight:
+            return msg_id
+
+
+def _make_spool(spool):
+    "Return spool, or a spool.Spool in the directory spool if it is a str"
+    if isinstance(spool, str):
+        return Spool(spool)
+    return spool
+
+
+def _frames(serial, messages, formatter):
+    for message in messages:
+        yield from serial.dump_iter(message, formatter)
+
+
+class _ReplyCollector(FrameReader):
+    "Collect decoded reply frames for the blocking Client"
+    def __init__(self, serial):
+        super().__init__(serial)
+        self.replies = {}
+        self.formatters = {}  # msg_id of a pending request -> its formatter
+
+    def accept(self, header):
+        "Decode the answer to a request in the formatter it was made with"
+        kind = header.kind
+        return ((kind == REPLY or kind == ERROR)
+                and self.formatters.get(header.msg_id) == header.tag.decode())
+
+    def frame_received(self, header, body):
+        try:
+            value = header.data_loader(body)
+        except Exception as e:
+            value = e
+        else:
+            if header.kind == ERROR:
+                value = RemoteError(value)
+        self.replies[header.msg_id] = value
+
+
+class Client:
+    """Send messages to a Server over a single persistent connection
+
+    The connection is opened lazily by the first send and reused until
+    close() is called; the server reads frames from it until EOF.
+    A Client is blocking and should only be used by one thread at a time.
+    Message bodies of shm_threshold bytes or more are sent through shared
+    memory (see asyncipc.shm) and bodies are compressed according to
+    compression (see asyncipc.compression). With compact=True messages are
+    sent as type ids and positional field values, using the schema the
+    server sends when connecting (see asyncipc.schema).
+
+    With spool, a directory or a spool.Spool, messages that can't be sent
+    because the server is down are written to that log instead, and sent
+    in order when a later send or connect() reaches the server again.
+    Requests and streams are never spooled.
+
+    Frames from the server are only decoded if they are encoded with one
+    of formatters (by default serializer.DEFAULT_FORMATTERS) or with the
+    formatter of a request, in which the server answers it.
+    """
+    def __init__(self, socket_name, message_types=None, formatter='json',
+                 shm_threshold=None, compression=None, compact=False, spool=None,
+                 formatters=None):
+        self.socket_path = _path.join(_utils.RUNTIME_DIR, socket_name)
+        self.formatter = formatter
+        if message_types is None:
+            message_types = _message_types
+        self.serial = Serialize(
+            shm_threshold=shm_threshold, compression=compression,
+            formatters=formatters, **message_types,
+        )
+        self.compact = compact
+        self.spool = _make_spool(spool)
+        if spool is not None:
+            self._spool_serial = Serialize(compression=compression, **message_types)
+        self.sock = None
+        self._ids = _count(1)
+        self._replies = None
+
+    def connect(self):
+        if self.sock is None:
+            sock = _socket(_AF_UNIX, _SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+            self._replies = None
+            if self.compact:
+                self._handshake()
+            if self.spool is not None:
+                self._replay()
+        return self.sock
+
+    def _replay(self):
+        "Send the frames spooled while the server couldn't be reached"
+        spool = self.spool
+        for seq, frame in spool.pending():
+            try:
+                _sendmsg_all(self.sock, [frame])
+            except OSError:
+                self.close()
+                raise
+            spool.done(seq)
+        spool.sync()
+
+    def _spool_send(self, items, dump):
+        """Send the frame dump(serial, item) returns for each of items
+
+        If that fails, the frames that weren't sent in full are spooled. A
+        frame the server got part of is sent again whole, as the server
+        discards the part when the connection is closed.
+        """
+        frames = []
+        progress = [0]
+        try:
+            sock = self.connect()
+            frames = [list(dump(self.serial, item)) for item in items]
+            _sendmsg_all(sock, _chain.from_iterable(frames), progress)
+        except OSError:
+            self.close()
+            sent = progress[0]
+            for idx, item in enumerate(items):
+                if idx < len(frames):
+                    sent -= sum(memoryview(x).nbytes for x in frames[idx])
+                if sent < 0 or idx >= len(frames):
+                    self.spool.append(b''.join(dump(self._spool_serial, item)))
+
+    def _handshake(self):
+        serial = self.serial
+        serial.compact = False
+        try:
+            table = self.request(_Hello(serial.schema.fingerprints()))
+        except RemoteError as e:
+            self.close()
+            raise SchemaError(str(e)) from None
+        serial.adopt(table)
+
+    def send(self, message, formatter=None):
+        "Send a single message, opening the connection if needed"
+        formatter = formatter or self.formatter
+        if self.spool is not None:
+            self._spool_send(
+                [message], lambda serial, msg: serial.dump_iter(msg, formatter),
+            )
+            return
+        sock = self.connect()
+        frame = self.serial.dump_iter(message, formatter)
+        _sendmsg_all(sock, frame)
+
+    def send_many(self, messages, formatter=None):
+        "Send an iterable of messages with as few syscalls as possible"
+        formatter = formatter or self.formatter
+        if self.spool is not None:
+            self._spool_send(
+                list(messages), lambda serial, msg: serial.dump_iter(msg, formatter),
+            )
+            return
+        sock = self.connect()
+        frames = _frames(self.serial, messages, formatter)
+        _sendmsg_all(sock, frames)
+
+    def send_batch(self, messages, formatter=None):
+        "Send messages together in a single BATCH frame"
+        formatter = formatter or self.formatter
+        if self.spool is not None:
+            self._spool_send(
+                [messages], lambda serial, msgs: serial.dump_batch_iter(msgs, formatter),
+            )
+            return
+        sock = self.connect()
+        frame = self.serial.dump_batch_iter(messages, formatter)
+        _sendmsg_all(sock, frame)
+
+    def send_stream(self, message, chunks, formatter=None):
+        """Send message with a body streamed from chunks, an iterable of bytes
+
+        The server's observer receives a streams.Stream. If chunks raises,
+        the connection is closed so the server knows the stream failed.
+        """
+        sock = self.connect()
+        stream_id = _next_id(self._ids)
+        serial = self.serial
+        frame = serial.dump_iter(message, formatter or self.formatter, STREAM, stream_id)
+        _sendmsg_all(sock, frame)
+        try:
+            for chunk in chunks:
+                if chunk:
+                    _sendmsg_all(sock, serial.dump_chunk_iter(stream_id, chunk))
+        except BaseException:
+            self.close()
+            raise
+        _sendmsg_all(sock, serial.dump_chunk_iter(stream_id, b''))
+
+    def request(self, message, formatter=None, timeout=None):
+        """Send message and block until the server's observer answers it
+
+        If no answer arrives within timeout seconds TimeoutError is raised
+        and the connection is closed, since the reply may still come.
+        """
+        sock = self.connect()
+        collector = self._replies
+        if collector is None:
+            # Made on the first request, one-way sends don't need it
+            collector = self._replies = _ReplyCollector(self.serial)
+        replies = collector.replies
+        msg_id = _next_id(self._ids, replies)
+        formatter = formatter or self.formatter
+        frame = self.serial.dump_iter(message, formatter, REQUEST, msg_id)
+        _sendmsg_all(sock, frame)
+        # The reply comes back in the formatter we asked with
+        collector.formatters[msg_id] = formatter
+        sock.settimeout(timeout)
+        try:
+            self._receive(sock, collector, msg_id)
+        except TimeoutError:
+            self.close()
+            raise
+        finally:
+            collector.formatters.pop(msg_id, None)
+        sock.settimeout(None)
+        value = replies.pop(msg_id)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _receive(self, sock, collector, msg_id):
+        "Read frames from sock until the reply to msg_id has been collected"
+        replies = collector.replies
+        while msg_id not in replies:
+            buf = collector.get_buffer(-1)
+            nbytes = sock.recv_into(buf)
+            del buf
+            if not nbytes:
+                self.close()
+                raise ConnectionError('Connection to server lost')
+            try:
+                collector.buffer_updated(nbytes)
+            except ValueError:
+                # The stream can't be parsed any further
+                self.close()
+                raise
+
+    def close(self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            sock.close()
+        if self.spool is not None:
+            self.spool.sync()
+
+    def __enter__(self):
+        try:
+            self.connect()
+        except OSError:
+            # Sends are spooled until the server is back
+            if self.spool is None:
+                raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ClientPool:
+    """Reuse blocking Client connections, keyed by socket path
+
+    connection() checks an idle Client out of the pool (or creates one)
+    and puts it back afterwards. A Client that raised anything other than
+    a RemoteError may be in an unknown state and is discarded.
+    """
+    def __init__(self, message_types=None, formatter='json', max_idle=4):
+        self.message_types = message_types
+        self.formatter = formatter
+        self.max_idle = max_idle
+        self.idle = {}
+
+    @_contextmanager
+    def connection(self, socket_name):
+        socket_path = _path.join(_utils.RUNTIME_DIR, socket_name)
+        idle = self.idle.setdefault(socket_path, [])
+        try:
+            client = idle.pop()
+        except IndexError:
+            client = Client(socket_path, self.message_types, self.formatter)
+        try:
+            yield client
+        except RemoteError:
+            self._release(idle, client)
+            raise
+        except BaseException:
+            client.close()
+            raise
+        self._release(idle, client)
+
+    def _release(self, idle, client):
+        if len(idle) < self.max_idle:
+            idle.append(client)
+        else:
+            client.close()
+
+    def send(self, socket_name, message, formatter=None):
+        with self.connection(socket_name) as client:
+            client.send(message, formatter)
+
+    def send_many(self, socket_name, messages, formatter=None):
+        with self.connection(socket_name) as client:
+            client.send_many(messages, formatter)
+
+    def send_batch(self, socket_name, messages, formatter=None):
+        with self.connection(socket_name) as client:
+            client.send_batch(messages, formatter)
+
+    def request(self, socket_name, message, formatter=None, timeout=None):
+        with self.connection(socket_name) as client:
+            return client.request(message, formatter, timeout)
+
+    def close(self):
+        idle, self.idle = self.idle, {}
+        for clients in idle.values():
+            for client in clients:
+                client.close()
+
+
+def __getattr__(name):
+    if name in ('AsyncClient', 'AsyncClientPool', 'ClientProtocol'):
+        from . import asyncclient
+        return getattr(asyncclient, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,267 @@
+"""
+Compress frame bodies.
+
+The codec a frame was compressed with is recorded in its header flags, so a
+receiver decodes frames from any sender as long as it knows the codec. Bodies
+below a size threshold, and bodies that don't shrink, are sent raw.
+
+Codecs that support it can use a preset dictionary per message type, trained
+on sample bodies of that type. Dictionaries help most with small, repetitive
+messages but both ends must have added the same dictionary.
+
+A body that decompresses to more than a maximum size is rejected with
+ValueError, so that a small frame can't make the receiver allocate
+gigabytes. So is a body compressed with a codec that is unknown or, like
+zstd without the zstandard package, unavailable here; the codecs a peer
+can read aren't negotiated, so both ends should configure one they have.
+"""
+import zlib as _zlib
+from functools import lru_cache as _lru_cache
+from struct import Struct as _Struct
+
+# Header flag bits (see serializer): the codec id and whether the body
+# starts with the id of the dictionary it was compressed with
+CODEC_SHIFT = 1
+CODEC_MASK = 0x07 << CODEC_SHIFT
+FLAG_DICT = 0x10
+
+_dict_id = _Struct('<I')
+
+
+def _check_size(size, max_size):
+    if size > max_size:
+        raise ValueError(f"Compressed body expands to more than {max_size} bytes")
+
+codecs = {}
+_codec_ids = {}
+
+class Codec:
+    """Base class for compression codecs
+
+    Subclasses are registered in codecs under their name; their id (1 to 7)
+    is written into the header flags of the frames they compressed.
+    """
+    name = None
+    id = None
+    dictionaries = False  # Whether a preset dictionary can be used
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.name is not None:
+            codecs[cls.name] = cls
+            _codec_ids[cls.id] = cls
+
+    @staticmethod
+    def available():
+        "Whether the codec can be used, i.e. the modules it needs are installed"
+        return True
+
+    @staticmethod
+    def compress(data, level=None, zdict=None):
+        raise NotImplementedError
+
+    @staticmethod
+    def decompress(data, max_size, zdict=None):
+        "Return data decompressed, raising ValueError if it exceeds max_size bytes"
+        raise NotImplementedError
+
+    @staticmethod
+    def train(samples, size):
+        "Return a dictionary of at most size bytes built from sample bodies"
+        raise NotImplementedError("codec doesn't support dictionaries")
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    id = 1
+    dictionaries = True
+
+    @staticmethod
+    def compress(data, level=None, zdict=None):
+        level = -1 if level is None else level
+        if zdict is None:
+            return _zlib.compress(data, level)
+        comp = _zlib.compressobj(level, zdict=zdict)
+        return comp.compress(data) + comp.flush()
+
+    @staticmethod
+    def decompress(data, max_size, zdict=None):
+        if zdict is None:
+            decomp = _zlib.decompressobj()
+        else:
+            decomp = _zlib.decompressobj(zdict=zdict)
+        body = decomp.decompress(data, max_size + 1)
+        _check_size(len(body), max_size)
+        if not decomp.eof:
+            raise ValueError("Compressed body is truncated")
+        return body
+
+    @staticmethod
+    def train(samples, size=1 << 15):
+        # zlib looks back at most 32KiB and finds the end of the dictionary
+        # cheapest to refer to, so keep the most recent samples last
+        size = min(size, 1 << 15)
+        parts, total = [], 0
+        for sample in reversed(samples):
+            if total + len(sample) > size:
+                break
+            parts.append(bytes(sample))
+            total += len(sample)
+        return b''.join(reversed(parts))
+
+
+class LzmaCodec(Codec):
+    "Slow but with the best ratio on large bodies"
+    name = 'lzma'
+    id = 2
+
+    @staticmethod
+    def compress(data, level=None, zdict=None):
+        import lzma
+        return lzma.compress(data, preset=level)
+
+    @staticmethod
+    def decompress(data, max_size, zdict=None):
+        import lzma
+        decomp = lzma.LZMADecompressor()
+        body = decomp.decompress(data, max_size + 1)
+        _check_size(len(body), max_size)
+        if not decomp.eof:
+            raise ValueError("Compressed body is truncated")
+        return body
+
+
+class ZstdCodec(Codec):
+    "Fast codec with trained dictionaries; requires the optional zstandard package"
+    name = 'zstd'
+    id = 3
+    dictionaries = True
+
+    @staticmethod
+    @_lru_cache(maxsize=None)
+    def available():
+        try:
+            import zstandard
+        except ImportError:
+            return False
+        return True
+
+    @staticmethod
+    @_lru_cache(maxsize=32)
+    def _compressor(level, zdict):
+        import zstandard
+        dict_data = None if zdict is None else zstandard.ZstdCompressionDict(zdict)
+        return zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+
+    @staticmethod
+    @_lru_cache(maxsize=32)
+    def _decompressor(zdict):
+        import zstandard
+        dict_data = None if zdict is None else zstandard.ZstdCompressionDict(zdict)
+        return zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    @classmethod
+    def compress(cls, data, level=None, zdict=None):
+        level = 3 if level is None else level
+        return cls._compressor(level, zdict).compress(data)
+
+    @classmethod
+    def decompress(cls, data, max_size, zdict=None):
+        # decompress() trusts the content size written in the frame, read
+        # no more than max_size bytes instead
+        parts, total = [], 0
+        with cls._decompressor(zdict).stream_reader(data) as reader:
+            while total <= max_size:
+                part = reader.read(max_size + 1 - total)
+                if not part:
+                    break
+                parts.append(part)
+                total += len(part)
+        _check_size(total, max_size)
+        return b''.join(parts)
+
+    @staticmethod
+    def train(samples, size=1 << 15):
+        import zstandard
+        samples = [bytes(sample) for sample in samples]
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def get_codec(name):
+    try:
+        codec = codecs[name]
+    except KeyError as e:
+        raise NotImplementedError(f"compression codec {name!r} doesn't exist!") from e
+    if not codec.available():
+        raise NotImplementedError(f"compression codec {name!r} isn't available")
+    return codec
+
+
+class Compression:
+    """Compression settings of a Serialize
+
+    Bodies of at least threshold bytes are compressed with codec at level
+    (None for the codec's default). Message types with a dictionary (see
+    add_dictionary and train) are compressed with it if the codec allows.
+    Any codec can be decompressed, whatever codec is configured, as long
+    as the body expands to no more than max_size bytes.
+    """
+    max_size = 1 << 26
+
+    def __init__(self, codec='zlib', threshold=1024, level=None, max_size=None):
+        self.codec = get_codec(codec)
+        self.threshold = threshold
+        self.level = level
+        if max_size is not None:
+            self.max_size = max_size
+        self.dictionaries = {}  # Message type name -> (id, dictionary)
+        self._by_id = {}
+
+    def add_dictionary(self, msgtype, zdict):
+        "Use zdict (bytes) for messages of msgtype (a class or its name)"
+        name = getattr(msgtype, '__name__', msgtype)
+        dict_id = _zlib.crc32(zdict)
+        self.dictionaries[name] = (dict_id, zdict)
+        self._by_id[dict_id] = zdict
+        return dict_id
+
+    def train(self, msgtype, samples, size=1 << 15):
+        "Train a dictionary for msgtype on sample bodies and add it"
+        zdict = self.codec.train(samples, size)
+        self.add_dictionary(msgtype, zdict)
+        return zdict
+
+    def compress(self, data, msg_type=None):
+        "Return data, compressed if it is worth it, and the header flags for it"
+        if len(data) < self.threshold:
+            return data, 0
+        codec = self.codec
+        flags = codec.id << CODEC_SHIFT
+        entry = self.dictionaries.get(msg_type) if codec.dictionaries else None
+        if entry is None:
+            body = codec.compress(data, self.level)
+        else:
+            dict_id, zdict = entry
+            body = _dict_id.pack(dict_id) + codec.compress(data, self.level, zdict)
+            flags |= FLAG_DICT
+        if len(body) >= len(data):
+            return data, 0
+        return body, flags
+
+    def decompress(self, data, flags):
+        "Decompress data from a frame whose header has flags"
+        codec_id = (flags & CODEC_MASK) >> CODEC_SHIFT
+        try:
+            codec = _codec_ids[codec_id]
+        except KeyError:
+            raise ValueError(f"Unknown compression codec id {codec_id}") from None
+        if not codec.available():
+            raise ValueError(f"Compression codec {codec.name!r} isn't available")
+        if not flags & FLAG_DICT:
+            return codec.decompress(data, self.max_size)
+        dict_id, = _dict_id.unpack_from(data)
+        try:
+            zdict = self._by_id[dict_id]
+        except KeyError:
+            raise ValueError(f"Unknown compression dictionary {dict_id:#010x}") from None
+        return codec.decompress(data[_dict_id.size:], self.max_size, zdict)
@@ -0,0 +1,134 @@
+"""
+Reassemble HeaderFormat frames from a byte stream.
+
+FrameReader does the parsing for both the asyncio protocols (see
+framing.FrameProtocol) and the blocking Client, which reads from its
+socket itself and so doesn't need asyncio.
+"""
+from . import _utils
+
+
+class FrameReader:
+    """Read HeaderFormat framed messages into a single reusable buffer
+
+    Data is read straight into a growable bytearray (see get_buffer() and
+    buffer_updated()). Every complete frame is handed to frame_received()
+    as a memoryview into that buffer, so a body is never copied before it
+    is decoded. The view is released
+    as soon as frame_received() returns and must not be kept around.
+
+    A header announcing a body larger than max_frame_size makes
+    buffer_updated() raise ValueError before any room is made for it, so
+    a peer can't make us allocate more than that; asyncio then closes the
+    connection.
+
+    Frames encoded with a formatter missing from serial.formatters are
+    refused the same way, unless the accept(header) method a subclass may
+    define returns true for them.
+    """
+    accept = None
+    initial_size = 1 << 16
+    min_read = 1 << 12
+    max_frame_size = 1 << 26
+
+    def __init__(self, serial):
+        self.logr = _utils.get_logger()
+        self.serial = serial
+        self.header_length = serial.header_length
+        self.transport = None
+        self._buf = bytearray(self.initial_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # Start of the data that hasn't been parsed
+        self._end = 0  # End of the data received so far
+        self._header = None  # Header of the frame whose body is pending
+        self._pauses = set()  # Reasons given to pause() and not resumed yet
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self._header is not None or self._start != self._end:
+            self.logr.warning('Connection closed in the middle of a frame')
+        self.transport = None
+
+    def frame_received(self, header, body):
+        raise NotImplementedError
+
+    def get_buffer(self, sizehint):
+        pending = self._end - self._start
+        if self._header is None:
+            needed = self.header_length - pending
+        else:
+            needed = self._header.data_length - pending
+        self._reserve(max(needed, self.min_read))
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        self._parse()
+
+    def pause(self, reason):
+        """Stop parsing frames and reading from the transport
+
+        Reading goes on once resume() was called with every reason
+        (a hashable) that pause() was.
+        """
+        pauses = self._pauses
+        if not pauses:
+            self.transport.pause_reading()
+        pauses.add(reason)
+
+    def resume(self, reason):
+        pauses = self._pauses
+        if reason not in pauses:
+            return
+        pauses.discard(reason)
+        if not pauses:
+            self._parse()
+            if not pauses and self.transport is not None:
+                self.transport.resume_reading()
+
+    def _parse(self):
+        view = self._view
+        header_length = self.header_length
+        load = self.serial.load
+        start, end = self._start, self._end
+        header = self._header
+        pauses = self._pauses
+        while not pauses:
+            if header is None:
+                if end - start < header_length:
+                    break
+                header = load(view, start, self.accept)
+                if header.data_length > self.max_frame_size:
+                    raise ValueError(
+                        f'Frame body of {header.data_length} bytes is larger'
+                        f' than max_frame_size ({self.max_frame_size})'
+                    )
+                start += header_length
+            stop = start + header.data_length
+            if end < stop:
+                break
+            self._start, self._header = stop, None
+            with view[start:stop] as body:
+                self.frame_received(header, body)
+            start, header = stop, None
+        if start == end:
+            start = end = 0
+        self._start, self._end, self._header = start, end, header
+
+    def _reserve(self, nbytes):
+        "Make room for at least nbytes after the unparsed data"
+        start, end = self._start, self._end
+        if len(self._buf) - end >= nbytes:
+            return
+        pending = end - start
+        if start:
+            self._view[:pending] = self._view[start:end]
+            self._start, self._end = 0, pending
+        if len(self._buf) - pending >= nbytes:
+            return
+        buf = bytearray(max(2 * len(self._buf), pending + nbytes))
+        buf[:pending] = self._view[:pending]
+        self._view.release()
+        self._buf, self._view = buf, memoryview(buf)
@@ -0,0 +1,7 @@
+import asyncio
+
+from .frames import FrameReader
+
+
+class FrameProtocol(FrameReader, asyncio.BufferedProtocol):
+    "asyncio.BufferedProtocol reading HeaderFormat framed messages, see FrameReader"
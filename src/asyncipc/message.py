@@ -1,5 +1,7 @@
-import inspect as _inspect
+from array import typecodes as _typecodes
 from itertools import chain as _chain
+from keyword import iskeyword as _iskeyword
+from types import FunctionType as _FunctionType
 from weakref import WeakValueDictionary as _WeakValueDictionary
 
 
@@ -7,6 +9,9 @@ from weakref import WeakValueDictionary as _WeakValueDictionary
 # code from the python cookbook 3rd edition
 
 class StructureMeta(type):
+    # Namespaces of the generated methods, by (positional, keyword) field names
+    _methods = {}
+
     def __new__(cls, clsname, bases, clsdict):
         # print(clsname, '->', bases)
         # print(clsdict)
@@ -17,11 +22,34 @@ class StructureMeta(type):
             kwfields.items(),
             *StructureMeta._get_fields(*bases),
         )
-        sig = StructureMeta.make_sig(*parameters)
-        clsdict['__signature__'] = sig
-        clsdict['__slots__'] = tuple(sig.parameters)
+        names, kwdefaults = StructureMeta.make_layout(*parameters)
+        clsdict['__slots__'] = names
+        clsdict['_kwdefaults'] = kwdefaults
+        methods = StructureMeta.make_methods(names, kwdefaults)
+        custom = StructureMeta._custom_methods(methods, *bases)
+        generated = []
+        for name, fn in methods.items():
+            if name not in clsdict and name not in custom:
+                clsdict[name] = fn
+                generated.append(name)
+        clsdict['_generated'] = frozenset(generated)
+        # _from_tuple and _from_dict only bypass a generated __init__
+        clsdict['_plain_init'] = '__init__' in generated
         return super().__new__(cls, clsname, bases, clsdict)
 
+    @staticmethod
+    def _custom_methods(names, *bases):
+        "Return which of names the nearest Structure base defining them wrote by hand"
+        custom = set()
+        found = set()
+        for klass in StructureMeta._get_structures(*bases):
+            for name in names:
+                if name in klass.__dict__ and name not in found:
+                    found.add(name)
+                    if name not in klass._generated:
+                        custom.add(name)
+        return custom
+
     @classmethod
     def _get_fields(cls, *bases):
         structs = list(StructureMeta._get_structures(*bases))
@@ -50,50 +78,196 @@ class StructureMeta(type):
                     seen.add(cls2)
 
     @staticmethod
-    def make_sig(*fields):
-        Parameter, Signature = _inspect.Parameter, _inspect.Signature
-        pos_parms = []
-        kw_parms = []
+    def make_layout(*fields):
+        """Return the names of fields, positional ones first, and the defaults
+        of the keyword-only ones, given as (name, default) pairs
+        """
+        positional = []
+        kwdefaults = {}
         for field in fields:
-            if isinstance(field, str):
-                pos_parms.append(Parameter(field, Parameter.POSITIONAL_OR_KEYWORD))
+            name = field if isinstance(field, str) else field[0]
+            if not name.isidentifier() or _iskeyword(name):
+                raise ValueError(f'{name!r} is not a valid parameter name')
+            if name in kwdefaults or name in positional:
+                raise ValueError(f'duplicate parameter name: {name!r}')
+            if name is field:
+                positional.append(name)
             else:
-                name, default = field
-                kw_parms.append(Parameter(name, Parameter.KEYWORD_ONLY, default=default))
-        return Signature(_chain(pos_parms, kw_parms))
+                kwdefaults[name] = field[1]
+        return tuple(positional) + tuple(kwdefaults), kwdefaults
+
+    @staticmethod
+    def make_sig(names, kwdefaults):
+        import inspect
+        Parameter = inspect.Parameter
+        return inspect.Signature([
+            Parameter(name, Parameter.KEYWORD_ONLY, default=kwdefaults[name])
+            if name in kwdefaults else
+            Parameter(name, Parameter.POSITIONAL_OR_KEYWORD)
+            for name in names
+        ])
+
+    @staticmethod
+    def make_methods(names, kwdefaults):
+        """Generate __init__, _from_tuple, _from_dict, _as_tuple, as_dict and __repr__
+
+        The generated code assigns each field directly, so constructing a
+        message doesn't go through Signature.bind(). It is compiled once
+        per layout of fields and shared by the classes having that layout.
+        """
+        key = (names, tuple(kwdefaults))
+        namespace = StructureMeta._methods.get(key)
+        if namespace is None:
+            namespace = StructureMeta._methods[key] = StructureMeta._compile(
+                names, kwdefaults,
+            )
+        init = namespace['__init__']
+        # Only the defaults differ between classes of the same layout
+        init = _FunctionType(init.__code__, init.__globals__, init.__name__)
+        init.__kwdefaults__ = dict(kwdefaults) or None
+        return {
+            '__init__': init,
+            '_from_tuple': classmethod(namespace['_from_tuple']),
+            '_from_dict': classmethod(namespace['_from_dict']),
+            '_as_tuple': namespace['_as_tuple'],
+            'as_dict': property(namespace['as_dict']),
+            '__repr__': namespace['__repr__'],
+        }
+
+    @staticmethod
+    def _compile(names, kwdefaults):
+        args = ['self']
+        for name in names:
+            if name in kwdefaults:
+                if '*' not in args:
+                    args.append('*')
+                args.append(f'{name}=None')
+            else:
+                args.append(name)
+        lines = [f'def __init__({", ".join(args)}):']
+        lines.extend(f'    self.{x} = {x}' for x in names)
+        lines.append('    pass')
+
+        lines.append('def _from_tuple(cls, values):')
+        lines.append('    if not cls._plain_init:')
+        lines.append('        return cls(**dict(zip(_names, values)))')
+        lines.append('    self = _new(cls)')
+        if names:
+            lines.append('    ' + ''.join(f'self.{x}, ' for x in names) + '= values')
+        lines.append('    return self')
+
+        # A dict with exactly the fields (as_dict of a peer) is assigned
+        # directly, anything else goes through __init__
+        lines.append('def _from_dict(cls, d):')
+        lines.append('    if not cls._plain_init or d.keys() != _keys:')
+        lines.append('        return cls(**d)')
+        lines.append('    self = _new(cls)')
+        lines.extend(f'    self.{x} = d[{x!r}]' for x in names)
+        lines.append('    return self')
+
+        lines.append('def _as_tuple(self):')
+        lines.append('    return (' + ''.join(f'self.{x}, ' for x in names) + ')')
+
+        items = ', '.join(f'{x!r}: self.{x}' for x in names)
+        lines.append('def as_dict(self):')
+        lines.append(f'    return {{{items}}}')
+
+        fields = ', '.join(f'{x}={{self.{x}!r}}' for x in names)
+        lines.append('def __repr__(self):')
+        lines.append(f'    return f"{{self.__class__.__name__}}({fields})"')
+
+        namespace = {'_new': object.__new__, '_names': names, '_keys': frozenset(names)}
+        exec('\n'.join(lines), namespace)
+        return namespace
+
+
+class _Signature:
+    "Non-data descriptor giving the inspect.Signature of a class's fields, made on first use"
+    def __get__(self, obj, cls):
+        sig = cls.__dict__.get('_signature')
+        if sig is None:
+            sig = StructureMeta.make_sig(cls.__slots__, cls._kwdefaults)
+            cls._signature = sig
+        return sig
 
 
 class Structure(metaclass=StructureMeta):
+    """Base class for structures with a fixed set of fields
+
+    Positional fields are listed in _fields and keyword-only fields with
+    their defaults in _kwfields. StructureMeta generates __init__, as_dict
+    and __repr__ for every subclass, as well as the _from_tuple(values)
+    classmethod which builds an instance from the field values in
+    __slots__ order, and its inverse _as_tuple(). _from_dict(d) likewise
+    builds an instance from an as_dict. Both skip __init__ unless it was
+    written by hand. Methods written by hand, in the class or inherited
+    from a base, are kept.
+    """
     _fields = []
     _kwfields = {}
-    def __init__(self, *args, **kwargs):
-        bound_values = self.__signature__.bind(*args, **kwargs)
-        # print(bound_values)
-        bound_values.apply_defaults()
-        # print(bound_values)
-        for name, value in bound_values.arguments.items():
-            setattr(self, name, value)
-
-    @property
-    def as_dict(self):
-        return {x:getattr(self, x) for x in self.__slots__}
-
-    def __repr__(self):
-        sig = self.__signature__
-        bound = sig.bind(**self.as_dict)
-        kwargs = (f'{key}={val!r}' for key,val in bound.arguments.items())
-        inner = ', '.join(kwargs)
-        cname = self.__class__.__name__
-        return f'{cname}({inner})'
+    __signature__ = _Signature()
 
 
 message_types = _WeakValueDictionary()
 
 class BaseMessage(Structure):
+    """Base class of the messages sent to a Server
+
+    Messages carrying state of which only the latest value matters can set
+    _coalesce to the names of the fields telling what the state is about,
+    e.g. ['sensor']. A message then replaces a queued one of the same type
+    with equal (hashable) values of those fields instead of being queued
+    after it; with an empty list all messages of the type are equal. If
+    _debounce is also set to a number of seconds, the first message of a
+    key is held back that long before being queued, and newer ones replace
+    it in the meantime. Requests are never coalesced.
+    """
+    _coalesce = None
+    _debounce = None
+
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         clsname = cls.__name__
+        if cls._coalesce is not None:
+            unknown = [name for name in cls._coalesce if name not in cls.__slots__]
+            if unknown:
+                raise TypeError(f"{clsname}._coalesce names unknown fields {unknown}")
+        elif cls._debounce is not None:
+            raise TypeError(f"{clsname}._debounce requires _coalesce")
         # if clsname in message_types:
         #     txt = f"Message type {clsname!r} is already registered"
         #     raise ValueError(txt)
         message_types[clsname] = cls
+
+
+# array typecodes that memoryview.cast() understands ('u' is deprecated)
+COLUMN_TYPECODES = ''.join(code for code in _typecodes if code != 'u')
+
+class ColumnMessage(BaseMessage):
+    """Message carrying arrays of numbers, e.g. a batch of samples
+
+    _columns maps the names of fields holding arrays to their array module
+    typecodes, e.g. {'t': 'd', 'value': 'f'}; like _kwfields it is merged
+    along the class hierarchy. A column may be given as an array.array, a
+    one-dimensional buffer (memoryview, numpy array) of that typecode or
+    any iterable of numbers. Sent with the 'columns' formatter (see
+    serializer.ColumnBackend) every column goes into the frame as one
+    contiguous buffer, and is received as a read-only memoryview into the
+    frame body, or a numpy array of it if numpy is installed.
+    """
+    _columns = {}
+    _column_types = {}
+
+    def __init_subclass__(cls, **kwargs):
+        columns = {}
+        for klass in reversed(cls.__mro__):
+            columns.update(klass.__dict__.get('_columns', {}))
+        clsname = cls.__name__
+        for name, code in columns.items():
+            if name not in cls.__slots__:
+                raise TypeError(f"{clsname}._columns names unknown field {name!r}")
+            if code not in COLUMN_TYPECODES:
+                raise TypeError(f"{clsname}._columns has invalid typecode {code!r}")
+        # The columns in __slots__ order, as they are encoded
+        cls._column_types = {x: columns[x] for x in cls.__slots__ if x in columns}
+        super().__init_subclass__(**kwargs)
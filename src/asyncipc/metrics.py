@@ -0,0 +1,127 @@
+"""
+Counters and histograms describing what a Server is doing.
+
+A Server only collects metrics when it is created with metrics=True; all
+of its hot paths check for Server.metrics being None first, so disabled
+metrics cost a single attribute test. A snapshot can be pulled with a
+GetMetrics request or by connecting to the server's metrics socket.
+"""
+from .message import BaseMessage
+
+
+class GetMetrics(BaseMessage):
+    "Request answered by a snapshot of the server's metrics"
+
+
+class Histogram:
+    """Histogram of durations with power-of-two microsecond buckets
+
+    Bucket i counts durations below 2**i microseconds (and at least
+    2**(i-1) for i > 0); the last bucket also holds anything larger.
+    """
+    __slots__ = ('count', 'total', 'max', 'buckets')
+    nbuckets = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * self.nbuckets
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        idx = int(seconds * 1e6).bit_length()
+        buckets = self.buckets
+        buckets[min(idx, len(buckets) - 1)] += 1
+
+    def percentile(self, pct):
+        "Upper bound in seconds of the bucket holding the pct percentile"
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100
+        seen = 0
+        for idx, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min((1 << idx) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        count = self.count
+        return {
+            'count': count,
+            'mean': self.total / count if count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class ObserverStats:
+    "Latency and failures of one observer"
+    __slots__ = ('latency', 'failures')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.failures = 0
+
+    def record(self, seconds, failed=False):
+        self.latency.observe(seconds)
+        if failed:
+            self.failures += 1
+
+    def snapshot(self):
+        d = self.latency.snapshot()
+        d['failures'] = self.failures
+        return d
+
+
+class Metrics:
+    "Everything a Server records about itself"
+    def __init__(self):
+        self.connections_open = 0
+        self.connections_total = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = {}
+        self.decode = Histogram()
+        self.queue_wait = Histogram()
+        self.queue_depth_max = 0
+        self.coalesced = 0
+        self.unobserved = 0  # Frames dropped undecoded as nobody observes them
+        self.observers = {}
+
+    def observer_stats(self, name):
+        try:
+            return self.observers[name]
+        except KeyError:
+            stats = self.observers[name] = ObserverStats()
+            return stats
+
+    def count_message(self, msg_type):
+        messages = self.messages
+        messages[msg_type] = messages.get(msg_type, 0) + 1
+
+    def snapshot(self, queue_depth=0):
+        return {
+            'connections': {
+                'open': self.connections_open,
+                'total': self.connections_total,
+            },
+            'bytes': {'in': self.bytes_in, 'out': self.bytes_out},
+            'messages': dict(self.messages),
+            'unobserved': self.unobserved,
+            'decode': self.decode.snapshot(),
+            'queue': {
+                'depth': queue_depth,
+                'max_depth': self.queue_depth_max,
+                'coalesced': self.coalesced,
+                'wait': self.queue_wait.snapshot(),
+            },
+            'observers': {
+                name: stats.snapshot() for name, stats in self.observers.items()
+            },
+        }
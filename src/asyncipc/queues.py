@@ -0,0 +1,145 @@
+import asyncio
+from collections import deque as _deque
+from time import perf_counter as _perf_counter
+
+
+def type_key(msg):
+    "Coalesce key under which all messages of the same type are equal"
+    return msg.__class__.__name__
+
+
+def message_key(msg):
+    """Coalesce key declared by the type of msg (see BaseMessage), or None
+
+    None is also returned if the values of the key fields can't be hashed,
+    so that such a message is queued without coalescing.
+    """
+    fields = getattr(msg.__class__, '_coalesce', None)
+    if fields is None:
+        return None
+    key = (msg.__class__, *[getattr(msg, name) for name in fields])
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _type_name(item):
+    "Return the message type name of a queued (message, reply) item, or None"
+    msg = item[0]
+    if msg.__class__ is list:
+        if not msg:
+            return None
+        msg = msg[0]
+    return msg.__class__.__name__
+
+
+class MessageQueue(asyncio.Queue):
+    """Bounded queue of (message, reply) items with priority lanes
+
+    priorities maps message type names to an integer priority (0 by
+    default); items of a higher priority are always taken out first and
+    items within a lane are FIFO. A BATCH item takes the priority of its
+    first message.
+
+    coalesce() swaps a queued item for a newer one with the same key
+    declared by its message type, keeping the old item's place in its lane.
+    If coalesce_key is given, replace() can do the same for messages of
+    any type, with the key returned by coalesce_key.
+
+    If metrics (a metrics.Metrics) is set, the queue records the time items
+    wait in it and its highest depth.
+    """
+    def __init__(self, maxsize=0, priorities=None, coalesce_key=None):
+        self.priorities = dict(priorities or {})
+        self.coalesce_key = coalesce_key
+        self.metrics = None
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        levels = set(self.priorities.values())
+        levels.add(0)
+        # Each lane holds cells ([item]) so coalescing can update in place
+        self._lanes = {level: _deque() for level in sorted(levels, reverse=True)}
+        self._cells = {}
+        self._count = 0
+
+    def qsize(self):
+        return self._count
+
+    def empty(self):
+        return not self._count
+
+    def _key(self, item):
+        msg = item[0]
+        if msg.__class__ is list or item[1] is not None:
+            return None
+        key = message_key(msg)
+        if key is None and self.coalesce_key is not None:
+            key = self.coalesce_key(msg)
+        return key
+
+    def _put(self, item):
+        cell = [item]
+        level = self.priorities.get(_type_name(item), 0)
+        self._lanes[level].append(cell)
+        self._count += 1
+        metrics = self.metrics
+        if metrics is not None:
+            cell.append(_perf_counter())
+            if self._count > metrics.queue_depth_max:
+                metrics.queue_depth_max = self._count
+        key = self._key(item)
+        if key is not None:
+            self._cells[key] = cell
+
+    def _get(self):
+        for lane in self._lanes.values():
+            if lane:
+                cell = lane.popleft()
+                self._count -= 1
+                item = cell[0]
+                self._forget(item, cell)
+                if len(cell) > 1:
+                    self.metrics.queue_wait.observe(_perf_counter() - cell[1])
+                return item
+        raise asyncio.QueueEmpty
+
+    def _forget(self, item, cell):
+        key = self._key(item)
+        if key is not None and self._cells.get(key) is cell:
+            del self._cells[key]
+
+    def replace(self, item):
+        "Swap item for a queued item with the same key; return the old item"
+        return self._swap(self._key(item), item)
+
+    def coalesce(self, item):
+        """Swap item for a queued item with the key its type declares
+
+        Return the old item, or None if there was none and item still has
+        to be queued.
+        """
+        if item[1] is not None:
+            return None
+        return self._swap(message_key(item[0]), item)
+
+    def _swap(self, key, item):
+        cell = self._cells.get(key) if key is not None else None
+        if cell is None:
+            return None
+        old, cell[0] = cell[0], item
+        return old
+
+    def drop_oldest(self):
+        "Remove and return the oldest item of the lowest priority lane"
+        for lane in reversed(list(self._lanes.values())):
+            if lane:
+                cell = lane.popleft()
+                self._count -= 1
+                item = cell[0]
+                self._forget(item, cell)
+                self.task_done()
+                return item
+        raise asyncio.QueueEmpty
@@ -0,0 +1,116 @@
+"""
+Small integer ids for message types, agreed on with a handshake.
+
+A Schema numbers a set of message types: the types known when it is
+created in the order of their names, then any type added later. A message
+can then be encoded as its type's id followed by its field values in
+__slots__ order instead of its type name and a dict of its fields.
+
+A client asks for the server's schema by sending Hello with the
+fingerprints of its own types; the server checks them against its own and
+answers with its table of (name, fingerprint) in id order, which the client
+then encodes with. A type whose fields differ between the two ends fails
+the handshake instead of being decoded wrongly later on.
+
+Independently of any schema, every frame carrying messages of a single
+type has that type's type_id() in its header, so that a server can tell
+what a frame holds without decoding its body.
+"""
+from zlib import crc32 as _crc32
+
+from .message import BaseMessage
+
+
+class SchemaError(Exception):
+    "Two peers disagree about the fields of a message type"
+
+
+class Hello(BaseMessage):
+    "Schema handshake request; fingerprints maps type names to fingerprints"
+    _fields = ['fingerprints']
+
+
+_type_ids = {}
+
+def type_id(name):
+    """Return the header id of the message type called name
+
+    It is a hash of the name, so that peers agree on it without a handshake.
+    """
+    try:
+        return _type_ids[name]
+    except KeyError:
+        pass
+    tid = _type_ids[name] = _crc32(name.encode('utf-8'))
+    return tid
+
+
+def fingerprint(msgtype):
+    "Return an int identifying the name and fields of msgtype"
+    fields = ','.join(msgtype.__slots__)
+    return _crc32(f'{msgtype.__name__}({fields})'.encode('utf-8'))
+
+
+class Schema:
+    "Numbering of message types, see the module docstring"
+    def __init__(self, message_types=()):
+        self.types = []  # Message class (or None) for each id
+        self.ids = {}  # Message class -> id
+        for name in sorted(message_types):
+            self.add(message_types[name])
+
+    def add(self, msgtype):
+        "Give msgtype the next id unless it has one; return its id"
+        try:
+            return self.ids[msgtype]
+        except KeyError:
+            pass
+        type_id = self.ids[msgtype] = len(self.types)
+        self.types.append(msgtype)
+        return type_id
+
+    @classmethod
+    def from_table(cls, table, message_types):
+        """Return the schema described by table, a peer's Schema.table()
+
+        message_types maps names to the local classes; ids of types that
+        only the peer knows are left unused.
+        """
+        schema = cls()
+        for name, fp in table:
+            msgtype = message_types.get(name)
+            if msgtype is not None:
+                if fingerprint(msgtype) != fp:
+                    raise SchemaError(f"Message type {name} differs from the peer's")
+                schema.ids[msgtype] = len(schema.types)
+            schema.types.append(msgtype)
+        return schema
+
+    def table(self):
+        "Return [name, fingerprint] for every type in id order"
+        return [[msgtype.__name__, fingerprint(msgtype)] for msgtype in self.types]
+
+    def fingerprints(self):
+        return {msgtype.__name__: fingerprint(msgtype) for msgtype in self.ids}
+
+    def check(self, fingerprints):
+        "Raise SchemaError if any type in fingerprints differs from ours"
+        ours = self.fingerprints()
+        bad = sorted(
+            name for name, fp in fingerprints.items()
+            if name in ours and ours[name] != fp
+        )
+        if bad:
+            raise SchemaError(f"Message types differ from the server's: {', '.join(bad)}")
+
+    def pack(self, message):
+        "Return message as a tuple of its type id and field values"
+        return (self.ids[message.__class__],) + message._as_tuple()
+
+    def unpack(self, values):
+        "Inverse of pack()"
+        type_id = values[0]
+        msgtype = self.types[type_id] if type_id < len(self.types) else None
+        if msgtype is None:
+            raise SchemaError(f"Unknown message type id {type_id}")
+        return msgtype._from_tuple(values[1:])
@@ -1,30 +1,79 @@
 import json as _json
+import json.encoder as _json_encoder
+from array import array as _array
 from collections import namedtuple as _namedtuple
+from struct import Struct as _Struct
 from struct import calcsize as _calcsize
 from struct import pack as _pack
-from struct import unpack as _unpack
+from struct import unpack_from as _unpack_from
 
-_HeaderFmt = _namedtuple('_HeaderFmt', ('tag', 'data_length'))
+from . import compression as _compression
+from . import shm as _shm
+from .message import ColumnMessage as _ColumnMessage
+from .message import Structure as _Structure
+from .schema import Schema as _Schema
+from .schema import type_id as _type_id
+
+# Frame kinds. A REQUEST is answered by a REPLY or an ERROR frame
+# carrying the same msg_id. A BATCH frame carries a list of messages.
+# A STREAM frame carries a message whose body follows in CHUNK frames
+# with the same msg_id, the last of them empty (see asyncipc.streams).
+MESSAGE, REQUEST, REPLY, ERROR, BATCH, STREAM, CHUNK = range(7)
+
+# Header flags. FLAG_SHM: the body is a handle to a shared memory segment
+# holding the actual body (see asyncipc.shm). The bits of CODEC_MASK and
+# FLAG_DICT describe how the body was compressed (see asyncipc.compression).
+# FLAG_COMPACT: messages are encoded by type id and field values in __slots__
+# order (see asyncipc.schema).
+FLAG_SHM = 0x01
+CODEC_MASK = _compression.CODEC_MASK
+FLAG_DICT = _compression.FLAG_DICT
+FLAG_COMPACT = 0x40
+
+# Backends whose frames Serialize decodes unless told otherwise. pickle
+# isn't one of them: unpickling a peer's frame runs whatever code it says.
+DEFAULT_FORMATTERS = ('json', 'msgpack', 'struct', 'columns')
+
+# type_id is schema.type_id() of the type of the message(s) in the body,
+# or 0 if it holds something else or messages of several types.
+_HeaderFmt = _namedtuple(
+    '_HeaderFmt',
+    ('version', 'tag', 'data_length', 'kind', 'msg_id', 'flags', 'type_id'),
+)
 class HeaderFormat:
+    """Fixed size frame header
+
+    The leading version byte changes whenever the layout does, so that
+    peers with incompatible headers fail loudly instead of misreading
+    each other's frames.
+    """
+    version = 2
     _taglen = 10
-    fmt = _HeaderFmt(tag=f'{_taglen:d}s', data_length='I')
-    _fmt = ''.join(fmt)
+    fmt = _HeaderFmt(
+        version='B', tag=f'{_taglen:d}s', data_length='I', kind='B',
+        msg_id='I', flags='B', type_id='I',
+    )
+    _fmt = '=' + ''.join(fmt)
     length = _calcsize(_fmt)
 
     @classmethod
-    def pack(cls, b_tag, length):
+    def pack(cls, b_tag, length, kind=MESSAGE, msg_id=0, flags=0, type_id=0):
         "Return a bytes object given a b_tag (bytes) and length (int)"
         taglen = cls._taglen
         if len(b_tag) > taglen:
             raise ValueError(f"Header tag {b_tag!r} is longer than {taglen}")
-        return _pack(cls._fmt, b_tag, length)
+        return _pack(cls._fmt, cls.version, b_tag, length, kind, msg_id, flags, type_id)
 
     @classmethod
-    def unpack(cls, bstr):
-        "Unpack a _HeaderFmt object from the bytes string bstr."
-        tag, length = _unpack(cls._fmt, bstr)
+    def unpack(cls, bstr, offset=0):
+        "Unpack a _HeaderFmt object from the buffer bstr at offset."
+        version, tag, length, kind, msg_id, flags, type_id = _unpack_from(
+            cls._fmt, bstr, offset,
+        )
+        if version != cls.version:
+            raise ValueError(f"Unsupported header version {version}")
         tag = tag.replace(b'\x00', b'')
-        return _HeaderFmt(tag, length)
+        return _HeaderFmt(version, tag, length, kind, msg_id, flags, type_id)
 
     @classmethod
     def __repr__(cls):
@@ -40,49 +89,594 @@ _HeaderInfo = _namedtuple(
 )
 _Msg = _namedtuple('_Msg', ('name', 'data'))
 
+
+def _make_json_encode():
+    """Return a function like json.dumps(obj, ensure_ascii=False)
+
+    json.dumps() builds a new encoder for every call, which costs more than
+    encoding a small message; this builds the C encoder once (without the
+    check for circular references).
+    """
+    encoder = _json.JSONEncoder(ensure_ascii=False)
+    c_make_encoder = getattr(_json_encoder, 'c_make_encoder', None)
+    if c_make_encoder is None:
+        return encoder.encode
+    iterencode = c_make_encoder(
+        None, encoder.default, _json_encoder.encode_basestring, None,
+        encoder.key_separator, encoder.item_separator, False, False, True,
+    )
+    def encode(obj):
+        return ''.join(iterencode(obj, 0))
+    return encode
+
+_json_encode = _make_json_encode()
+
+
+class LazyMessage:
+    """Message of class msgtype that is only decoded from its frame when needed
+
+    The proxy passes for a msgtype instance (its __class__ is msgtype) and
+    decodes the frame body the first time anything but its class is looked
+    up, so that a message that is only routed or counted is never parsed.
+    """
+    __slots__ = ('_msgtype', '_header', '_body', '_message')
+
+    def __init__(self, msgtype, header, body):
+        self._msgtype = msgtype
+        self._header = header
+        self._body = body
+        self._message = None
+
+    @property
+    def __class__(self):
+        return self._msgtype
+
+    def _decoded(self):
+        "Return the decoded message"
+        message = self._message
+        if message is None:
+            message = self._message = self._header.data_loader(self._body)
+        return message
+
+    def __getattr__(self, name):
+        return getattr(self._decoded(), name)
+
+    def __repr__(self):
+        return f'<LazyMessage {self._msgtype.__name__}>'
+
+
+backends = {}
+
+class Backend:
+    """Base class for message body encodings
+
+    Subclasses are registered in backends under their tag, which is also
+    written into the frame header so that Serialize.load can dispatch on it.
+    By default a message is encoded as a (name, as_dict) pair, and any
+    other value (e.g. the result of a request) as a (None, value) pair.
+    Backends whose encode() takes any list can also encode messages
+    compactly, as a type id followed by the field values.
+
+    encoder() returns a function encoding messages of one class like
+    dumps(); Serialize caches it per class, so a backend can prepare in it
+    whatever is the same for every message of the class.
+    """
+    tag = None
+    compact = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.tag is not None:
+            backends[cls.tag] = cls
+
+    @classmethod
+    def dumps(cls, message):
+        if isinstance(message, _Structure):
+            return cls.encode(_Msg(message.__class__.__name__, message.as_dict))
+        return cls.encode(_Msg(None, message))
+
+    @classmethod
+    def encoder(cls, msgtype):
+        "Return a function encoding a message of class msgtype"
+        name = msgtype.__name__
+        encode = cls.encode
+        def dumps(message):
+            return encode(_Msg(name, message.as_dict))
+        return dumps
+
+    @classmethod
+    def loads(cls, b_obj, message_types):
+        name, data = cls.decode(b_obj)
+        if name is None:
+            return data
+        return message_types[name]._from_dict(data)
+
+    @classmethod
+    def dumps_batch(cls, messages):
+        return cls.encode([
+            _Msg(message.__class__.__name__, message.as_dict)
+            for message in messages
+        ])
+
+    @classmethod
+    def loads_batch(cls, b_obj, message_types):
+        return [
+            message_types[name]._from_dict(data) for name, data in cls.decode(b_obj)
+        ]
+
+    @staticmethod
+    def encode(message_tupl):
+        raise NotImplementedError
+
+    @staticmethod
+    def decode(b_obj):
+        raise NotImplementedError
+
+
+class JsonBackend(Backend):
+    tag = 'json'
+
+    @staticmethod
+    def encode(message_tupl):
+        return _json_encode(message_tupl).encode('utf-8')
+
+    @classmethod
+    def encoder(cls, msgtype):
+        "Return a function encoding a message of class msgtype"
+        # The type name is the same for every message, only encode the fields
+        prefix = f'[{_json_encode(msgtype.__name__)}, '
+        def dumps(message):
+            return (prefix + _json_encode(message.as_dict) + ']').encode('utf-8')
+        return dumps
+
+    @staticmethod
+    def decode(b_obj):
+        return _json.loads(str(b_obj, 'utf-8'))
+
+
+class MsgpackBackend(Backend):
+    "Compact binary encoding; requires the optional msgpack package"
+    tag = 'msgpack'
+
+    @staticmethod
+    def encode(message_tupl):
+        import msgpack
+        return msgpack.packb(message_tupl, use_bin_type=True)
+
+    @staticmethod
+    def decode(b_obj):
+        import msgpack
+        return msgpack.unpackb(b_obj, raw=False)
+
+
+class PickleBackend(Backend):
+    "Encode arbitrary python values. Only use this with trusted peers!"
+    tag = 'pickle'
+
+    @staticmethod
+    def encode(message_tupl):
+        import pickle
+        return pickle.dumps(tuple(message_tupl), pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(b_obj):
+        import pickle
+        return pickle.loads(b_obj)
+
+
+class StructBackend(Backend):
+    """Fixed layout binary encoding built from a message's fields
+
+    Message classes opt in by declaring a struct format code for each of
+    their fields, e.g. _struct = {'a': 'i', 'b': 'd'}. Like _kwfields the
+    declarations are merged along the class hierarchy. The body is the
+    length-prefixed class name followed by the packed field values.
+    """
+    tag = 'struct'
+    compact = False
+    _cache = {}
+
+    @classmethod
+    def get_struct(cls, msgtype):
+        try:
+            return cls._cache[msgtype]
+        except KeyError:
+            pass
+        formats = {}
+        for klass in reversed(msgtype.__mro__):
+            formats.update(getattr(klass, '_struct', {}))
+        codes = []
+        for name in msgtype.__slots__:
+            try:
+                codes.append(formats[name])
+            except KeyError:
+                clsname = msgtype.__name__
+                txt = f"{clsname} has no struct format for field {name!r}"
+                raise ValueError(txt) from None
+        packer = _Struct('<' + ''.join(codes))
+        cls._cache[msgtype] = packer
+        return packer
+
+    @classmethod
+    def dumps(cls, message):
+        if not isinstance(message, _Structure):
+            raise TypeError(f"{cls.tag} backend can only encode messages")
+        return cls.encoder(message.__class__)(message)
+
+    @classmethod
+    def encoder(cls, msgtype):
+        "Return a function encoding a message of class msgtype"
+        pack = cls.get_struct(msgtype).pack
+        b_name = msgtype.__name__.encode('utf-8')
+        prefix = bytes((len(b_name),)) + b_name
+        def dumps(message):
+            return prefix + pack(*message._as_tuple())
+        return dumps
+
+    @classmethod
+    def loads(cls, b_obj, message_types):
+        return cls._load_from(b_obj, 0, message_types)[0]
+
+    @classmethod
+    def dumps_batch(cls, messages):
+        return b''.join([cls.dumps(message) for message in messages])
+
+    @classmethod
+    def loads_batch(cls, b_obj, message_types):
+        messages = []
+        offset, end = 0, len(b_obj)
+        while offset < end:
+            msg, offset = cls._load_from(b_obj, offset, message_types)
+            messages.append(msg)
+        return messages
+
+    @classmethod
+    def _load_from(cls, b_obj, offset, message_types):
+        "Return the message packed at offset and the offset following it"
+        start = offset + 1
+        stop = start + b_obj[offset]
+        msgtype = message_types[str(b_obj[start:stop], 'utf-8')]
+        packer = cls.get_struct(msgtype)
+        values = packer.unpack_from(b_obj, stop)
+        return msgtype._from_tuple(values), stop + packer.size
+
+
+_column = _Struct('<cB6xQ')  # typecode, item size, length in bytes
+_json_length = _Struct('<I')
+
+def _padding(offset):
+    "Return the number of bytes aligning offset to 8"
+    return -offset % 8
+
+def _column_buffer(value, typecode):
+    "Return the bytes of value, a column of typecode, as a buffer"
+    try:
+        view = memoryview(value)
+    except TypeError:
+        pass
+    else:
+        if view.format.lstrip('@') == typecode and view.ndim == 1 and view.c_contiguous:
+            return view.cast('B')
+    return memoryview(_array(typecode, value)).cast('B')
+
+
+class ColumnBackend(Backend):
+    """Encoding of message.ColumnMessage with its columns as raw buffers
+
+    A message is its length-prefixed class name, a JSON object of its other
+    fields, and then for each column its typecode, item size and length in
+    bytes followed by its data, padded so that every column starts at a
+    multiple of 8 bytes. Values are in native byte order, as both ends of
+    the socket are on the same machine.
+
+    Columns are decoded as memoryviews into the body (or numpy arrays of
+    them), so a body that is still in the receive buffer is copied once.
+    """
+    tag = 'columns'
+    compact = False
+    _asarray = None
+
+    @classmethod
+    def dumps(cls, message):
+        return cls.encoder(message.__class__)(message)
+
+    @classmethod
+    def encoder(cls, msgtype):
+        "Return a function encoding a message of class msgtype"
+        if not issubclass(msgtype, _ColumnMessage):
+            raise TypeError(f"{cls.tag} backend can only encode ColumnMessages")
+        b_name = msgtype.__name__.encode('utf-8')
+        prefix = bytes((len(b_name),)) + b_name
+        columns = [
+            (name, code, code.encode(), _array(code).itemsize)
+            for name, code in msgtype._column_types.items()
+        ]
+        fields = [x for x in msgtype.__slots__ if x not in msgtype._column_types]
+        pack_column = _column.pack
+        def dumps(message):
+            b_fields = _json_encode(
+                {x: getattr(message, x) for x in fields},
+            ).encode('utf-8')
+            parts = [prefix, _json_length.pack(len(b_fields)), b_fields]
+            offset = len(prefix) + _json_length.size + len(b_fields)
+            for name, code, b_code, itemsize in columns:
+                buf = _column_buffer(getattr(message, name), code)
+                nbytes = len(buf)
+                pad = _padding(offset)
+                parts.append(bytes(pad))
+                parts.append(pack_column(b_code, itemsize, nbytes))
+                parts.append(buf)
+                offset += pad + _column.size + nbytes
+            parts.append(bytes(_padding(offset)))
+            return b''.join(parts)
+        return dumps
+
+    @classmethod
+    def loads(cls, b_obj, message_types):
+        return cls._load_from(cls._stable(b_obj), 0, message_types)[0]
+
+    @classmethod
+    def dumps_batch(cls, messages):
+        return b''.join([cls.dumps(message) for message in messages])
+
+    @classmethod
+    def loads_batch(cls, b_obj, message_types):
+        view = cls._stable(b_obj)
+        messages = []
+        offset, end = 0, len(view)
+        while offset < end:
+            msg, offset = cls._load_from(view, offset, message_types)
+            messages.append(msg)
+        return messages
+
+    @staticmethod
+    def _stable(b_obj):
+        "Return a memoryview of b_obj, copied unless it is read-only"
+        view = memoryview(b_obj)
+        if not view.readonly:
+            # A writable body lives in a buffer that is reused
+            view = memoryview(bytes(view))
+        return view
+
+    @classmethod
+    def _load_from(cls, view, offset, message_types):
+        "Return the message at offset in view and the offset following it"
+        start = offset + 1
+        stop = start + view[offset]
+        msgtype = message_types[str(view[start:stop], 'utf-8')]
+        length, = _json_length.unpack_from(view, stop)
+        offset = stop + _json_length.size + length
+        d = _json.loads(str(view[offset - length:offset], 'utf-8'))
+        asarray = cls._array_maker()
+        for name, code in msgtype._column_types.items():
+            offset += _padding(offset)
+            b_code, itemsize, nbytes = _column.unpack_from(view, offset)
+            offset += _column.size
+            if b_code != code.encode() or itemsize != _array(code).itemsize:
+                txt = (f"{msgtype.__name__}.{name} is a column of {code!r} but"
+                       f" the frame holds {itemsize} byte {b_code.decode()!r}")
+                raise ValueError(txt)
+            column = view[offset:offset + nbytes].cast(code)
+            d[name] = column if asarray is None else asarray(column)
+            offset += nbytes
+        return msgtype._from_dict(d), offset + _padding(offset)
+
+    @classmethod
+    def _array_maker(cls):
+        "Return numpy.asarray, or None if numpy isn't installed"
+        asarray = cls._asarray
+        if asarray is None:
+            try:
+                from numpy import asarray
+            except ImportError:
+                asarray = False
+            cls._asarray = asarray
+        return asarray or None
+
+
 class Serialize:
+    """Turn messages into frames (header and body) and back
+
+    Bodies of at least shm_threshold bytes are passed through a shared
+    memory segment instead of the socket; None disables this. Bodies are
+    compressed according to compression (a compression.Compression), or
+    not at all if it is None.
+
+    Messages are encoded with their type's id in schema once compact is
+    true, which adopt() sets after a schema handshake. Compact frames are
+    always decoded with schema.
+
+    The encoder for a message class and formatter is made the first time
+    such a message is dumped and cached until the schema changes.
+
+    Only frames encoded with one of formatters (by default
+    DEFAULT_FORMATTERS) are decoded; load() raises ValueError for any
+    other, before its body is looked at, unless its accept function
+    returns true for the frame's header.
+    """
     header_length = HeaderFormat.length
-    def __init__(self, **message_types):
+    def __init__(self, *, shm_threshold=None, compression=None, formatters=None,
+                 **message_types):
+        self.shm_threshold = shm_threshold
+        self.compression = compression
+        if formatters is None:
+            formatters = DEFAULT_FORMATTERS
+        self.formatters = set(formatters)
         self.message_types = message_types
+        self.type_ids = {}  # type_id in frame headers -> message class
+        for msgtype in message_types.values():
+            self._add_type_id(msgtype)
+        self.schema = _Schema(message_types)
+        self.compact = False
+        self._encoders = {}  # (class, formatter) -> (backend, encode, flags, type_id)
+        if compression is None:
+            compression = _compression.Compression()
+        self._decompress = compression.decompress
 
-    def dump_iter(self, message, formatter='json'):
-        dumper_name = f'_dump_{formatter}'
+    @staticmethod
+    def get_backend(formatter):
         try:
-            dumper = getattr(self, dumper_name)
-        except AttributeError as e:
-            txt = f"data dumper {dumper_name!r} doesn't exist!"
+            return backends[formatter]
+        except KeyError as e:
+            txt = f"serializer backend {formatter!r} doesn't exist!"
             raise NotImplementedError(txt) from e
 
-        mtupl = _Msg(message.__class__.__name__, message.as_dict)
-        objstr = dumper(mtupl)
-        yield HeaderFormat.pack(b'json', len(objstr))
-        yield objstr
+    def add_type(self, msgtype):
+        "Make msgtype known to this Serialize (and give it a schema id)"
+        self.message_types.setdefault(msgtype.__name__, msgtype)
+        self._add_type_id(msgtype)
+        self.schema.add(msgtype)
+        self._encoders.clear()
 
-    @staticmethod
-    def _dump_json(message_tupl):
-        objstr = _json.dumps(message_tupl, ensure_ascii=True)
-        return objstr.encode('ascii')
+    def _add_type_id(self, msgtype):
+        tid = _type_id(msgtype.__name__)
+        known = self.type_ids.setdefault(tid, msgtype)
+        if known is not msgtype and known is not None:
+            # Frames of colliding types are told apart by decoding them
+            self.type_ids[tid] = None
 
-    def load(self, b_header):
-        header = HeaderFormat.unpack(b_header)
-        tag = header.tag.decode()
+    def adopt(self, table):
+        "Encode compactly with the peer's schema, given its Schema.table()"
+        self.schema = _Schema.from_table(table, self.message_types)
+        self.compact = True
+        self._encoders.clear()
 
-        d_header = header._asdict()
-        loader_name = f'_load_{tag}'
+    def dump_iter(self, message, formatter='json', kind=MESSAGE, msg_id=0):
+        msgtype = message.__class__
         try:
-            data_loader = getattr(self, loader_name)
-        except AttributeError as e:
-            txt = f"data_loader {loader_name!r} doesn't exist!"
-            raise NotImplementedError(txt) from e
+            backend, encode, flags, type_id = self._encoders[msgtype, formatter]
+        except KeyError:
+            backend, encode, flags, type_id = self._encoder(msgtype, formatter)
+        objstr = encode(message)
+        yield from self._frame(
+            backend, objstr, kind, msg_id, msgtype.__name__, flags, type_id,
+        )
+
+    def _encoder(self, msgtype, formatter):
+        "Make and cache what dump_iter needs to encode msgtype with formatter"
+        backend = self.get_backend(formatter)
+        flags = type_id = 0
+        if not issubclass(msgtype, _Structure):
+            encode = backend.dumps
+        else:
+            type_id = _type_id(msgtype.__name__)
+            if self.compact and backend.compact and msgtype in self.schema.ids:
+                encode_values = backend.encode
+                schema_id = self.schema.ids[msgtype]
+                def encode(message):
+                    return encode_values((schema_id,) + message._as_tuple())
+                flags = FLAG_COMPACT
+            else:
+                encode = backend.encoder(msgtype)
+        entry = self._encoders[msgtype, formatter] = (backend, encode, flags, type_id)
+        return entry
 
-        def load_msg(b_obj, *args, **kwargs):
-            'Unpack b_obj and return a corresponding message object'
-            mtupl = _Msg._make(data_loader(b_obj, *args, **kwargs))
-            return self.message_types[mtupl.name](**mtupl.data)
+    def dump_batch_iter(self, messages, formatter='json'):
+        "Like dump_iter but put all of messages into a single BATCH frame"
+        backend = self.get_backend(formatter)
+        ids = self.schema.ids
+        flags = 0
+        if self.compact and backend.compact and all(m.__class__ in ids for m in messages):
+            pack = self.schema.pack
+            objstr = backend.encode([pack(message) for message in messages])
+            flags = FLAG_COMPACT
+        else:
+            objstr = backend.dumps_batch(messages)
+        msg_type = None
+        type_id = 0
+        if messages:
+            first = messages[0].__class__
+            msg_type = first.__name__
+            if all(m.__class__ is first for m in messages):
+                type_id = _type_id(msg_type)
+        yield from self._frame(backend, objstr, BATCH, 0, msg_type, flags, type_id)
+
+    def dump_chunk_iter(self, stream_id, chunk):
+        "Frame chunk (bytes) as part of the body of stream stream_id"
+        flags = 0
+        compression = self.compression
+        if compression is not None:
+            chunk, flags = compression.compress(chunk)
+        yield HeaderFormat.pack(b'', len(chunk), CHUNK, stream_id, flags)
+        yield chunk
+
+    def train_compression(self, messages, formatter='json', size=1 << 15):
+        "Train a compression dictionary for each message type in messages"
+        if self.compression is None:
+            raise ValueError("Serialize was created without compression")
+        backend = self.get_backend(formatter)
+        samples = {}
+        for message in messages:
+            name = message.__class__.__name__
+            samples.setdefault(name, []).append(backend.dumps(message))
+        for name, bodies in samples.items():
+            self.compression.train(name, bodies, size)
+
+    def _frame(self, backend, objstr, kind, msg_id=0, msg_type=None, flags=0,
+               type_id=0):
+        compression = self.compression
+        if compression is not None:
+            objstr, codec_flags = compression.compress(objstr, msg_type)
+            flags |= codec_flags
+        threshold = self.shm_threshold
+        if threshold is not None and len(objstr) >= threshold:
+            objstr = _shm.write_segment(objstr)
+            flags |= FLAG_SHM
+        yield HeaderFormat.pack(
+            backend.tag.encode(), len(objstr), kind, msg_id, flags, type_id,
+        )
+        yield objstr
 
+    def load(self, b_header, offset=0, accept=None):
+        header = HeaderFormat.unpack(b_header, offset)
+        if header.kind == CHUNK:
+            load_msg = bytes
+        else:
+            load_msg = self._loader(header, accept)
+
+        if header.flags & CODEC_MASK:
+            load_plain = load_msg
+            decompress = self._decompress
+            flags = header.flags
+            def load_msg(b_obj):
+                'Decompress b_obj and unpack the result'
+                return load_plain(decompress(b_obj, flags))
+
+        if header.flags & FLAG_SHM:
+            load_body = load_msg
+            def load_msg(b_obj):
+                'Map the shared memory segment b_obj and unpack its contents'
+                with _shm.open_segment(b_obj) as view:
+                    return load_body(view)
+
+        d_header = header._asdict()
         d_header['data_loader'] = load_msg
         return _HeaderInfo(**d_header)
 
-    @staticmethod
-    def _load_json(b_obj, *args, **kwargs):
-        return _json.loads(b_obj.decode('ascii'), *args, **kwargs)
+    def _loader(self, header, accept=None):
+        tag = header.tag.decode()
+        backend = self.get_backend(tag)
+        if tag not in self.formatters and (accept is None or not accept(header)):
+            raise ValueError(f"Refusing a frame encoded with {tag!r}")
+        message_types = self.message_types
+
+        if header.flags & FLAG_COMPACT:
+            decode = backend.decode
+            unpack = self.schema.unpack
+            if header.kind == BATCH:
+                def load_msg(b_obj):
+                    'Unpack b_obj and return a list of compact message objects'
+                    return [unpack(values) for values in decode(b_obj)]
+            else:
+                def load_msg(b_obj):
+                    'Unpack b_obj and return the compact message object'
+                    return unpack(decode(b_obj))
+        elif header.kind == BATCH:
+            def load_msg(b_obj):
+                'Unpack b_obj and return a list of message objects'
+                return backend.loads_batch(b_obj, message_types)
+        else:
+            def load_msg(b_obj):
+                'Unpack b_obj and return a corresponding message object'
+                return backend.loads(b_obj, message_types)
+        return load_msg
@@ -2,78 +2,903 @@
 # https://github.com/joidegn/leo-cli
 # https://pymotw.com/2/socket/uds.html
 import asyncio
+import json as _json
+from functools import partial as _partial
 from os import path as _path
+from time import perf_counter as _perf_counter
 
 from . import _utils
-from .serializer import Serialize
-from collections import namedtuple
+from . import shm as _shm
+from .framing import FrameProtocol
+from .metrics import GetMetrics, Metrics
+from .queues import MessageQueue, message_key, type_key
+from .schema import Hello, SchemaError
+from .serializer import (BATCH, CHUNK, ERROR, FLAG_COMPACT, FLAG_SHM, REPLY,
+                         REQUEST, STREAM, HeaderFormat, LazyMessage, Serialize)
+from .spool import Spool
+from .streams import Stream
+
+
+def new_event_loop():
+    """Return a new event loop of the fastest kind available
+
+    That is a uvloop loop if uvloop is installed, and one running new tasks
+    eagerly (until their first await) if asyncio supports it.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    else:
+        loop = uvloop.new_event_loop()
+    eager_task_factory = getattr(asyncio, 'eager_task_factory', None)
+    if eager_task_factory is not None:
+        loop.set_task_factory(eager_task_factory)
+    return loop
+
+
+def _as_coroutine(fn, executor=None):
+    """Return fn as a coroutine function, wrapping it if it is synchronous
+
+    If executor is given the synchronous fn is run in it, so that it
+    doesn't block the event loop.
+    """
+    iscoro = asyncio.iscoroutinefunction
+    if iscoro(fn) or iscoro(getattr(fn, '__call__', None)):
+        return fn
+    if executor is not None:
+        async def wrapper(*args):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(executor, fn, *args)
+    else:
+        async def wrapper(*args, **kwargs):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class Observer:
+    """An observer function together with how it is to be called
+
+    With concurrency=None every message is handled by its own task. Otherwise
+    messages wait in the observer's inbox and are handled by a fixed number
+    of worker tasks, so at most concurrency calls are running at once;
+    ordered=True is the same as concurrency=1 and calls the observer
+    sequentially in the order the messages arrived. The inbox holds up to
+    maxsize messages (concurrency by default); when it is full, overflow
+    decides what happens to a new message:
+
+    - 'block': the server holds the message back, and takes no further
+      messages off its queue, until the inbox has room. Only messages for
+      this observer wait like this, so that they stay bounded by the
+      server's maxsize and overload policy
+    - 'drop-newest': discard the new message
+    - 'drop-oldest': discard the oldest message in the inbox
+
+    A request whose message is discarded gets an error reply.
+
+    With inline=True a synchronous fn (without an executor) is called right
+    away instead of in a task, which saves creating and scheduling a task
+    for every message; callback and the reply still get a done future.
+
+    With lazy=True fn may be called with a serializer.LazyMessage, which
+    is only decoded once fn reads one of its fields.
+
+    The reply and done arguments of submit() are done callbacks, called
+    with a future of fn's outcome once it has handled the message.
+    """
+    overflows = ('block', 'drop-newest', 'drop-oldest')
+
+    def __init__(self, fn, callback=None, batch=False, concurrency=None,
+                 ordered=False, executor=None, inline=False, lazy=False,
+                 maxsize=None, overflow='block'):
+        if ordered:
+            concurrency = 1
+        if concurrency is not None and concurrency < 1:
+            raise ValueError(f"concurrency must be at least 1, not {concurrency}")
+        if overflow not in self.overflows:
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+        if maxsize is not None and maxsize < 1:
+            raise ValueError(f"maxsize must be at least 1, not {maxsize}")
+        self.fn = fn
+        self.func = _as_coroutine(fn, executor)
+        self.inline = inline and executor is None and self.func is not fn
+        self.lazy = lazy
+        self.callback = callback
+        self.batch = batch
+        self.concurrency = concurrency
+        self.maxsize = maxsize or concurrency
+        self.overflow = overflow
+        # Whether the server waits for room in the inbox
+        self.blocking = concurrency is not None and overflow == 'block'
+        self.dropped = 0
+        self.logr = _utils.get_logger()
+        self.inbox = None
+        self.workers = []
+        self.stats = None  # metrics.ObserverStats, if the server has metrics
+        self._room = None  # Future set once a full inbox has room again
+
+    def submit(self, arg, reply=None, done=None):
+        "Call the observer with arg (a message, or a list if batch is true)"
+        if self.inline:
+            self._call(arg, reply, done)
+            return
+        if self.concurrency is None:
+            if self.stats is None:
+                coro = self.func(arg)
+            else:
+                coro = self._timed(self.func, arg)
+            task = asyncio.get_event_loop().create_task(coro)
+            if self.callback is not None:
+                task.add_done_callback(self.callback)
+            if reply is not None:
+                task.add_done_callback(reply)
+            if done is not None:
+                task.add_done_callback(done)
+            return
+        inbox = self.inbox
+        if inbox is None:
+            inbox = self.inbox = asyncio.Queue()
+            create_task = asyncio.get_event_loop().create_task
+            self.workers = [
+                create_task(self._work()) for _ in range(self.concurrency)
+            ]
+        elif not self.blocking and inbox.qsize() >= self.maxsize:
+            if self.overflow == 'drop-newest':
+                self._drop(arg, reply, done)
+                return
+            self._drop(*inbox.get_nowait())
+        inbox.put_nowait((arg, reply, done))
+
+    def _drop(self, arg, reply, done):
+        "Discard a message that doesn't fit in the inbox"
+        self.dropped += 1
+        self.logr.debug('Inbox of observer %r is full, dropped a message', self.fn)
+        if reply is not None:
+            reply.error('Observer is overloaded')
+        if done is not None:
+            done()
+
+    def full(self):
+        "Whether the inbox holds maxsize messages or more"
+        inbox = self.inbox
+        return inbox is not None and inbox.qsize() >= self.maxsize
+
+    async def wait_for_room(self):
+        "Wait until the inbox isn't full()"
+        while self.full():
+            if self._room is None or self._room.done():
+                self._room = asyncio.get_event_loop().create_future()
+            await self._room
+
+    def _call(self, arg, reply, done=None):
+        "Call the synchronous fn with arg, see inline"
+        callback = self.callback
+        stats = self.stats
+        if stats is not None:
+            started = _perf_counter()
+        try:
+            result = self.fn(arg)
+        except Exception as e:
+            if stats is not None:
+                stats.record(_perf_counter() - started, True)
+            if callback is None and reply is None:
+                self.logr.exception('Observer %r failed', self.fn)
+                if done is not None:
+                    done()
+                return
+            future = asyncio.get_event_loop().create_future()
+            future.set_exception(e)
+        else:
+            if stats is not None:
+                stats.record(_perf_counter() - started)
+            if callback is None and reply is None:
+                if done is not None:
+                    done()
+                return
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(result)
+        if callback is not None:
+            future.add_done_callback(callback)
+        if reply is not None:
+            future.add_done_callback(reply)
+        if done is not None:
+            future.add_done_callback(done)
+
+    def close(self):
+        "Stop the worker tasks; messages waiting in the inbox are dropped"
+        workers, self.workers = self.workers, []
+        for task in workers:
+            task.cancel()
+        self.inbox = None
+        if self._room is not None and not self._room.done():
+            self._room.set_result(None)
+
+    async def _timed(self, func, arg):
+        "Await func(arg), recording its latency and failure in stats"
+        started = _perf_counter()
+        try:
+            result = await func(arg)
+        except Exception:
+            self.stats.record(_perf_counter() - started, True)
+            raise
+        self.stats.record(_perf_counter() - started)
+        return result
+
+    async def _work(self):
+        inbox = self.inbox
+        func = self.func
+        callback = self.callback
+        if self.stats is not None:
+            func = _partial(self._timed, func)
+        create_future = asyncio.get_event_loop().create_future
+        while True:
+            arg, reply, done = await inbox.get()
+            room = self._room
+            if room is not None and not room.done():
+                room.set_result(None)
+            if callback is None and reply is None:
+                try:
+                    await func(arg)
+                except Exception:
+                    self.logr.exception('Observer %r failed', func)
+                if done is not None:
+                    done()
+                continue
+            future = create_future()
+            if callback is not None:
+                future.add_done_callback(callback)
+            if reply is not None:
+                future.add_done_callback(reply)
+            if done is not None:
+                future.add_done_callback(done)
+            try:
+                result = await func(arg)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class _Ack:
+    """Done callback calling on_done once every observer handled a message
+
+    Each submission of the message counts with expect(); the one made
+    when creating the _Ack is for dispatching it, and is released by
+    calling the _Ack once dispatch is over.
+    """
+    __slots__ = ('pending', 'on_done')
+
+    def __init__(self, on_done):
+        self.pending = 1
+        self.on_done = on_done
+
+    def expect(self):
+        self.pending += 1
+        return self
+
+    def __call__(self, future=None):
+        self.pending -= 1
+        if not self.pending:
+            self.on_done()
 
 
-Observer = namedtuple('Observer', 'func callback')
 class Server:
-    def __init__(self, socket_name, message_types):
+    """Receive messages on a unix socket and dispatch them to observers
+
+    Received messages wait in the bounded queue Server.messages (of size
+    maxsize) before being dispatched. When it is full, overload decides
+    what happens to a new message:
+
+    - 'block': stop reading from that client until there is room
+    - 'drop-newest': discard the new message
+    - 'drop-oldest': discard the oldest message of the lowest priority
+    - 'reject': discard the new message and send the client an ERROR frame
+    - 'coalesce': replace a queued message having the same coalesce_key
+      (by default the message type), otherwise block
+
+    Dropped or rejected requests are answered with an ERROR frame.
+    Messages whose type declares a coalesce key replace queued messages of
+    the same key, and may be debounced first (see BaseMessage).
+    priorities maps message types to priority lanes (see MessageQueue).
+    Replies of shm_threshold bytes or more are sent through shared memory,
+    and compressed according to compression (see asyncipc.compression).
+    Only frames encoded with one of formatters are accepted (by default
+    serializer.DEFAULT_FORMATTERS, which leaves out 'pickle'); a client
+    sending any other is disconnected.
+
+    With metrics=True the server keeps a metrics.Metrics in Server.metrics
+    and answers GetMetrics requests with a snapshot of it. If metrics_socket
+    is also given, every connection to that socket is sent a JSON snapshot
+    and closed.
+
+    Clients created with compact=True send a Hello request when they
+    connect; it is answered with the server's schema (see asyncipc.schema)
+    and never reaches an observer.
+
+    With inline=True synchronous observers are called as soon as their
+    message is taken off the queue rather than each in a new task (see
+    Observer). Together with a loop from new_event_loop() this is the
+    fastest way to run a server whose observers don't block.
+
+    With spool, a directory or a spool.Spool, every received message is
+    written to that log before it is queued and marked done once all of
+    its observers have handled it. Messages left in the log by a server
+    that died are queued again when the next one starts, before it
+    accepts connections. Streams aren't spooled. A spool belongs to one
+    process, so a spooling server can't be run by a Supervisor.
+
+    Frames name the type of their messages in their header, so a frame's
+    handling is decided before its body is decoded (see frame_handling):
+    one-way frames whose type has no observers are dropped undecoded, and
+    messages whose observers were all registered with lazy=True are
+    handed to them as LazyMessages.
+
+    A client sending a frame body larger than max_frame_size bytes is
+    disconnected (see FrameReader).
+    """
+    overload_policies = ('block', 'drop-newest', 'drop-oldest', 'reject', 'coalesce')
+
+    def __init__(self, socket_name, message_types, maxsize=30, overload='block',
+                 priorities=None, coalesce_key=None, shm_threshold=None,
+                 metrics=False, metrics_socket=None, compression=None,
+                 inline=False, spool=None, formatters=None, max_frame_size=None):
+        if overload not in self.overload_policies:
+            raise ValueError(f"Unknown overload policy {overload!r}")
         self.socket_path = _path.join(_utils.RUNTIME_DIR, socket_name)
         self.logr = _utils.get_logger()
-        self.serial = Serialize(**message_types)
-        self.messages = asyncio.Queue(30)
-        d_observer = {}
-        for key in message_types:
-            d_observer[key] = []
-        self.observers = d_observer
-
-    def register(self, msgtype, fn, callback=None):
-        d = self.observers
-        fn2 = asyncio.coroutine(fn)
-        obs = Observer(fn2, callback)
-        if isinstance(msgtype, str):
-            d[msgtype].append(obs)
+        self.serial = Serialize(
+            shm_threshold=shm_threshold, compression=compression,
+            formatters=formatters, **message_types,
+        )
+        self.serial.add_type(Hello)
+        self.overload = overload
+        self.inline = inline
+        if max_frame_size is None:
+            max_frame_size = FrameProtocol.max_frame_size
+        self.max_frame_size = max_frame_size
+        if overload == 'coalesce' and coalesce_key is None:
+            coalesce_key = type_key
+        priorities = {
+            getattr(key, '__name__', key): level
+            for key, level in (priorities or {}).items()
+        }
+        self.messages = MessageQueue(maxsize, priorities, coalesce_key)
+        self.observers = {}  # message class -> list of Observers
+        self._dispatch = {}  # message class -> observers of it and its bases
+        self._handling = {}  # message class -> its frame_handling()
+        self._held = {}  # coalesce key -> (item, protocol) being debounced
+        if isinstance(spool, str):
+            spool = Spool(spool)
+        self.spool = spool
+        self._records = {}  # id of a spooled message -> its record in spool
+        self._spool_timer = None
+        if spool is not None:
+            self._spool_serial = Serialize(compression=compression, **message_types)
+        self.listener = None
+        self.connections = set()
+        self.metrics = None
+        self.metrics_path = None
+        self.metrics_listener = None
+        if metrics:
+            self.metrics = self.messages.metrics = Metrics()
+            self.register(GetMetrics, self._get_metrics)
+            if metrics_socket is not None:
+                self.metrics_path = _path.join(_utils.RUNTIME_DIR, metrics_socket)
+
+    def register(self, msgtype, fn, callback=None, batch=False,
+                 concurrency=None, ordered=False, executor=None, lazy=False,
+                 maxsize=None, overflow='block'):
+        """Call fn with every message of type msgtype or of a subclass of it
+
+        msgtype is a message class or the name of one of the server's
+        message types; a class the server didn't know about is added to
+        them. If batch is true fn is called with a list of messages instead:
+        all messages of one type from a BATCH frame, or a single message.
+        concurrency and ordered limit how many calls of fn may run at once,
+        maxsize and overflow how many messages may wait for them and what
+        happens to the others (see Observer). A blocking fn can be run in a concurrent.futures
+        executor, e.g. a ThreadPoolExecutor, by passing it as executor.
+        With lazy=True fn may be called with messages that are decoded only
+        when it reads their fields (see Observer).
+        """
+        msgtype = self._message_class(msgtype)
+        self.serial.add_type(msgtype)
+        obs = Observer(
+            fn, callback, batch, concurrency, ordered, executor, self.inline, lazy,
+            maxsize, overflow,
+        )
+        self.observers.setdefault(msgtype, []).append(obs)
+        self._dispatch.clear()
+        self._handling.clear()
+        if self.metrics is not None:
+            name = getattr(fn, '__qualname__', fn.__class__.__qualname__)
+            obs.stats = self.metrics.observer_stats(f'{msgtype.__name__}/{name}')
+        return obs
+
+    def unregister(self, msgtype, fn):
+        """Stop calling fn (or the Observer returned by register) for msgtype
+
+        Raise ValueError if fn isn't registered for msgtype.
+        """
+        msgtype = self._message_class(msgtype)
+        observers = self.observers.get(msgtype, [])
+        for idx, obs in enumerate(observers):
+            if obs is fn or obs.fn is fn:
+                break
+        else:
+            raise ValueError(f"{fn!r} isn't registered for {msgtype.__name__}")
+        del observers[idx]
+        if not observers:
+            del self.observers[msgtype]
+        self._dispatch.clear()
+        self._handling.clear()
+        obs.close()
+
+    def _message_class(self, msgtype):
+        if not isinstance(msgtype, str):
+            return msgtype
+        try:
+            return self.serial.message_types[msgtype]
+        except KeyError:
+            raise ValueError(f"Unknown message type {msgtype!r}") from None
+
+    def observers_for(self, msgtype):
+        """Return the observers of message class msgtype and of its bases
+
+        Observers of msgtype come first, then those of its base classes in
+        MRO order. The result is cached until observers are (un)registered.
+        """
+        try:
+            return self._dispatch[msgtype]
+        except KeyError:
+            pass
+        observers = self.observers
+        found = []
+        for klass in msgtype.__mro__:
+            found.extend(observers.get(klass, ()))
+        found = self._dispatch[msgtype] = tuple(found)
+        return found
+
+    def frame_handling(self, msgtype):
+        """Return what to do with a frame of msgtype messages before decoding it
+
+        'drop' if nobody is interested in them, 'lazy' if all of their
+        observers are lazy, otherwise 'decode'. Requests are never dropped
+        and only single messages are decoded lazily. The result is cached
+        until observers are (un)registered.
+        """
+        try:
+            return self._handling[msgtype]
+        except KeyError:
+            pass
+        observers = self.observers_for(msgtype)
+        if not observers:
+            handling = 'decode' if msgtype is Hello else 'drop'
+        elif all(obs.lazy for obs in observers):
+            handling = 'lazy'
         else:
-            d[msgtype.__name__].append(obs)
+            handling = 'decode'
+        self._handling[msgtype] = handling
+        return handling
+
+    def metrics_snapshot(self):
+        "Return the server's metrics as a dict of plain values"
+        return self.metrics.snapshot(self.messages.qsize())
+
+    def _get_metrics(self, msg):
+        return self.metrics_snapshot()
+
+    def _hello(self, msg, reply):
+        "Answer a schema handshake with the server's schema table"
+        if reply is None:
+            return
+        schema = self.serial.schema
+        try:
+            schema.check(msg.fingerprints)
+        except SchemaError as e:
+            reply.error(f'SchemaError: {e}')
+        else:
+            reply.send(schema.table())
+
+    def __call__(self, loop, sock=None):
+        """Start listening and dispatching messages on loop
 
-    def __call__(self, loop):
-        coro = asyncio.start_unix_server(self.listener, path=self.socket_path)
-        loop.run_until_complete(coro)
+        If sock is given it must be an already bound and listening unix
+        socket, which is used instead of binding socket_path.
+        """
         loop.create_task(self.queue_reader())
+        if self.spool is not None:
+            # Messages from before are queued before any new one arrives
+            loop.run_until_complete(self._replay())
+            self._sync_spool(loop)
+        if sock is None:
+            coro = loop.create_unix_server(self._protocol, path=self.socket_path)
+        else:
+            coro = loop.create_unix_server(self._protocol, sock=sock)
+        self.listener = loop.run_until_complete(coro)
+        if self.metrics_path is not None:
+            coro = loop.create_unix_server(
+                lambda: _MetricsProtocol(self),
+                path=self.metrics_path,
+            )
+            self.metrics_listener = loop.run_until_complete(coro)
+
+    def _protocol(self):
+        return ServerProtocol(self)
+
+    async def shutdown(self, grace=5.0):
+        """Stop accepting connections and wait for the current ones to end
+
+        Clients get up to grace seconds to close their connections and the
+        observers to empty the message queue. Remaining connections are then
+        closed.
+        """
+        if self.listener is not None:
+            self.listener.close()
+        if self.metrics_listener is not None:
+            self.metrics_listener.close()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + grace
+        while (self.connections or self._held or not self.messages.empty()) \
+              and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for protocol in list(self.connections):
+            protocol.transport.close()
+        if self.spool is not None:
+            self._spool_timer.cancel()
+            self.spool.sync()
+
+    def spool_frame(self, msg, header, body):
+        "Write the frame msg was received in (header and body) to spool"
+        if header.flags & (FLAG_SHM | FLAG_COMPACT):
+            # Neither a shared memory segment nor schema ids outlive us
+            tag = header.tag.decode()
+            if header.kind == BATCH:
+                frame = self._spool_serial.dump_batch_iter(msg, tag)
+            else:
+                frame = self._spool_serial.dump_iter(msg, tag)
+            data = b''.join(frame)
+        else:
+            data = HeaderFormat.pack(
+                header.tag, header.data_length, header.kind, 0, header.flags,
+                header.type_id,
+            ) + body
+        self._records[id(msg)] = self.spool.append(data)
+
+    def _done(self, msg):
+        "Mark the spool record of msg as done, if it has one"
+        if self.spool is not None:
+            seq = self._records.pop(id(msg), None)
+            if seq is not None:
+                self.spool.done(seq)
+
+    async def _replay(self):
+        "Queue the messages a previous server left in the spool"
+        serial = self.serial
+        spool = self.spool
+        count = 0
+        for seq, frame in list(spool.pending()):
+            try:
+                header = serial.load(frame)
+                msg = header.data_loader(memoryview(frame)[serial.header_length:])
+            except Exception:
+                self.logr.exception('Dropping a spooled frame that failed to load')
+                spool.done(seq)
+                continue
+            self._records[id(msg)] = seq
+            await self.messages.put((msg, None))
+            count += 1
+        if count:
+            self.logr.info('Queued %d messages left in the spool', count)
+
+    def _sync_spool(self, loop):
+        self.spool.sync()
+        self._spool_timer = loop.call_later(
+            self.spool.sync_interval, self._sync_spool, loop,
+        )
+
+    def offer(self, item, protocol):
+        """Queue item, applying the overload policy if the queue is full
+
+        Return False if item couldn't be queued and the caller should wait
+        for room with messages.put().
+        """
+        msg, reply = item
+        cls = msg.__class__
+        if cls is Hello:
+            self._done(msg)
+            self._hello(msg, reply)
+            return True
+        if reply is None and getattr(cls, '_debounce', None) is not None:
+            key = message_key(msg)
+            if key is not None:
+                self._hold(key, item, protocol)
+                return True
+        return self._enqueue(item, protocol)
+
+    def _enqueue(self, item, protocol):
+        messages = self.messages
+        old = messages.coalesce(item)
+        if old is not None:
+            self._done(old[0])
+            if self.metrics is not None:
+                self.metrics.coalesced += 1
+            return True
+        if not messages.full():
+            messages.put_nowait(item)
+            return True
+        policy = self.overload
+        if policy == 'block':
+            return False
+        elif policy == 'coalesce':
+            dropped = messages.replace(item)
+            if dropped is None:
+                return False
+        elif policy == 'drop-oldest':
+            dropped = messages.drop_oldest()
+            messages.put_nowait(item)
+        else:
+            dropped = item
+        msg, reply = dropped
+        self._done(msg)
+        if reply is not None:
+            reply.error('Server is overloaded')
+        elif policy == 'reject':
+            protocol.send_error('Server is overloaded')
+        self.logr.debug('Server is overloaded, dropped a message')
+        return True
+
+    def _hold(self, key, item, protocol):
+        "Queue item, whose coalesce key is key, after _debounce seconds unless replaced"
+        held = self._held
+        if key in held:
+            self._done(held[key][0][0])
+            if self.metrics is not None:
+                self.metrics.coalesced += 1
+        else:
+            loop = asyncio.get_event_loop()
+            loop.call_later(item[0]._debounce, self._release, key)
+        held[key] = (item, protocol)
+
+    def _release(self, key):
+        item, protocol = self._held.pop(key)
+        if not self._enqueue(item, protocol):
+            asyncio.get_event_loop().create_task(self.messages.put(item))
 
     async def queue_reader(self):
         messages = self.messages
-        logr = self.logr
-        d_observers = self.observers
-        create_task = asyncio.get_event_loop().create_task
+        dispatch = self.dispatch
+        observers_for = self.observers_for
+        records = self._records
         while True:
-            msg = await messages.get()
-            msg_type = msg.__class__.__name__
-            observers = d_observers[msg_type]
-            if observers:
-                for obs in observers:
-                    fn, callback = obs
-                    task = create_task(fn(msg))
-                    if callback is not None:
-                        task.add_done_callback(callback)
+            msg, reply = await messages.get()
+            done = None
+            if records and id(msg) in records:
+                # The spool record is done once every observer is
+                done = _Ack(_partial(self._done, msg))
+            if msg.__class__ is list:
+                by_type = {}
+                for item in msg:
+                    by_type.setdefault(item.__class__, []).append(item)
+                for msgtype, msgs in by_type.items():
+                    for obs in observers_for(msgtype):
+                        if obs.blocking and obs.full():
+                            await obs.wait_for_room()
+                    dispatch(msgtype, msgs, None, done)
+            else:
+                for obs in observers_for(msg.__class__):
+                    if obs.blocking and obs.full():
+                        await obs.wait_for_room()
+                dispatch(msg.__class__, [msg], reply, done)
+            if done is not None:
+                done()
+
+    def dispatch(self, msgtype, msgs, reply=None, done=None):
+        """Hand msgs, which are all of class msgtype, to their observers
+
+        done, an _Ack, is told of every submission.
+        """
+        try:
+            observers = self._dispatch[msgtype]
+        except KeyError:
+            observers = self.observers_for(msgtype)
+        if not observers:
+            name = msgtype.__name__
+            self.logr.debug('%s has no observers', name)
+            if reply is not None:
+                reply.error(f'{name} has no observers')
+            return
+        for obs in observers:
+            # The first observer's result answers the request
+            if obs.batch:
+                obs.submit(msgs, reply, done and done.expect())
+            else:
+                for msg in msgs:
+                    obs.submit(msg, reply, done and done.expect())
+            reply = None
+
+    def dispatch_stream(self, stream):
+        """Hand stream to the first observer of its message's type
+
+        Streams skip Server.messages: their chunks are flow controlled on
+        their own, by the Stream.
+        """
+        msgtype = stream.message.__class__
+        observers = self.observers_for(msgtype)
+        if not observers:
+            self.logr.debug('%s has no observers, discarding stream', msgtype.__name__)
+            stream.close()
+            return
+        observers[0].submit(stream, stream.close)
+
+
+class _Reply:
+    "Done callback sending an observer's outcome back to the requester"
+    __slots__ = ('protocol', 'msg_id', 'formatter')
+
+    def __init__(self, protocol, msg_id, formatter):
+        self.protocol = protocol
+        self.msg_id = msg_id
+        self.formatter = formatter
+
+    def __call__(self, future):
+        if future.cancelled():
+            self.error('Request was cancelled')
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.error(f'{exc.__class__.__name__}: {exc}')
+            return
+        self.send(future.result())
+
+    def send(self, value):
+        "Answer the request with value"
+        try:
+            frame = self.protocol.serial.dump_iter(
+                value, self.formatter, REPLY, self.msg_id,
+            )
+            frame = list(frame)
+        except Exception as e:
+            self.error(f'Unable to encode reply: {e}')
+            return
+        self.protocol.write_frame(frame)
+
+    def error(self, text):
+        self.protocol.send_error(text, self.msg_id)
+
+
+class _MetricsProtocol(asyncio.Protocol):
+    "Write a JSON snapshot of the server's metrics and hang up"
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        snapshot = self.server.metrics_snapshot()
+        transport.write(_json.dumps(snapshot).encode('utf-8'))
+        transport.close()
+
+
+class ServerProtocol(FrameProtocol):
+    "Decode frames from one client connection and queue them for dispatch"
+    def __init__(self, server):
+        super().__init__(server.serial)
+        self.server = server
+        self.max_frame_size = server.max_frame_size
+        self.metrics = server.metrics
+        self.streams = {}
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.server.connections.add(self)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.connections_open += 1
+            metrics.connections_total += 1
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.server.connections.discard(self)
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.set_exception(ConnectionError('Stream sender disconnected'))
+        if self.metrics is not None:
+            self.metrics.connections_open -= 1
+
+    def buffer_updated(self, nbytes):
+        if self.metrics is not None:
+            self.metrics.bytes_in += nbytes
+        super().buffer_updated(nbytes)
+
+    def frame_received(self, header, body):
+        kind = header.kind
+        if kind == CHUNK or kind == STREAM:
+            self.stream_frame_received(header, body)
+            return
+        metrics = self.metrics
+        reply = None
+        if kind == REQUEST:
+            reply = _Reply(self, header.msg_id, header.tag.decode())
+        msg = None
+        msgtype = self.serial.type_ids.get(header.type_id)
+        if msgtype is not None:
+            handling = self.server.frame_handling(msgtype)
+            if handling == 'drop' and reply is None:
+                self.logr.debug('Dropping %s undecoded, it has no observers',
+                                msgtype.__name__)
+                if metrics is not None:
+                    metrics.unobserved += 1
+                if header.flags & FLAG_SHM:
+                    try:
+                        _shm.discard_segment(bytes(body))
+                    except ValueError:
+                        self.logr.warning('Invalid shared memory handle %r', bytes(body))
+                return
+            if handling == 'lazy' and kind != BATCH and not header.flags & FLAG_SHM:
+                # The body is a view into the receive buffer, it must be copied
+                msg = LazyMessage(msgtype, header, bytes(body))
+        if msg is None:
+            if metrics is not None:
+                started = _perf_counter()
+            if reply is not None:
+                try:
+                    msg = header.data_loader(body)
+                except Exception as e:
+                    reply.error(f'Unable to decode request: {e!r}')
+                    return
             else:
-                logr.debug(f'{msg_type} has no observers')
-
-    async def get_header(self, reader):
-        data = await reader.read(self.serial.header_length)
-        return self.serial.load(data)
-
-    async def listener(self, reader, writer):
-        logr = self.logr
-        logr.debug(f"In listener!")
-        header = await self.get_header(reader)
-        value = await reader.read(header.data_length)
-        msg = header.data_loader(value)
-        logr.debug(f"Received {msg!r}")
-        await self.messages.put(msg)
-        writer.close()
-        # self.msg = msg
-
-        # writer.close()
-        # writer.write(b'got it')
-        # try:
-        #     await writer.drain()
-        #     logr.debug("Closing the client socket")
-        #     writer.close()
-        # except ConnectionResetError:
-        #     pass
-        return
+                msg = header.data_loader(body)
+            if metrics is not None:
+                metrics.decode.observe(_perf_counter() - started)
+        if kind == BATCH:
+            if not msg:
+                return
+            self.logr.debug('Received a batch of %d messages', len(msg))
+            if metrics is not None:
+                for item in msg:
+                    metrics.count_message(item.__class__.__name__)
+        else:
+            self.logr.debug('Received %r', msg)
+            if metrics is not None:
+                metrics.count_message(msg.__class__.__name__)
+        if self.server.spool is not None:
+            self.server.spool_frame(msg, header, body)
+        item = (msg, reply)
+        if not self.server.offer(item, self):
+            # Stop reading from this client until the queue has room
+            self.pause('queue')
+            asyncio.ensure_future(self._put(item))
+
+    def stream_frame_received(self, header, body):
+        stream_id = header.msg_id
+        if header.kind == STREAM:
+            stream = Stream(header.data_loader(body), self, stream_id)
+            self.streams[stream_id] = stream
+            self.server.dispatch_stream(stream)
+            return
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            self.logr.warning('Dropping a chunk of unknown stream %d', stream_id)
+        elif header.data_length:
+            stream.feed(header.data_loader(body))
+        else:
+            del self.streams[stream_id]
+            stream.feed_eof()
+
+    async def _put(self, item):
+        await self.server.messages.put(item)
+        self.resume('queue')
+
+    def send_error(self, text, msg_id=0):
+        self.write_frame(self.serial.dump_iter(text, 'json', ERROR, msg_id))
+
+    def write_frame(self, frame):
+        if self.transport is None or self.transport.is_closing():
+            self.logr.debug('Dropping reply to a closed connection')
+            return
+        if self.metrics is not None:
+            frame = list(frame)
+            self.metrics.bytes_out += sum(map(len, frame))
+        self.transport.writelines(frame)
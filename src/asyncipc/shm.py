@@ -0,0 +1,80 @@
+"""
+Pass large frame bodies through memory-mapped files instead of the socket.
+
+The sender writes a body into a new file under RUNTIME_DIR (normally a
+tmpfs) and sends only the file's name. The receiver maps the file, decodes
+the body straight from the mapping and unlinks it, so the file lives only
+as long as the message is in flight.
+"""
+import mmap as _mmap
+import os as _os
+from contextlib import contextmanager as _contextmanager
+
+from . import _utils
+
+PREFIX = 'asyncipc-shm-'
+
+
+def write_segment(data):
+    "Write data into a new mapped file and return its handle (bytes)"
+    from tempfile import mkstemp
+    fd, path = mkstemp(prefix=PREFIX, dir=_utils.RUNTIME_DIR)
+    try:
+        size = len(data)
+        if size:
+            _os.ftruncate(fd, size)
+            with _mmap.mmap(fd, size) as mm:
+                mm[:] = data
+    except BaseException:
+        _os.unlink(path)
+        raise
+    finally:
+        _os.close(fd)
+    return _os.path.basename(path).encode('utf-8')
+
+
+def _segment_path(handle):
+    "Return the path of the file named by handle, checking it is a segment"
+    name = str(handle, 'utf-8')
+    if not name.startswith(PREFIX) or _os.sep in name:
+        raise ValueError(f"Invalid shared memory handle {name!r}")
+    return _os.path.join(_utils.RUNTIME_DIR, name)
+
+
+def discard_segment(handle):
+    "Unlink the file named by handle without reading it"
+    try:
+        _os.unlink(_segment_path(handle))
+    except FileNotFoundError:
+        pass
+
+
+@_contextmanager
+def open_segment(handle):
+    """Map the file named by handle and yield a memoryview of its contents
+
+    The file is unlinked straight away. The view is only valid inside the
+    with block.
+    """
+    path = _segment_path(handle)
+    fd = _os.open(path, _os.O_RDONLY)
+    try:
+        _os.unlink(path)
+        size = _os.fstat(fd).st_size
+        if not size:
+            yield memoryview(b'')
+            return
+        mm = _mmap.mmap(fd, size, prot=_mmap.PROT_READ)
+    finally:
+        _os.close(fd)
+    view = memoryview(mm)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            # The decoded object still refers to the mapping, leave it to
+            # be unmapped once that is garbage collected
+            pass
@@ -0,0 +1,240 @@
+"""
+Append-only, memory-mapped log of frames that outlives the process.
+
+A Spool is a directory of segment files named after the sequence number
+of their first record, and a cursor file holding the sequence number of
+the oldest record that isn't done yet. Each record is its length, its
+crc32 and its data, written into the newest segment through a memory map.
+
+Records are made durable by group commit: sync() flushes everything
+appended since the last sync with a single msync, and append() calls it
+once sync_interval seconds have passed since the last one, so a crash
+loses at most the records of that interval instead of costing an fsync
+for each of them. After a crash a torn record fails its checksum and
+ends the log.
+
+Once every record of a segment is done the segment is deleted. Beyond
+that, segments are dropped oldest first, done or not, while the spool is
+larger than max_bytes or older than max_age seconds.
+
+Nothing locks a spool: a directory must only be used by one Spool, in a
+single process, at a time. In particular a Spool must not be shared by
+processes forked after it was opened.
+"""
+import mmap as _mmap
+import os
+import struct as _struct
+from collections import deque as _deque
+from time import monotonic as _monotonic
+from time import time as _time
+from zlib import crc32 as _crc32
+
+from . import _utils
+
+_record = _struct.Struct('<II')  # data length, crc32 of data
+_cursor = _struct.Struct('<Q')
+
+
+def _records(buf, end=None):
+    "Yield the data of the valid records in buf (up to end), a segment"
+    offset = 0
+    if end is None:
+        end = len(buf)
+    header_size = _record.size
+    while offset + header_size <= end:
+        length, crc = _record.unpack_from(buf, offset)
+        start = offset + header_size
+        if not length or start + length > end:
+            return
+        data = buf[start:start + length]
+        if _crc32(data) != crc:
+            return
+        yield data
+        offset = start + length
+
+
+class Spool:
+    "Log of records in directory, see the module docstring"
+    segment_size = 1 << 24
+
+    def __init__(self, directory, segment_size=None, max_bytes=None,
+                 max_age=None, sync_interval=0.05):
+        self.directory = directory
+        if segment_size is not None:
+            self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sync_interval = sync_interval
+        self.logr = _utils.get_logger()
+        self._segments = []  # [first seq, path] of every segment, oldest first
+        self._map = None  # Memory map of the newest segment
+        self._end = 0  # Where the next record goes in _map
+        self._synced = 0  # How much of _map was flushed
+        self._next = 0  # Sequence number of the next record
+        self._first = 0  # Sequence number of the oldest record not done
+        self._done = _deque()  # Whether each record from _first on is done
+        self._cursor_map = None
+        self._cursor_dirty = False
+        self._last_sync = _monotonic()
+        self._open()
+
+    def __len__(self):
+        "Number of records not done yet"
+        return len(self._done) - sum(self._done)
+
+    def _open(self):
+        directory = self.directory
+        os.makedirs(directory, exist_ok=True)
+        cursor_path = os.path.join(directory, 'cursor')
+        with open(cursor_path, 'a+b') as f:
+            if os.fstat(f.fileno()).st_size < _cursor.size:
+                f.truncate(_cursor.size)
+            self._cursor_map = _mmap.mmap(f.fileno(), _cursor.size)
+        cursor, = _cursor.unpack_from(self._cursor_map)
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.seg'))
+        for name in names:
+            self._segments.append([int(name[:-4]), os.path.join(directory, name)])
+        if not self._segments:
+            self._next = cursor
+            self._new_segment(0)
+        else:
+            first, path = self._segments[-1]
+            with open(path, 'r+b') as f:
+                self._map = _mmap.mmap(f.fileno(), 0)
+            count = 0
+            for data in _records(self._map):
+                self._end += _record.size + len(data)
+                count += 1
+            self._synced = self._end
+            self._next = first + count
+            cursor = max(cursor, self._segments[0][0])
+        self._first = min(cursor, self._next)
+        self._done.extend([False] * (self._next - self._first))
+
+    def _new_segment(self, size):
+        first = self._next
+        path = os.path.join(self.directory, f'{first:020d}.seg')
+        size = max(self.segment_size, size)
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            self._map = _mmap.mmap(f.fileno(), size)
+        self._segments.append([first, path])
+        self._end = self._synced = 0
+
+    def append(self, data):
+        "Add a record holding data (bytes, not empty); return its sequence number"
+        length = len(data)
+        if not length:
+            raise ValueError('Spooled records may not be empty')
+        size = _record.size + length
+        if self._end + size > len(self._map):
+            self.sync()
+            self._map.close()
+            self._new_segment(size)
+            self.compact()
+        buf = self._map
+        start = self._end + _record.size
+        buf[start:start + length] = data
+        _record.pack_into(buf, self._end, length, _crc32(data))
+        self._end = start + length
+        seq = self._next
+        self._next += 1
+        self._done.append(False)
+        if _monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+        return seq
+
+    def done(self, seq):
+        "Mark the record seq as done; it won't be returned by pending() again"
+        index = seq - self._first
+        if index < 0:
+            return
+        done = self._done
+        done[index] = True
+        if index:
+            return
+        while done and done[0]:
+            done.popleft()
+            self._first += 1
+        self._cursor_dirty = True
+
+    def pending(self):
+        """Yield (seq, data) for every record that isn't done, oldest first
+
+        Records may be marked done while iterating, but not appended.
+        """
+        segments = list(self._segments)
+        for idx, (first, path) in enumerate(segments):
+            if idx + 1 < len(segments):
+                if segments[idx + 1][0] <= self._first:
+                    continue
+                try:
+                    f = open(path, 'rb')
+                except FileNotFoundError:
+                    continue  # Dropped by compact() meanwhile
+                with f, _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ) as buf:
+                    yield from self._pending_in(buf, first)
+            else:
+                yield from self._pending_in(self._map, first, self._end)
+
+    def _pending_in(self, buf, seq, end=None):
+        for data in _records(buf, end):
+            index = seq - self._first
+            if index >= 0 and not self._done[index]:
+                yield seq, bytes(data)
+            seq += 1
+
+    def sync(self):
+        "Flush the records appended and the records done since the last sync"
+        buf = self._map
+        if self._end > self._synced:
+            start = self._synced - self._synced % _mmap.PAGESIZE
+            buf.flush(start, self._end - start)
+            self._synced = self._end
+        if self._cursor_dirty:
+            self.compact()
+            self._cursor_dirty = False
+            _cursor.pack_into(self._cursor_map, 0, self._first)
+            self._cursor_map.flush()
+        self._last_sync = _monotonic()
+
+    def compact(self):
+        "Delete segments that are done, too old or beyond max_bytes"
+        segments = self._segments
+        while len(segments) > 1 and segments[1][0] <= self._first:
+            os.unlink(segments.pop(0)[1])
+        if self.max_bytes is None and self.max_age is None:
+            return
+        while len(segments) > 1 and self._over_limits():
+            first, path = segments.pop(0)
+            self._drop_until(segments[0][0])
+            os.unlink(path)
+
+    def _over_limits(self):
+        paths = [path for _, path in self._segments]
+        if self.max_bytes is not None:
+            if sum(os.path.getsize(path) for path in paths) > self.max_bytes:
+                return True
+        if self.max_age is not None:
+            return _time() - os.path.getmtime(paths[0]) > self.max_age
+        return False
+
+    def _drop_until(self, seq):
+        "Give up on all records before seq"
+        dropped = 0
+        done = self._done
+        while self._first < seq:
+            if not done.popleft():
+                dropped += 1
+            self._first += 1
+        if dropped:
+            self.logr.warning('Spool is over its limits, dropped %d records', dropped)
+        self._cursor_dirty = True
+
+    def close(self):
+        if self._map is None:
+            return
+        self.sync()
+        self._map.close()
+        self._cursor_map.close()
+        self._map = self._cursor_map = None
@@ -0,0 +1,101 @@
+"""
+Messages whose body is streamed in chunks.
+
+A streamed message is sent as a STREAM frame holding the message itself,
+followed by any number of CHUNK frames with the same msg_id carrying raw
+bytes, and an empty CHUNK frame ending it. Neither end holds more than a
+few chunks in memory, and no frame has to fit the whole body.
+"""
+import asyncio
+from collections import deque as _deque
+
+
+class Stream:
+    """A received streamed message and an async iterator over its chunks
+
+    The observer of the message's type is called with the Stream and reads
+    the chunks with async for. Once maxsize chunks are waiting the server
+    stops reading from the sender's connection until the observer catches
+    up. Chunks the observer didn't read when it returns are discarded.
+    """
+    maxsize = 16
+
+    def __init__(self, message, protocol, stream_id):
+        self.message = message
+        self.protocol = protocol
+        self.stream_id = stream_id
+        self.paused = False
+        self._chunks = _deque()
+        self._waiter = None
+        self._eof = False
+        self._exc = None
+        self._closed = False
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.stream_id} of {self.message!r}>'
+
+    def feed(self, chunk):
+        if self._closed:
+            return
+        self._chunks.append(chunk)
+        self._wake()
+        if len(self._chunks) >= self.maxsize and not self.paused:
+            self.paused = True
+            self.protocol.pause(self)
+
+    def feed_eof(self):
+        self._eof = True
+        self._wake()
+
+    def set_exception(self, exc):
+        self._exc = exc
+        self._wake()
+
+    def close(self, future=None):
+        "Discard the rest of the stream (can be used as a done callback)"
+        self._closed = True
+        self._chunks.clear()
+        self._unpause()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunks = self._chunks
+        while not chunks:
+            if self._exc is not None:
+                raise self._exc
+            if self._eof or self._closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.get_event_loop().create_future()
+            await self._waiter
+        chunk = chunks.popleft()
+        if self.paused and len(chunks) <= self.maxsize // 2:
+            self._unpause()
+        return chunk
+
+    async def read(self):
+        "Return the rest of the body at once; this defeats streaming"
+        return b''.join([chunk async for chunk in self])
+
+    def _unpause(self):
+        if not self.paused:
+            return
+        self.paused = False
+        # Reading goes on once nothing else keeps the connection paused
+        self.protocol.resume(self)
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
+async def _aiter(chunks):
+    "Iterate asynchronously over chunks, a sync or async iterable"
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import signal
+import time
+from socket import AF_UNIX as _AF_UNIX
+from socket import SOCK_STREAM as _SOCK_STREAM
+from socket import socket as _socket
+
+from . import _utils
+
+
+class Supervisor:
+    """Run a Server in several pre-forked worker processes
+
+    The supervisor binds the server's unix socket once and forks workers
+    that all accept connections from it, so each connection is served
+    by whichever worker accepts it first. Every worker runs its own event
+    loop with its own copy of the server and of the observers registered
+    before run() was called.
+
+    Workers that die are replaced. SIGHUP starts a graceful restart: a
+    new set of workers is forked and the old ones are sent SIGTERM, after
+    which they stop accepting connections and get grace seconds to finish
+    their work. SIGTERM or SIGINT stops the supervisor and all workers.
+
+    Workers run their event loop from loop_factory, e.g. the faster
+    server.new_event_loop.
+
+    A server with a spool is refused with ValueError: the workers would
+    all append to and mark done records of the one spool they inherited,
+    which isn't safe across processes.
+    """
+    poll_interval = 0.1
+
+    def __init__(self, server, workers=None, grace=5.0, backlog=128,
+                 loop_factory=asyncio.new_event_loop):
+        if server.spool is not None:
+            raise ValueError("A Server with a spool can't be shared by workers")
+        self.server = server
+        self.loop_factory = loop_factory
+        self.nworkers = workers or os.cpu_count() or 1
+        self.grace = grace
+        self.backlog = backlog
+        self.logr = _utils.get_logger()
+        self.sock = None
+        self.workers = set()
+        self.retiring = set()
+        self._stopping = False
+        self._restarting = False
+
+    def bind(self):
+        path = self.server.socket_path
+        sock = _socket(_AF_UNIX, _SOCK_STREAM)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock.bind(path)
+        sock.listen(self.backlog)
+        return sock
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._worker()
+                code = 0
+            except BaseException:
+                self.logr.exception('Worker crashed')
+            finally:
+                os._exit(code)
+        self.workers.add(pid)
+        self.logr.debug('Started worker %d', pid)
+        return pid
+
+    def _worker(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+        loop = self.loop_factory()
+        asyncio.set_event_loop(loop)
+        server = self.server
+        server(loop, sock=self.sock)
+
+        def stop():
+            task = loop.create_task(server.shutdown(self.grace))
+            task.add_done_callback(lambda _: loop.stop())
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGINT)
+
+        loop.add_signal_handler(signal.SIGTERM, stop)
+        loop.add_signal_handler(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        loop.run_forever()
+
+    def restart(self):
+        "Replace all workers with new ones, letting the old ones finish"
+        old = set(self.workers)
+        for _ in range(self.nworkers):
+            self.spawn()
+        self.retiring |= old
+        self.workers -= old
+        self._signal_all(old, signal.SIGTERM)
+
+    def run(self):
+        "Fork the workers and supervise them until told to stop"
+        self.sock = self.bind()
+        handlers = {
+            signal.SIGTERM: signal.signal(signal.SIGTERM, self._on_stop),
+            signal.SIGINT: signal.signal(signal.SIGINT, self._on_stop),
+            signal.SIGHUP: signal.signal(signal.SIGHUP, self._on_restart),
+        }
+        try:
+            for _ in range(self.nworkers):
+                self.spawn()
+            while not self._stopping:
+                if self._restarting:
+                    self._restarting = False
+                    self.restart()
+                self._reap()
+                time.sleep(self.poll_interval)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            self.stop()
+
+    def stop(self):
+        "Stop all workers, giving them grace seconds before killing them"
+        self._stopping = True
+        pids = self.workers | self.retiring
+        self._signal_all(pids, signal.SIGTERM)
+        deadline = time.monotonic() + self.grace + 1.0
+        while (self.workers or self.retiring) and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(self.poll_interval / 2)
+        self._signal_all(self.workers | self.retiring, signal.SIGKILL)
+        for pid in self.workers | self.retiring:
+            os.waitpid(pid, 0)
+        self.workers.clear()
+        self.retiring.clear()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.server.socket_path)
+            except FileNotFoundError:
+                pass
+
+    def _reap(self):
+        "Collect exited workers, replacing the ones that weren't retired"
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif pid in self.workers:
+                self.workers.discard(pid)
+                if not self._stopping:
+                    self.logr.warning('Worker %d exited (%s), restarting it', pid, status)
+                    self.spawn()
+
+    def _signal_all(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_restart(self, signum, frame):
+        self._restarting = True
@@ -1,8 +1,8 @@
 import pytest
 
 from asyncipc._utils import RUNTIME_DIR
+from asyncipc.client import Client
 from asyncipc.message import BaseMessage, message_types
-from asyncipc.serializer import Serialize
 
 
 class Alpha(BaseMessage):
@@ -24,13 +24,6 @@ def alpha():
     return Alpha(99,98)
 
 
-def new_socket(path):
-    from socket import socket, AF_UNIX, SOCK_STREAM
-    sock = socket(AF_UNIX, SOCK_STREAM)
-    sock.connect(path)
-    return sock
-
-
 @pytest.fixture
 def sockpath():
     from os import path
@@ -40,10 +33,35 @@ def sockpath():
 def send_msg(sockpath):
     def inner(msg):
         def wrapper():
-            sock = new_socket(sockpath)
-            serial = Serialize(**message_types)
-            for bstr in serial.dump_iter(msg):
-                sock.send(bstr)
-            sock.close()
+            with Client(sockpath) as client:
+                client.send(msg)
         return wrapper
     return inner
+
+
+def send_msg_many(sockpath, msgs):
+    "Return a function sending msgs over one connection"
+    def wrapper():
+        with Client(sockpath) as client:
+            client.send_many(msgs)
+    return wrapper
+
+@pytest.fixture
+def event_loop():
+    import asyncio
+    loop = asyncio.new_event_loop()
+    yield loop
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+
+
+def run_until(loop, predicate, timeout=2.0):
+    "Run loop until predicate() is true or raise asyncio.TimeoutError"
+    import asyncio
+    async def wait():
+        while not predicate():
+            await asyncio.sleep(0.005)
+    loop.run_until_complete(asyncio.wait_for(wait(), timeout))
@@ -1,6 +1,89 @@
+import asyncio
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+import pytest
+from fixtures import *
 
 from asyncipc.cli import main
+from asyncipc.message import message_types
+from asyncipc.server import Server
+
+# Budgets for a fresh interpreter, measured at about 40ms to import the
+# client and a few ms for the first send. Wall-clock time isn't reliable on
+# a loaded machine, so they are only held to with ASYNCIPC_TIMING_TESTS
+# set; otherwise they are LOOSE_FACTOR times larger, which still catches
+# gross regressions
+IMPORT_BUDGET = 0.5
+SEND_BUDGET = 1.0
+LOOSE_FACTOR = 10
+CHECK_TIMING = bool(os.environ.get('ASYNCIPC_TIMING_TESTS'))
+
+
+def check_budget(elapsed, budget):
+    if not CHECK_TIMING:
+        budget *= LOOSE_FACTOR
+    assert elapsed < budget
 
 
 def test_main():
     main([])
+
+def python_env():
+    "Environment for a python subprocess importing asyncipc from the source tree"
+    src = os.path.join(os.path.dirname(__file__), os.pardir, 'src')
+    return dict(os.environ, PYTHONPATH=os.path.abspath(src))
+
+def run_python(*args, timeout=10):
+    return subprocess.run(
+        [sys.executable, *args], env=python_env(), timeout=timeout,
+        capture_output=True, text=True, check=True,
+    ).stdout
+
+def test_client_import():
+    code = '''if True:
+        import sys
+        from time import perf_counter
+        started = perf_counter()
+        from asyncipc.client import Client
+        print(perf_counter() - started)
+        heavy = ('asyncio', 'inspect', 'logging', 'tempfile', 'lzma', 'pickle')
+        print(' '.join(name for name in heavy if name in sys.modules))
+    '''
+    elapsed, heavy = run_python('-c', code).split('\n')[:2]
+    assert heavy == ''
+    check_budget(float(elapsed), IMPORT_BUDGET)
+
+def test_send_from_cli(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    received = []
+    serv.register(Alpha, received.append)
+    serv.register(Beta, lambda msg: msg.c)
+    serv(event_loop)
+
+    async def run(*args):
+        started = perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'asyncipc', 'send', os.path.basename(sockpath), *args,
+            env=python_env(),
+            stdout=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await proc.communicate()
+        assert proc.returncode == 0
+        return perf_counter() - started, stdout
+    elapsed, _ = event_loop.run_until_complete(run('Alpha', '{"a": 1, "b": 2}'))
+    run_until(event_loop, lambda: received)
+    assert received[0].as_dict == Alpha(1, 2).as_dict
+    check_budget(elapsed, IMPORT_BUDGET + SEND_BUDGET)
+
+    _, stdout = event_loop.run_until_complete(
+        run('Beta', '{"a": 1, "b": 2, "c": 3}', '--request'))
+    assert stdout.strip() == b'3'
+
+def test_send_invalid_fields(capsys):
+    for fields in ('[1]', '{"not a name": 1}', '{'):
+        with pytest.raises(SystemExit):
+            main(['send', 'unused', 'Alpha', fields])
+        assert 'FIELDS' in capsys.readouterr().err
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+from fixtures import *
+
+from asyncipc.bench import percentiles
+from asyncipc.cli import main
+
+
+def test_percentiles():
+    result = percentiles([i / 1000 for i in range(1000, 0, -1)])
+    assert result['p50'] == 0.501
+    assert result['p99'] == 0.991
+    assert result['p999'] == result['max'] == 1.0
+    assert percentiles([]) == {}
+
+@pytest.mark.parametrize('mode', ['persistent', 'batch', 'request', 'connect'])
+def test_bench(tmp_path, mode):
+    path = tmp_path / 'results.json'
+    main(['bench', '-n', '200', '--warmup', '0', '--mode', mode,
+          '--size', '100', '--json', str(path)])
+    output = json.loads(path.read_text())
+    assert output['config']['mode'] == mode
+    results = output['results']
+    assert results['count'] == 200
+    assert results['throughput'] > 0
+    assert 0 < results['latency']['p50'] <= results['latency']['p999']
+
+@pytest.mark.parametrize('mode', ['persistent', 'request'])
+def test_bench_formatter(tmp_path, mode):
+    path = tmp_path / 'results.json'
+    main(['bench', '-n', '50', '--warmup', '0', '--mode', mode, '-f', 'pickle',
+          '--size', '100', '--json', str(path)])
+    results = json.loads(path.read_text())['results']
+    assert results['count'] == 50
+
+def test_struct_needs_small_messages():
+    with pytest.raises(SystemExit):
+        main(['bench', '-f', 'struct'])
+
+@pytest.mark.parametrize('formatter', ['json', 'pickle', 'struct'])
+def test_codec(tmp_path, formatter):
+    path = tmp_path / 'results.json'
+    mix = 'small' if formatter == 'struct' else 'small=1,large=1'
+    main(['bench', '-n', '200', '--warmup', '10', '--mode', 'codec',
+          '-f', formatter, '--mix', mix, '--json', str(path)])
+    results = json.loads(path.read_text())['results']
+    assert results['count'] == 200
+    assert results['encode']['throughput'] > 0
+    assert results['decode']['throughput'] > 0
+
+def test_columns_isnt_a_bench_formatter():
+    with pytest.raises(SystemExit):
+        main(['bench', '-f', 'columns', '--mode', 'codec'])
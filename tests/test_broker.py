@@ -0,0 +1,130 @@
+import asyncio
+import logging
+
+import pytest
+from fixtures import *
+
+from asyncipc.broker import Broker, Subscription
+from asyncipc.client import AsyncClient, Client, RemoteError
+from asyncipc.message import BaseMessage, message_types
+from asyncipc.serializer import Serialize
+
+
+def test_fan_out(sockpath, event_loop):
+    broker = Broker(sockpath, message_types)
+    observed = []
+    broker.register(Alpha, observed.append)
+    broker(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath) as alphas, \
+                   AsyncClient(sockpath) as betas, \
+                   AsyncClient(sockpath) as packed:
+            await alphas.subscribe(Alpha)
+            await betas.subscribe('Beta')
+            await packed.subscribe(Beta, formatter='pickle')
+            with Client(sockpath) as publisher:
+                publisher.send(Alpha(1, 2))
+                publisher.send_batch([Beta(3, 1, 2), Alpha(4, 5)])
+            got = [await alphas.receive() for _ in range(3)]
+            assert [m.as_dict for m in got] == [
+                Alpha(1, 2).as_dict, Beta(3, 1, 2).as_dict, Alpha(4, 5).as_dict,
+            ]
+            assert (await betas.receive()).as_dict == Beta(3, 1, 2).as_dict
+            assert (await packed.receive()).as_dict == Beta(3, 1, 2).as_dict
+
+            await alphas.unsubscribe(Alpha)
+            assert not broker.subscriptions.get(alphas.protocol)
+            with pytest.raises(RemoteError, match='policy'):
+                await alphas.subscribe(Alpha, policy='asdf')
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    assert [m.a for m in observed] == [1, 1, 4]
+
+class Packed(BaseMessage):
+    _fields = ['a']
+    _struct = {'a': 'B'}
+
+def test_unencodable_subscription(sockpath, event_loop):
+    broker = Broker(sockpath, message_types)
+    observed = []
+    broker.register(Packed, observed.append)
+    broker(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath) as packed, AsyncClient(sockpath) as plain:
+            with pytest.raises(RemoteError, match='no struct format'):
+                await packed.subscribe(Alpha, formatter='struct')
+            await packed.subscribe(Packed, formatter='struct')
+            await plain.subscribe(Packed)
+            with Client(sockpath) as publisher:
+                # Out of range for the struct format of a
+                publisher.send(Packed(300))
+                publisher.send(Packed(1))
+            assert [(await plain.receive()).a for _ in range(2)] == [300, 1]
+            assert (await packed.receive()).a == 1
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    assert [m.a for m in observed] == [300, 1]
+
+def test_forward_undecoded(sockpath, event_loop):
+    broker = Broker(sockpath, message_types)
+    broker(event_loop)
+    assert broker.frame_handling(Alpha) == 'drop'
+
+    async def run():
+        async with AsyncClient(sockpath) as subscriber:
+            await subscriber.subscribe(Alpha)
+            assert broker.frame_handling(Beta) == 'lazy'
+            with Client(sockpath) as publisher:
+                publisher.send(Beta(3, 1, 2))
+            assert (await subscriber.receive()).as_dict == Beta(3, 1, 2).as_dict
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+
+def test_disconnect_unsubscribes(sockpath, event_loop):
+    broker = Broker(sockpath, message_types)
+    broker(event_loop)
+
+    async def run():
+        client = AsyncClient(sockpath)
+        await client.subscribe(Alpha)
+        assert len(broker.subscriptions) == 1
+        client.close()
+        while broker.subscriptions:
+            await asyncio.sleep(0.005)
+        assert not broker.targets(Beta)
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+
+class FakeProtocol:
+    "Stands in for a BrokerProtocol whose transport stopped writing"
+    def __init__(self):
+        self.serial = Serialize()
+        self.writing_paused = False
+        self.written = []
+        self.closed = False
+        self.transport = self
+        self.logr = logging.getLogger()
+
+    def write_frame(self, frame):
+        # Like ServerProtocol.write_frame, drop frames to a closed connection
+        if not self.closed:
+            self.written.append(frame)
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize('policy, expected', [
+    ('drop-oldest', [0, 3, 4]),
+    ('drop-newest', [0, 1, 2]),
+    ('disconnect', [0]),
+])
+def test_slow_subscriber(policy, expected):
+    protocol = FakeProtocol()
+    sub = Subscription(protocol, maxsize=2, policy=policy)
+    sub.push(0)
+    protocol.writing_paused = True
+    for frame in range(1, 5):
+        sub.push(frame)
+    assert sub.dropped == (1 if policy == 'disconnect' else 2)
+    assert protocol.closed == (policy == 'disconnect')
+    protocol.writing_paused = False
+    sub.flush()
+    assert protocol.written == expected
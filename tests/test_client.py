@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+from fixtures import *
+
+from asyncipc import client as _client
+from asyncipc.client import AsyncClientPool, Client, ClientPool, RemoteError
+from asyncipc.message import BaseMessage, message_types
+from asyncipc.server import Server
+
+
+class SlowRequest(BaseMessage):
+    "Request the test server answers slowly"
+
+
+class TrickleSocket:
+    "Fake socket whose sendmsg() writes at most 5 bytes at a time"
+    def __init__(self):
+        self.data = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        chunk = b''.join(bytes(x) for x in buffers)[:5]
+        self.data += chunk
+        return len(chunk)
+
+
+def test_sendmsg_partial_writes():
+    sock = TrickleSocket()
+    buffers = [b'abc', b'', b'defghij', bytearray(b'klm')]
+    _client._sendmsg_all(sock, buffers)
+    assert sock.data == b'abcdefghijklm'
+    assert sock.calls == 3
+
+
+@pytest.fixture
+def server(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    serv.received = []
+    def record(msg):
+        # Betas reach Alpha's observers too, only keep the Alphas
+        if msg.__class__ is Alpha:
+            serv.received.append(msg)
+    serv.register(Alpha, record)
+    serv.register(Beta, lambda msg: msg.c * 2)
+    serv(event_loop)
+    return serv
+
+
+def test_sync_send_many_and_request(server, sockpath, event_loop):
+    msgs = [Alpha(i, i) for i in range(50)]
+    results = []
+    def run_client():
+        with Client(sockpath) as client:
+            client.send_many(msgs)
+            results.append(client.request(Beta(21, 0, 0)))
+    event_loop.run_until_complete(
+        asyncio.wait_for(event_loop.run_in_executor(None, run_client), 2.0))
+    run_until(event_loop, lambda: len(server.received) == 50)
+    assert [m.as_dict for m in server.received] == [m.as_dict for m in msgs]
+    assert results == [42]
+
+
+def test_client_pool_reuses_connection(server, sockpath, event_loop):
+    pool = ClientPool()
+    def run_client():
+        for i in range(3):
+            pool.send(sockpath, Alpha(i, i))
+        assert pool.request(sockpath, Beta(1, 0, 0)) == 2
+        with pytest.raises(RemoteError):
+            pool.request(sockpath, Beta(None, 0, 0))
+    event_loop.run_until_complete(
+        asyncio.wait_for(event_loop.run_in_executor(None, run_client), 2.0))
+    assert len(pool.idle[sockpath]) == 1
+    pool.close()
+
+
+def test_async_pool(server, sockpath, event_loop):
+    pool = AsyncClientPool()
+    msgs = [Alpha(i, 'x' * 1000) for i in range(500)]
+    async def run():
+        await pool.send_many(sockpath, msgs)
+        await pool.send(sockpath, Alpha('last', 0))
+        assert pool.get(sockpath) is pool.get(sockpath)
+        assert await pool.request(sockpath, Beta(2, 0, 0)) == 4
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    run_until(event_loop, lambda: len(server.received) == 501)
+    assert server.received[-1].a == 'last'
+    pool.close()
+
+def test_msg_ids_wrap(server, sockpath, event_loop):
+    from itertools import count
+    from asyncipc.client import AsyncClient
+    assert _client._next_id(count(2**32 - 1), {1: None}) == 2**32 - 1
+    assert _client._next_id(count(2**32), {1: None}) == 2
+    def run_client():
+        with Client(sockpath) as client:
+            client._ids = count(2**32 - 1)
+            return [client.request(Beta(i, 0, 0)) for i in range(3)]
+    assert event_loop.run_until_complete(
+        asyncio.wait_for(event_loop.run_in_executor(None, run_client), 2.0)) == [0, 2, 4]
+    async def run():
+        async with AsyncClient(sockpath) as client:
+            client._ids = count(2**32 - 1)
+            return await asyncio.gather(*[client.request(Beta(i, 0, 0)) for i in range(3)])
+    assert event_loop.run_until_complete(asyncio.wait_for(run(), 2.0)) == [0, 2, 4]
+
+def test_request_timeout(server, sockpath, event_loop):
+    import time
+    async def slow(msg):
+        await asyncio.sleep(1)
+    server.register(SlowRequest, slow)
+    def run_client():
+        with Client(sockpath) as client:
+            started = time.monotonic()
+            with pytest.raises(TimeoutError):
+                client.request(SlowRequest(), timeout=0.05)
+            assert time.monotonic() - started < 0.5
+            assert client.sock is None
+            return client.request(Beta(1, 0, 0), timeout=1)
+    assert event_loop.run_until_complete(
+        asyncio.wait_for(event_loop.run_in_executor(None, run_client), 2.0)) == 2
+
+def test_reply_formatter_is_accepted_for_its_reply_only():
+    from asyncipc.asyncclient import ClientProtocol
+    from asyncipc.serializer import MESSAGE, REPLY, Serialize
+    serial = Serialize(formatters=['pickle'], **message_types)
+    reply = b''.join(serial.dump_iter(3, 'pickle', REPLY, 5))
+    published = b''.join(serial.dump_iter(Alpha(1, 2), 'pickle', MESSAGE))
+    for collector in (_client._ReplyCollector(Serialize()),
+                      ClientProtocol(Serialize())):
+        collector.formatters[5] = 'pickle'
+        load = collector.serial.load
+        assert load(reply, 0, collector.accept).data_loader(reply[serial.header_length:]) == 3
+        with pytest.raises(ValueError):
+            load(published, 0, collector.accept)
+        del collector.formatters[5]
+        with pytest.raises(ValueError):
+            load(reply, 0, collector.accept)
@@ -0,0 +1,104 @@
+import pytest
+from fixtures import *
+
+from asyncipc.compression import CODEC_SHIFT, Compression, codecs
+from asyncipc.message import message_types
+from asyncipc.serializer import CODEC_MASK, FLAG_DICT, HeaderFormat, Serialize
+
+
+def roundtrip(serial, msg, formatter='json', receiver=None):
+    b_header, b_data = serial.dump_iter(msg, formatter)
+    header = (receiver or serial).load(b_header)
+    return header, header.data_loader(b_data)
+
+@pytest.mark.parametrize('codec', ('zlib', 'lzma', 'zstd'))
+def test_codecs(codec):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    serial = Serialize(compression=Compression(codec, threshold=100), **message_types)
+    small, big = Alpha(1, 2), Alpha('telemetry ' * 100, [1.5] * 50)
+    header, msg = roundtrip(serial, small)
+    assert not header.flags & CODEC_MASK
+    b_header, b_data = serial.dump_iter(big)
+    assert len(b_data) < 200
+    # The receiver needs no compression settings to decode the frame
+    header, msg = roundtrip(serial, big, receiver=Serialize(**message_types))
+    assert header.flags & CODEC_MASK
+    assert msg.as_dict == big.as_dict
+
+@pytest.mark.parametrize('codec', ('zlib', 'lzma', 'zstd'))
+@pytest.mark.parametrize('use_dict', (False, True))
+def test_max_size(codec, use_dict):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    if use_dict and not codecs[codec].dictionaries:
+        pytest.skip(f"{codec} doesn't support dictionaries")
+    sender, limited = Compression(codec, threshold=100), Compression(max_size=50100)
+    if use_dict:
+        for compression in (sender, limited):
+            compression.add_dictionary(Alpha, b'"Alpha" telemetry ' * 20)
+    serial = Serialize(compression=sender, **message_types)
+    msg = Alpha('x' * 50000, 1)
+    b_header, b_data = serial.dump_iter(msg)
+    assert len(b_data) < 1000
+    receiver = Serialize(compression=limited, **message_types)
+    assert receiver.load(b_header).data_loader(b_data).as_dict == msg.as_dict
+    receiver.compression.max_size = 50000
+    with pytest.raises(ValueError):
+        receiver.load(b_header).data_loader(b_data)
+    with pytest.raises(ValueError):
+        receiver.load(b_header).data_loader(b_data[:len(b_data) // 2])
+
+def test_incompressible_sent_raw():
+    import os
+    serial = Serialize(
+        compression=Compression(threshold=10), formatters=['pickle'], **message_types,
+    )
+    header, msg = roundtrip(serial, os.urandom(2000), 'pickle')
+    assert not header.flags & CODEC_MASK
+
+def test_dictionary():
+    samples = [Alpha(f'sensor-{i}', {'temp': i, 'unit': 'celsius'}) for i in range(50)]
+    sender = Serialize(compression=Compression(threshold=10), **message_types)
+    sender.train_compression(samples)
+    msg = Alpha('sensor-99', {'temp': 99, 'unit': 'celsius'})
+    plain = Serialize(compression=Compression(threshold=10), **message_types)
+    b_plain = list(plain.dump_iter(msg))[1]
+    b_header, b_data = sender.dump_iter(msg)
+    assert len(b_data) < len(b_plain)
+
+    receiver = Serialize(compression=Compression(), **message_types)
+    with pytest.raises(ValueError, match='dictionary'):
+        receiver.load(b_header).data_loader(b_data)
+    receiver.compression.add_dictionary(Alpha, sender.compression.dictionaries['Alpha'][1])
+    header = receiver.load(b_header)
+    assert header.flags & FLAG_DICT
+    assert header.data_loader(b_data).as_dict == msg.as_dict
+
+def test_batch_compressed():
+    serial = Serialize(compression=Compression(threshold=100), **message_types)
+    msgs = [Alpha(i, 'x' * 20) for i in range(50)]
+    b_header, b_data = serial.dump_batch_iter(msgs)
+    header = serial.load(b_header)
+    assert header.flags & CODEC_MASK
+    assert [m.as_dict for m in header.data_loader(b_data)] == [m.as_dict for m in msgs]
+
+def test_header_version():
+    b_header = bytearray(HeaderFormat.pack(b'json', 10))
+    b_header[0] = HeaderFormat.version + 1
+    with pytest.raises(ValueError, match='version'):
+        HeaderFormat.unpack(b_header)
+
+def test_unknown_codec():
+    with pytest.raises(NotImplementedError):
+        Compression('asdf')
+    assert set(codecs) >= {'zlib', 'lzma'}
+
+def test_unavailable_codec(monkeypatch):
+    zstd = codecs['zstd']
+    monkeypatch.setattr(zstd, 'available', staticmethod(lambda: False))
+    with pytest.raises(NotImplementedError, match='available'):
+        Compression('zstd')
+    flags = zstd.id << CODEC_SHIFT
+    with pytest.raises(ValueError, match='available'):
+        Compression().decompress(b'x' * 100, flags)
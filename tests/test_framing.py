@@ -0,0 +1,98 @@
+import pytest
+from fixtures import *
+
+from asyncipc.framing import FrameProtocol
+from asyncipc.message import message_types
+from asyncipc.serializer import Serialize
+
+
+class Collector(FrameProtocol):
+    initial_size = 64
+    min_read = 16
+
+    def __init__(self):
+        super().__init__(Serialize(formatters=('json', 'pickle'), **message_types))
+        self.received = []
+
+    def frame_received(self, header, body):
+        assert isinstance(body, memoryview)
+        self.received.append(header.data_loader(body))
+
+    def feed(self, data, chunk_size):
+        "Mimic a transport doing recv_into() with at most chunk_size bytes"
+        while data:
+            buf = self.get_buffer(-1)
+            nbytes = min(len(buf), chunk_size, len(data))
+            buf[:nbytes] = data[:nbytes]
+            data = data[nbytes:]
+            self.buffer_updated(nbytes)
+
+
+def frames(*messages, formatter='json'):
+    serial = Serialize(**message_types)
+    return b''.join(b''.join(serial.dump_iter(m, formatter)) for m in messages)
+
+
+@pytest.mark.parametrize('chunk_size', (1, 7, 64, 4096))
+def test_split_reads(chunk_size):
+    msgs = [Alpha(i, 'x' * i) for i in range(20)]
+    proto = Collector()
+    proto.feed(frames(*msgs), chunk_size)
+    assert [m.as_dict for m in proto.received] == [m.as_dict for m in msgs]
+    assert proto._start == proto._end == 0
+
+@pytest.mark.parametrize('formatter', ('json', 'pickle'))
+def test_buffer_grows(formatter):
+    big = Beta('c' * 100000, 1, 2)
+    proto = Collector()
+    proto.feed(frames(Alpha(1, 2), big, Alpha(3, 4), formatter=formatter), 1000)
+    assert [m.as_dict for m in proto.received] == \
+        [Alpha(1, 2).as_dict, big.as_dict, Alpha(3, 4).as_dict]
+    assert len(proto._buf) >= 100000
+
+def test_max_frame_size():
+    from asyncipc.serializer import HeaderFormat
+    proto = Collector()
+    proto.max_frame_size = 1000
+    proto.feed(frames(Alpha('x' * 900, 1)), 64)
+    with pytest.raises(ValueError):
+        proto.feed(HeaderFormat.pack(b'json', 0xFFFFFFFF), 64)
+    assert len(proto._buf) < 4096
+
+class FakeTransport:
+    def __init__(self):
+        self.reading = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+def test_pause_reasons():
+    import asyncio
+    from asyncipc.streams import Stream
+    proto = Collector()
+    transport = FakeTransport()
+    proto.connection_made(transport)
+    stream = Stream(Alpha(1, 2), proto, 1)
+    for _ in range(stream.maxsize):
+        stream.feed(b'x')
+    assert stream.paused
+    proto.pause('queue')
+    proto.feed(frames(Alpha(3, 4)), 64)
+    # The stream catching up doesn't undo the other pause
+    async def read(count):
+        for _ in range(count):
+            await stream.__anext__()
+    asyncio.run(read(stream.maxsize))
+    assert not stream.paused
+    assert not transport.reading and not proto.received
+    # Nor the reverse
+    for _ in range(stream.maxsize):
+        stream.feed(b'x')
+    proto.resume('queue')
+    assert not transport.reading and not proto.received
+    stream.close()
+    assert transport.reading
+    assert [m.as_dict for m in proto.received] == [Alpha(3, 4).as_dict]
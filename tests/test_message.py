@@ -28,6 +28,11 @@ def test_sig():
     sig = Alpha.__signature__
     assert list(sig.parameters) == ['a', 'b', 'x']
 
+def test_sig_of_instances():
+    import inspect
+    assert Alpha(1, 2).__signature__ is Alpha.__signature__
+    assert inspect.signature(Alpha) == Alpha.__signature__
+
 def test_sig_inheritance():
     sig = Beta.__signature__
     assert list(sig.parameters) == ['c', 'a', 'b', 'y', 'x']
@@ -35,3 +40,89 @@ def test_sig_inheritance():
 def test_repr():
     a = Alpha(98, 99, x=97)
     assert repr(a) == 'Alpha(a=98, b=99, x=97)'
+
+def test_init_semantics():
+    with pytest.raises(TypeError):
+        Alpha(1)
+    with pytest.raises(TypeError):
+        Alpha(1, 2, 3)
+    with pytest.raises(TypeError):
+        Alpha(1, 2, z=3)
+    assert Alpha(b=2, a=1).as_dict == {'a': 1, 'b': 2, 'x': 42}
+    assert Beta(3, 1, 2).as_dict == Beta(c=3, a=1, b=2).as_dict
+
+def test_from_tuple():
+    beta = Beta._from_tuple(('c', 'a', 'b', 'y', 'x'))
+    assert isinstance(beta, Beta)
+    assert beta.as_dict == {x:x for x in 'cabxy'}
+    with pytest.raises(ValueError):
+        Beta._from_tuple((1, 2))
+
+def test_from_dict():
+    beta = Beta(3, 1, 2, y=5)
+    assert Beta._from_dict(beta.as_dict).as_dict == beta.as_dict
+    # Anything but a complete as_dict goes through __init__
+    assert Beta._from_dict({'a': 1, 'b': 2, 'c': 3}).as_dict == Beta(3, 1, 2).as_dict
+    with pytest.raises(TypeError):
+        Beta._from_dict({'a': 1})
+    with pytest.raises(TypeError):
+        Beta._from_dict({'a': 1, 'b': 2, 'c': 3, 'x': 4, 'z': 5})
+
+def test_from_dict_uses_custom_init():
+    class Thermometer(BaseMessage):
+        _fields = ['celsius']
+        def __init__(self, celsius):
+            self.celsius = float(celsius)
+    assert Thermometer._from_dict({'celsius': '12'}).celsius == 12.0
+    assert Thermometer._from_tuple(('12',)).celsius == 12.0
+    class Outdoor(Thermometer):
+        pass
+    assert Outdoor._from_dict({'celsius': '12'}).celsius == 12.0
+
+def test_custom_init_is_kept():
+    class Custom(BaseMessage):
+        _fields = ['a']
+        def __init__(self, a):
+            self.a = a * 2
+    assert Custom(2).a == 4
+    assert repr(Custom(1)) == 'Custom(a=2)'
+
+def test_custom_methods_are_inherited():
+    class Custom(BaseMessage):
+        _fields = ['a']
+        def __init__(self, a, b=0):
+            self.a = a * 2
+            self.b = b
+        def __repr__(self):
+            return f'<{self.a}>'
+    class Sub(Custom):
+        _fields = ['b']
+    sub = Sub(2)
+    assert (sub.a, sub.b) == (4, 0)
+    assert repr(sub) == '<4>'
+    # Generated methods depending on the fields are still made per class
+    assert sub.as_dict == {'b': 0, 'a': 4}
+    class Plain(BaseMessage):
+        _fields = ['a']
+    class PlainSub(Plain):
+        _fields = ['b']
+    assert repr(PlainSub(1, 2)) == 'PlainSub(b=1, a=2)'
+
+def test_column_message():
+    from asyncipc.message import ColumnMessage
+    class Readings(ColumnMessage):
+        _fields = ['value', 'sensor', 't']
+        _columns = {'t': 'd', 'value': 'f'}
+    class MoreReadings(Readings):
+        _fields = ['count']
+        _columns = {'count': 'q'}
+    assert Readings._column_types == {'value': 'f', 't': 'd'}
+    assert MoreReadings._column_types == {'count': 'q', 'value': 'f', 't': 'd'}
+    with pytest.raises(TypeError):
+        class Unknown(ColumnMessage):
+            _fields = ['a']
+            _columns = {'b': 'd'}
+    with pytest.raises(TypeError):
+        class Invalid(ColumnMessage):
+            _fields = ['a']
+            _columns = {'a': 'x'}
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import socket
+from os import path
+
+import pytest
+from fixtures import *
+
+from asyncipc.message import message_types
+from asyncipc.metrics import GetMetrics, Histogram
+from asyncipc.server import Server
+
+
+def test_histogram():
+    hist = Histogram()
+    assert hist.snapshot()['p99'] == 0.0
+    for seconds in (1e-6, 3e-6, 3e-6, 1e-3, 2.0):
+        hist.observe(seconds)
+    snap = hist.snapshot()
+    assert snap['count'] == 5
+    assert snap['max'] == 2.0
+    assert snap['mean'] == pytest.approx(sum((1e-6, 3e-6, 3e-6, 1e-3, 2.0)) / 5)
+    assert snap['p50'] == 4e-6
+    assert snap['p99'] == 2.0
+    hist.observe(1e9)
+    assert hist.buckets[-1] == 1
+
+def test_metrics_disabled(sockpath):
+    serv = Server(sockpath, message_types)
+    assert serv.metrics is None
+    assert GetMetrics not in serv.observers
+
+def test_metrics_request(sockpath, event_loop):
+    from asyncipc.client import AsyncClient
+    serv = Server(sockpath, message_types, metrics=True,
+                  metrics_socket='adfasfz38-metrics')
+    seen = []
+    def fail(msg):
+        if msg.a < 0:
+            raise ValueError(msg.a)
+        seen.append(msg)
+    serv.register(Alpha, fail)
+    serv(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath) as client:
+            await client.send_many([Alpha(1, 2), Alpha(-1, 2), Alpha(3, 4)])
+            await client.send_batch([Beta(1, 2, 3), Alpha(5, 6)])
+            while len(seen) < 3:
+                await asyncio.sleep(0.005)
+            return await client.request(GetMetrics())
+    snap = event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    assert snap['connections'] == {'open': 1, 'total': 1}
+    assert snap['messages'] == {'Alpha': 4, 'Beta': 1, 'GetMetrics': 1}
+    assert snap['bytes']['in'] > 0
+    assert snap['decode']['count'] == 5  # frames, the batch counts once
+    assert snap['queue']['wait']['count'] == 5
+    assert snap['queue']['max_depth'] >= 1
+    stats = snap['observers']['Alpha/test_metrics_request.<locals>.fail']
+    assert stats['count'] == 5  # Beta is observed as an Alpha too
+    assert stats['failures'] == 1
+
+    def pull():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path.join(path.dirname(sockpath), 'adfasfz38-metrics'))
+        with sock, sock.makefile('rb') as f:
+            return json.load(f)
+    snap = event_loop.run_until_complete(event_loop.run_in_executor(None, pull))
+    assert snap['messages']['GetMetrics'] == 1
+    assert snap['bytes']['out'] > 0
+    event_loop.run_until_complete(serv.shutdown(0.1))
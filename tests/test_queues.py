@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+from fixtures import *
+
+from asyncipc.queues import MessageQueue, type_key
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+def test_priority_lanes():
+    queue = MessageQueue(10, priorities={'Beta': 5})
+    items = [(Alpha(1, 0), None), (Beta(2, 0, 0), None),
+             (Alpha(3, 0), None), ([Beta(4, 0, 0)], None)]
+    for item in items:
+        queue.put_nowait(item)
+    assert queue.qsize() == 4
+    assert drain(queue) == [items[1], items[3], items[0], items[2]]
+
+def test_empty_batch():
+    queue = MessageQueue(10, priorities={'Beta': 5})
+    queue.put_nowait(([], None))
+    assert drain(queue) == [([], None)]
+
+def test_coalesce_in_place():
+    queue = MessageQueue(10, coalesce_key=type_key)
+    a1, b1, a2 = (Alpha(1, 0), None), (Beta(2, 0, 0), None), (Alpha(3, 0), None)
+    request = (Alpha(4, 0), object())
+    queue.put_nowait(a1)
+    queue.put_nowait(b1)
+    assert queue.replace(a2) is a1
+    assert queue.replace(request) is None
+    assert queue.qsize() == 2
+    assert drain(queue) == [a2, b1]
+    assert queue.replace(a1) is None
+
+def test_drop_oldest_prefers_low_priority():
+    queue = MessageQueue(3, priorities={'Beta': 1})
+    items = [(Beta(1, 0, 0), None), (Alpha(2, 0), None), (Alpha(3, 0), None)]
+    for item in items:
+        queue.put_nowait(item)
+    assert queue.full()
+    assert queue.drop_oldest() is items[1]
+    assert drain(queue) == [items[0], items[2]]
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.drop_oldest()
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from fixtures import *
+
+from asyncipc.client import AsyncClient, Client
+from asyncipc.message import message_types
+from asyncipc.schema import Schema, SchemaError, fingerprint
+from asyncipc.serializer import FLAG_COMPACT, Serialize
+from asyncipc.server import Server
+
+
+def test_pack_unpack(msg_obj):
+    schema = Schema({'Beta': Beta, 'Alpha': Alpha})
+    assert schema.ids == {Alpha: 0, Beta: 1}
+    values = schema.pack(msg_obj)
+    assert values[0] == schema.ids[msg_obj.__class__]
+    assert schema.unpack(values).as_dict == msg_obj.as_dict
+    with pytest.raises(SchemaError):
+        schema.unpack((5, 1, 2))
+
+def test_fingerprints():
+    assert fingerprint(Alpha) == fingerprint(Alpha)
+    assert fingerprint(Alpha) != fingerprint(Beta)
+    server = Schema({'Alpha': Alpha, 'Beta': Beta})
+    client = Schema.from_table(server.table(), {'Beta': Beta})
+    assert client.ids == {Beta: 1}
+    assert client.fingerprints() == {'Beta': fingerprint(Beta)}
+    server.check({'Beta': fingerprint(Beta), 'Gamma': 1})
+    with pytest.raises(SchemaError, match='Alpha'):
+        server.check({'Alpha': 1})
+    with pytest.raises(SchemaError):
+        Schema.from_table([['Alpha', 1]], {'Alpha': Alpha})
+
+@pytest.mark.parametrize('formatter', ['json', 'msgpack', 'pickle'])
+def test_compact_frames(formatter):
+    serial = Serialize(formatters=[formatter], **message_types)
+    serial.adopt(serial.schema.table())
+    msg = Beta(3, 1, 2, x=4, y=5)
+    b_header, b_data = serial.dump_iter(msg, formatter)
+    header = serial.load(b_header)
+    assert header.flags & FLAG_COMPACT
+    assert header.data_loader(b_data).as_dict == msg.as_dict
+    verbose = Serialize(**message_types)
+    assert len(b_data) < len(list(verbose.dump_iter(msg, formatter))[1])
+
+    b_header, b_data = serial.dump_batch_iter([msg, Alpha(1, 2)], formatter)
+    header = serial.load(b_header)
+    assert [m.as_dict for m in header.data_loader(b_data)] == [
+        msg.as_dict, Alpha(1, 2).as_dict,
+    ]
+
+def test_compact_client(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    received = []
+    serv.register(Alpha, received.append)
+    serv.register(Beta, lambda msg: msg.c)
+    serv(event_loop)
+
+    def send():
+        with Client(sockpath, compact=True) as client:
+            client.send(Alpha(1, 2))
+            client.send_batch([Alpha(3, 4), Beta(5, 6, 7)])
+            return client.request(Beta(3, 1, 2))
+    result = event_loop.run_until_complete(event_loop.run_in_executor(None, send))
+    assert result == 3
+
+    async def run():
+        async with AsyncClient(sockpath, compact=True) as client:
+            assert await client.request(Beta(8, 1, 2)) == 8
+            assert client.serial.compact
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    run_until(event_loop, lambda: len(received) == 5)
+    assert [m.a for m in received] == [1, 3, 6, 1, 1]
+
+def test_mismatched_schema(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    serv(event_loop)
+
+    def connect():
+        client = Client(sockpath, compact=True)
+        client.serial.schema.fingerprints = lambda: {'Alpha': 1}
+        with pytest.raises(SchemaError, match='Alpha'):
+            client.connect()
+        assert client.sock is None
+    event_loop.run_until_complete(event_loop.run_in_executor(None, connect))
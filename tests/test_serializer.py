@@ -1,13 +1,15 @@
+from array import array
+
 import pytest
 from fixtures import *
 
-from asyncipc.message import BaseMessage, message_types
-from asyncipc.serializer import HeaderFormat, Serialize
+from asyncipc.message import BaseMessage, ColumnMessage, message_types
+from asyncipc.serializer import FLAG_COMPACT, HeaderFormat, Serialize, backends
 
 
 @pytest.fixture
 def serialize():
-    return Serialize(**message_types)
+    return Serialize(formatters=backends, **message_types)
 
 def test_dump_iter(msg_obj, serialize):
     assert len(list(serialize.dump_iter(msg_obj))) == 2
@@ -30,3 +32,182 @@ def test_loader_implemented(alpha, serialize):
     b_header = HeaderFormat.pack(b'blaas', 9000)
     with pytest.raises(NotImplementedError):
         serialize.load(b_header)
+
+def test_formatters_allowlist(alpha):
+    b_header, b_data = Serialize(**message_types).dump_iter(alpha, 'pickle')
+    with pytest.raises(ValueError):
+        Serialize(**message_types).load(b_header)
+    serialize = Serialize(formatters=['pickle'], **message_types)
+    assert serialize.load(b_header).data_loader(b_data).as_dict == alpha.as_dict
+    with pytest.raises(ValueError):
+        serialize.load(next(serialize.dump_iter(alpha, 'json')))
+
+class Gamma(BaseMessage):
+    _fields = ['a', 'b']
+    _kwfields = {'x': 1.5}
+    _struct = {'a': 'i', 'b': 'q', 'x': 'd'}
+
+class Delta(Gamma):
+    _fields = ['c']
+    _struct = {'c': 'H'}
+
+@pytest.mark.parametrize('formatter', ('json', 'pickle', 'msgpack'))
+def test_backends(msg_obj, serialize, formatter):
+    if formatter == 'msgpack':
+        pytest.importorskip('msgpack')
+    b_header, b_data = serialize.dump_iter(msg_obj, formatter=formatter)
+    header = serialize.load(b_header)
+    assert header.tag == formatter.encode()
+    assert header.data_loader(b_data).as_dict == msg_obj.as_dict
+
+@pytest.mark.parametrize('msg', (Gamma(1, 2), Delta(3, 1, 2, x=0.25)))
+def test_struct_backend(msg, serialize):
+    b_header, b_data = serialize.dump_iter(msg, formatter='struct')
+    assert serialize.load(b_header).data_loader(b_data).as_dict == msg.as_dict
+
+def test_struct_missing_format(alpha, serialize):
+    with pytest.raises(ValueError):
+        list(serialize.dump_iter(alpha, formatter='struct'))
+
+def test_json_unicode(serialize):
+    msg = Alpha('été', '☃')
+    b_header, b_data = serialize.dump_iter(msg)
+    assert b_data.decode('utf-8').count('☃') == 1
+    assert serialize.load(b_header).data_loader(b_data).as_dict == msg.as_dict
+
+def test_pickle_bytes(serialize):
+    msg = Alpha(b'\x00\xff', bytearray(b'ab'))
+    b_header, b_data = serialize.dump_iter(msg, formatter='pickle')
+    assert serialize.load(b_header).data_loader(b_data).as_dict == msg.as_dict
+
+def test_header_kind_and_msg_id(alpha, serialize):
+    from asyncipc.serializer import REQUEST
+    b_header, b_data = serialize.dump_iter(alpha, 'json', REQUEST, 2**32 - 1)
+    header = serialize.load(b_header)
+    assert (header.kind, header.msg_id) == (REQUEST, 2**32 - 1)
+
+def test_dump_value(serialize):
+    b_header, b_data = serialize.dump_iter({'answer': [4, 2]})
+    assert serialize.load(b_header).data_loader(b_data) == {'answer': [4, 2]}
+
+@pytest.mark.parametrize('formatter', ('json', 'pickle', 'struct'))
+def test_batch(serialize, formatter):
+    from asyncipc.serializer import BATCH
+    msgs = [Gamma(1, 2), Delta(3, 1, 2, x=0.5), Gamma(4, 5)]
+    b_header, b_data = serialize.dump_batch_iter(msgs, formatter)
+    header = serialize.load(b_header)
+    assert header.kind == BATCH
+    assert [m.as_dict for m in header.data_loader(b_data)] == [m.as_dict for m in msgs]
+
+def test_type_id_in_header(serialize):
+    from asyncipc.schema import type_id
+    header = serialize.load(next(serialize.dump_iter(Alpha(1, 2))))
+    assert header.type_id == type_id('Alpha')
+    assert serialize.type_ids[header.type_id] is Alpha
+    assert serialize.load(next(serialize.dump_iter('reply'))).type_id == 0
+    b_header = next(serialize.dump_batch_iter([Beta(1, 2, 3), Beta(4, 5, 6)]))
+    assert serialize.load(b_header).type_id == type_id('Beta')
+    b_header = next(serialize.dump_batch_iter([Beta(1, 2, 3), Alpha(4, 5)]))
+    assert serialize.load(b_header).type_id == 0
+
+def test_lazy_message(serialize):
+    from asyncipc.serializer import LazyMessage
+    b_header, b_data = serialize.dump_iter(Beta(3, 1, 2))
+    msg = LazyMessage(Beta, serialize.load(b_header), b_data)
+    assert msg.__class__ is Beta and isinstance(msg, Alpha)
+    assert msg._message is None
+    assert msg.c == 3 and msg.as_dict == Beta(3, 1, 2).as_dict
+
+@pytest.mark.parametrize('formatter', ('json', 'pickle', 'msgpack'))
+def test_cached_encoders(msg_obj, serialize, formatter):
+    import json
+    if formatter == 'msgpack':
+        pytest.importorskip('msgpack')
+    frame = list(serialize.dump_iter(msg_obj, formatter))
+    entry = serialize._encoders[msg_obj.__class__, formatter]
+    assert list(serialize.dump_iter(msg_obj, formatter)) == frame
+    assert serialize._encoders[msg_obj.__class__, formatter] is entry
+    assert serialize.load(frame[0]).data_loader(frame[1]).as_dict == msg_obj.as_dict
+    if formatter == 'json':
+        name = msg_obj.__class__.__name__
+        assert json.loads(frame[1]) == [name, msg_obj.as_dict]
+    serialize.adopt(serialize.schema.table())
+    assert not serialize._encoders
+    header = serialize.load(next(serialize.dump_iter(msg_obj, formatter)))
+    assert header.flags & FLAG_COMPACT
+
+class Samples(ColumnMessage):
+    _fields = ['sensor', 't', 'value']
+    _kwfields = {'unit': 'C'}
+    _columns = {'t': 'd', 'value': 'i'}
+
+def column_values(column):
+    "Return the values of a column decoded as a memoryview or a numpy array"
+    return memoryview(column).tolist()
+
+@pytest.mark.parametrize('values, expected', (
+    ([1, -2, 3], [1, -2, 3]),
+    (array('i', [1, -2, 3]), [1, -2, 3]),
+    (memoryview(array('i', [1, -2, 3])), [1, -2, 3]),
+    (array('h', [1, -2, 3]), [1, -2, 3]),
+    ((x for x in (1, -2, 3)), [1, -2, 3]),
+    ([], []),
+))
+def test_column_backend(serialize, values, expected):
+    t = array('d', [0.5, 1.5, 2.5][:len(expected)])
+    msg = Samples('s1', t, values)
+    b_header, b_data = serialize.dump_iter(msg, 'columns')
+    loaded = serialize.load(b_header).data_loader(b_data)
+    assert (loaded.sensor, loaded.unit) == ('s1', 'C')
+    assert column_values(loaded.t) == t.tolist()
+    assert column_values(loaded.value) == expected
+
+def test_column_backend_zero_copy(serialize):
+    msg = Samples('s1', array('d', range(1000)), array('i', range(1000)))
+    b_header, b_data = serialize.dump_iter(msg, 'columns')
+    load = serialize.load(b_header).data_loader
+    # Columns of a read-only body are views into it
+    loaded = load(b_data)
+    assert memoryview(loaded.t).obj is b_data
+    # A writable body is a reused receive buffer, so it is copied first
+    body = bytearray(b_data)
+    loaded = load(body)
+    body[:] = bytes(len(body))
+    assert column_values(loaded.value) == list(range(1000))
+
+def test_column_backend_batch(serialize):
+    msgs = [Samples(f's{x}', [x] * x, range(x), unit='K') for x in range(5)]
+    b_header, b_data = serialize.dump_batch_iter(msgs, 'columns')
+    assert len(b_data) % 8 == 0
+    loaded = serialize.load(b_header).data_loader(b_data)
+    assert [(m.sensor, m.unit) for m in loaded] == [(f's{x}', 'K') for x in range(5)]
+    assert [column_values(m.t) for m in loaded] == [[float(x)] * x for x in range(5)]
+    assert [column_values(m.value) for m in loaded] == [list(range(x)) for x in range(5)]
+
+def test_column_backend_shm():
+    serialize = Serialize(shm_threshold=0, **message_types)
+    msg = Samples('s1', array('d', range(10000)), range(10000))
+    b_header, b_data = serialize.dump_iter(msg, 'columns')
+    loaded = serialize.load(b_header).data_loader(b_data)
+    assert column_values(loaded.t) == list(range(10000))
+
+def test_column_backend_mismatch(serialize):
+    with pytest.raises(TypeError):
+        list(serialize.dump_iter(Alpha(1, 2), 'columns'))
+    b_header, b_data = serialize.dump_iter(Samples('s1', [1.0], [1]), 'columns')
+    class Samples2(ColumnMessage):
+        _fields = ['sensor', 't', 'value']
+        _kwfields = {'unit': 'C'}
+        _columns = {'t': 'd', 'value': 'q'}
+    types = dict(message_types, Samples=Samples2)
+    with pytest.raises(ValueError):
+        Serialize(**types).load(b_header).data_loader(b_data)
+
+def test_column_backend_numpy(serialize):
+    numpy = pytest.importorskip('numpy')
+    t = numpy.linspace(0, 1, 50)
+    msg = Samples('s1', t, numpy.arange(50, dtype=numpy.intc))
+    b_header, b_data = serialize.dump_iter(msg, 'columns')
+    loaded = serialize.load(b_header).data_loader(b_data)
+    assert isinstance(loaded.t, numpy.ndarray)
+    assert (loaded.t == t).all() and loaded.value.sum() == sum(range(50))
@@ -1,9 +1,10 @@
 import asyncio
 import logging
+import os
 
 from fixtures import *
 
-from asyncipc.message import message_types
+from asyncipc.message import BaseMessage, message_types
 from asyncipc.server import Server
 
 logr = logging.getLogger()
@@ -29,7 +30,7 @@ class Recorder2:
     def callback(self, future):
         self.future = future
 
-def test_send_msg(send_msg, sockpath, alpha):
+def test_send_msg(send_msg, sockpath, alpha, event_loop):
     serv = Server(sockpath, message_types)
     fn = Recorder()
     fn2 = Recorder2()
@@ -37,13 +38,512 @@ def test_send_msg(send_msg, sockpath, alpha):
     serv.register(alpha.__class__, fn)
     serv.register(alpha.__class__, fn2, fn2.callback)
     # serv.register(alpha.__class__, somefunc)
-    loop = asyncio.get_event_loop()
+    loop = event_loop
     serv(loop)
-    loop.call_later(2.0, send_msg(alpha))
-    loop.call_later(4.0, loop.stop)
-    loop.run_forever()
+    loop.run_until_complete(loop.run_in_executor(None, send_msg(alpha)))
+    run_until(loop, lambda: fn2.msg is not None and hasattr(fn2, 'future'))
     dalpha = alpha.as_dict
     assert fn.msg.as_dict == dalpha
     assert fn2.future.result().as_dict == dalpha
     assert fn2.msg.as_dict == dalpha
     
+
+@pytest.mark.parametrize('count', (3, 200))
+def test_persistent_connection(sockpath, event_loop, msg_obj, count):
+    from asyncipc.client import Client
+    serv = Server(sockpath, message_types)
+    received = []
+    serv.register(msg_obj.__class__, received.append)
+    serv(event_loop)
+    client = Client(sockpath)
+    def send_all():
+        for _ in range(count):
+            client.send(msg_obj)
+    event_loop.call_soon(send_all)
+    run_until(event_loop, lambda: len(received) == count)
+    client.close()
+    assert [x.as_dict for x in received] == [msg_obj.as_dict] * count
+
+def test_request_reply(sockpath, event_loop):
+    from asyncipc.client import AsyncClient, RemoteError
+    serv = Server(sockpath, message_types)
+
+    async def add(msg):
+        await asyncio.sleep(0.01 * (msg.a % 3))
+        return msg.a + msg.b
+    serv.register(Alpha, add)
+    serv.register(Alpha, lambda msg: 'ignored')
+    serv.register(Beta, lambda msg: Alpha(msg.c, msg.a))
+    serv(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath) as client:
+            sums = await asyncio.gather(
+                *(client.request(Alpha(i, 10)) for i in range(20)))
+            assert sums == [i + 10 for i in range(20)]
+            reply = await client.request(Beta(3, 1, 2))
+            assert reply.as_dict == Alpha(3, 1).as_dict
+            with pytest.raises(RemoteError):
+                await client.request(Alpha('a', 1))
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+
+def test_inline_observers(sockpath):
+    from asyncipc.client import AsyncClient, RemoteError
+    from asyncipc.server import new_event_loop
+    loop = new_event_loop()
+    serv = Server(sockpath, message_types, inline=True, metrics=True)
+    order, done = [], []
+
+    async def slow(msg):
+        await asyncio.sleep(0.01)
+        order.append('async')
+    def add(msg):
+        order.append('inline')
+        return msg.a + msg.b
+    def fail(msg):
+        raise ValueError(msg.c)
+    serv.register(Alpha, add, callback=done.append)
+    serv.register(Alpha, slow)
+    serv.register(Beta, fail)
+    assert [obs.inline for obs in serv.observers[Alpha]] == [True, False]
+    serv(loop)
+
+    async def run():
+        async with AsyncClient(sockpath) as client:
+            assert await client.request(Alpha(1, 2)) == 3
+            with pytest.raises(RemoteError, match='ValueError'):
+                await client.request(Beta(3, 2, 2))
+        while len(order) < 4:
+            await asyncio.sleep(0.005)
+    try:
+        loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    finally:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+    assert order == ['inline', 'inline', 'async', 'async']
+    assert [future.result() for future in done] == [3, 4]
+    stats = serv.metrics_snapshot()['observers']
+    assert stats['Beta/test_inline_observers.<locals>.fail']['failures'] == 1
+
+def test_request_without_observer(sockpath, event_loop):
+    from asyncipc.client import AsyncClient, RemoteError
+    serv = Server(sockpath, message_types)
+    serv(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath) as client:
+            with pytest.raises(RemoteError, match='no observers'):
+                await client.request(Alpha(1, 2))
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+
+def test_batch_observers(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    batches, singles = [], []
+    serv.register(Alpha, batches.append, batch=True)
+    serv.register(Alpha, singles.append)
+    serv.register(Beta, batches.append, batch=True)
+    serv(event_loop)
+    msgs = [Alpha(1, 2), Beta(3, 1, 2), Alpha(3, 4)]
+    def send():
+        with Client(sockpath) as client:
+            client.send_batch(msgs)
+            client.send(Alpha(5, 6))
+    event_loop.call_soon(send)
+    run_until(event_loop, lambda: len(batches) == 4 and len(singles) == 4)
+    # Beta is also delivered to the observers of its base class Alpha
+    assert [[m.a for m in batch] for batch in batches] == [[1, 3], [1], [1], [5]]
+    assert [m.a for m in singles] == [1, 3, 1, 5]
+
+def test_dispatch_by_class(sockpath, event_loop):
+    from asyncipc.message import BaseMessage
+    serv = Server(sockpath, message_types)
+    class Late(Beta):
+        pass
+    seen = []
+    alpha_obs = serv.register('Alpha', lambda msg: seen.append(('alpha', msg.a)))
+    serv.register(Late, lambda msg: seen.append(('late', msg.a)))
+    assert [o.fn for o in serv.observers_for(Late)][1] is alpha_obs.fn
+    assert serv.observers_for(Beta) == (alpha_obs,)
+    serv(event_loop)
+    def send():
+        with Client(sockpath) as client:
+            client.send_many([Alpha(1, 2), Beta(3, 2, 2), Late(4, 3, 3)])
+    event_loop.call_soon(send)
+    run_until(event_loop, lambda: len(seen) == 4)
+    assert seen == [('alpha', 1), ('alpha', 2), ('late', 3), ('alpha', 3)]
+
+    serv.unregister(Alpha, alpha_obs)
+    assert serv.observers_for(Beta) == ()
+    assert len(serv.observers_for(Late)) == 1
+    with pytest.raises(ValueError):
+        serv.unregister(Alpha, alpha_obs)
+    with pytest.raises(ValueError, match='Unknown message type'):
+        serv.register('NoSuchType', print)
+
+class Unobserved(BaseMessage):
+    _fields = ['a']
+
+def test_frame_handling(sockpath, event_loop):
+    from asyncipc.schema import type_id
+    from asyncipc.serializer import HeaderFormat, LazyMessage
+    serv = Server(sockpath, message_types, metrics=True)
+    serv.serial.add_type(Unobserved)
+    lazy, eager = [], []
+    serv.register(Alpha, lazy.append, lazy=True)
+    assert serv.frame_handling(Alpha) == 'lazy'
+    assert serv.frame_handling(Unobserved) == 'drop'
+    serv(event_loop)
+    def send():
+        with Client(sockpath) as client:
+            # Never decoded, or this wouldn't get through
+            client.sock.sendall(
+                HeaderFormat.pack(b'json', 3, type_id=type_id('Unobserved')) + b'{{{'
+            )
+            client.send_many([Unobserved(1), Alpha(1, 2), Beta(3, 1, 2)])
+    event_loop.call_soon(send)
+    run_until(event_loop, lambda: len(lazy) == 2)
+    assert serv.metrics.unobserved == 2
+    assert all(type(msg) is LazyMessage and msg._message is None for msg in lazy)
+    assert isinstance(lazy[1], Beta)
+    assert [msg.a for msg in lazy] == [1, 1]
+
+    serv.register(Beta, eager.append)
+    assert serv.frame_handling(Beta) == 'decode'
+    event_loop.call_soon(send)
+    run_until(event_loop, lambda: len(eager) == 1 and len(lazy) == 4)
+    assert type(lazy[2]) is LazyMessage and type(lazy[3]) is Beta
+    assert eager == lazy[3:]
+
+class Tracker:
+    "Async observer recording how many calls run at the same time"
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.running = self.max_running = 0
+        self.seen = []
+
+    async def __call__(self, msg):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay * (msg.a % 3))
+        self.seen.append(msg.a)
+        self.running -= 1
+        return msg.a
+
+@pytest.mark.parametrize('kwargs,limit', (
+    ({'concurrency': 3}, 3),
+    ({'ordered': True}, 1),
+))
+def test_bounded_observers(sockpath, event_loop, kwargs, limit):
+    serv = Server(sockpath, message_types)
+    tracker = Tracker()
+    results = []
+    serv.register(Alpha, tracker, lambda fut: results.append(fut.result()), **kwargs)
+    serv(event_loop)
+    msgs = [Alpha(i, 0) for i in range(30)]
+    event_loop.call_soon(send_msg_many(sockpath, msgs))
+    run_until(event_loop, lambda: len(results) == 30)
+    assert tracker.max_running == limit
+    assert sorted(results) == list(range(30))
+    if limit == 1:
+        assert tracker.seen == list(range(30))
+
+def test_executor_observer(sockpath, event_loop):
+    import time
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    serv = Server(sockpath, message_types)
+    threads = set()
+    def blocking(msg):
+        time.sleep(0.05)
+        threads.add(threading.get_ident())
+        return msg.a
+    ticks = []
+    async def ticker():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0.005)
+    results = []
+    with ThreadPoolExecutor(4) as executor:
+        serv.register(Alpha, blocking, lambda fut: results.append(fut.result()),
+                      concurrency=4, executor=executor)
+        serv(event_loop)
+        event_loop.create_task(ticker())
+        event_loop.call_soon(send_msg_many(sockpath, [Alpha(i, 0) for i in range(8)]))
+        run_until(event_loop, lambda: len(results) == 8)
+    assert threading.get_ident() not in threads
+    assert sorted(results) == list(range(8))
+    assert len(ticks) > 5
+
+class FakeProtocol:
+    def __init__(self):
+        self.errors = []
+
+    def send_error(self, text, msg_id=0):
+        self.errors.append((text, msg_id))
+
+
+class FakeReply:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, text):
+        self.errors.append(text)
+
+    def __call__(self, future):
+        pass
+
+
+@pytest.mark.parametrize('overload,expected,accepted,errors', (
+    ('block', [0, 1], False, 0),
+    ('drop-newest', [0, 1], True, 0),
+    ('drop-oldest', [1, 2], True, 0),
+    ('reject', [0, 1], True, 1),
+))
+def test_overload_policies(sockpath, overload, expected, accepted, errors):
+    serv = Server(sockpath, message_types, maxsize=2, overload=overload)
+    proto = FakeProtocol()
+    for i in range(2):
+        assert serv.offer((Alpha(i, 0), None), proto)
+    assert serv.offer((Alpha(2, 0), None), proto) is accepted
+    queued = [serv.messages.get_nowait()[0].a for _ in range(2)]
+    assert queued == expected
+    assert len(proto.errors) == errors
+
+def test_overload_coalesce(sockpath):
+    serv = Server(sockpath, message_types, maxsize=2, overload='coalesce')
+    proto = FakeProtocol()
+    serv.offer((Alpha(0, 0), None), proto)
+    serv.offer((Beta(1, 0, 0), None), proto)
+    assert serv.offer((Alpha(2, 0), None), proto)
+    assert not serv.offer((Alpha(3, 0), FakeReply()), proto)
+    assert [serv.messages.get_nowait()[0].a for _ in range(2)] == [2, 0]
+
+class Reading(BaseMessage):
+    _fields = ['sensor', 'value']
+    _coalesce = ['sensor']
+
+class SlowReading(Reading):
+    _debounce = 0.05
+
+def test_coalesce_by_key(sockpath):
+    serv = Server(sockpath, message_types, maxsize=10, metrics=True)
+    proto = FakeProtocol()
+    for item in [(Reading('a', 1), None), (Alpha(0, 0), None),
+                 (Reading('b', 2), None), (Reading('a', 3), None),
+                 (Reading('a', 4), FakeReply())]:
+        assert serv.offer(item, proto)
+    queued = [serv.messages.get_nowait()[0] for _ in range(serv.messages.qsize())]
+    assert [msg.as_dict for msg in queued] == [
+        Reading('a', 3).as_dict, Alpha(0, 0).as_dict,
+        Reading('b', 2).as_dict, Reading('a', 4).as_dict,
+    ]
+    # Once taken off the queue a message can't be replaced any more
+    serv.offer((Reading('a', 5), None), proto)
+    assert serv.messages.qsize() == 1
+    assert serv.metrics.coalesced == 1
+
+def test_unhashable_coalesce_key(sockpath):
+    serv = Server(sockpath, message_types, maxsize=10)
+    for item in [(Reading(['a'], 1), None), (Reading(['a'], 2), None)]:
+        assert serv.offer(item, FakeProtocol())
+    assert serv.offer((SlowReading(['a'], 3), None), FakeProtocol())
+    assert not serv._held
+    queued = [serv.messages.get_nowait()[0].value for _ in range(3)]
+    assert queued == [1, 2, 3]
+
+def test_debounce(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    received = []
+    serv.register(Reading, received.append)
+    serv(event_loop)
+    async def offer():
+        for value in range(5):
+            serv.offer((SlowReading('a', value), None), FakeProtocol())
+        serv.offer((SlowReading('b', 0), None), FakeProtocol())
+    event_loop.run_until_complete(offer())
+    assert serv.messages.empty()
+    run_until(event_loop, lambda: len(received) == 2)
+    assert [(msg.sensor, msg.value) for msg in received] == [('a', 4), ('b', 0)]
+    assert not serv._held
+
+def test_bad_coalesce_declaration():
+    with pytest.raises(TypeError, match='unknown'):
+        class Bad(BaseMessage):
+            _fields = ['a']
+            _coalesce = ['b']
+    with pytest.raises(TypeError, match='_coalesce'):
+        class Bad(BaseMessage):
+            _fields = ['a']
+            _debounce = 1.0
+
+def test_overloaded_request_gets_error(sockpath):
+    serv = Server(sockpath, message_types, maxsize=1, overload='drop-newest')
+    reply = FakeReply()
+    serv.offer((Alpha(0, 0), None), FakeProtocol())
+    serv.offer((Alpha(1, 0), reply), FakeProtocol())
+    assert reply.errors == ['Server is overloaded']
+
+def test_unknown_overload_policy(sockpath):
+    with pytest.raises(ValueError):
+        Server(sockpath, message_types, overload='nope')
+
+def test_shared_memory_transport(sockpath, event_loop):
+    from asyncipc.client import AsyncClient
+    serv = Server(sockpath, message_types, shm_threshold=10000)
+    serv.register(Alpha, lambda msg: msg.a * 2)
+    serv(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath, shm_threshold=10000) as client:
+            return await client.request(Alpha('y' * 100000, 1))
+    reply = event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    assert reply == 'y' * 200000
+    assert not [x for x in os.listdir(RUNTIME_DIR) if x.startswith('asyncipc-shm-')]
+
+def test_unobserved_shared_memory_frames(sockpath, event_loop):
+    from asyncipc.client import AsyncClient
+    serv = Server(sockpath, message_types)
+    serv.register(Beta, lambda msg: msg.c)
+    serv(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath, shm_threshold=10000) as client:
+            await client.send(Alpha('z' * 100000, 0))
+            return await client.request(Beta(1, 1, 1))
+    assert event_loop.run_until_complete(asyncio.wait_for(run(), 2.0)) == 1
+    assert not [x for x in os.listdir(RUNTIME_DIR) if x.startswith('asyncipc-shm-')]
+
+def test_refuses_unlisted_formatters(sockpath, event_loop):
+    from asyncipc.client import Client
+    serv = Server(sockpath, message_types)
+    received = []
+    serv.register(Alpha, received.append)
+    serv(event_loop)
+
+    def send():
+        with Client(sockpath) as client:
+            client.send(Alpha(1, 2), 'pickle')
+            client.request(Alpha(3, 4))
+    with pytest.raises(OSError):
+        event_loop.run_until_complete(event_loop.run_in_executor(None, send))
+    assert not received
+    serv.listener.close()
+
+    serv = Server(sockpath, message_types, formatters=['json', 'pickle'])
+    serv.register(Alpha, received.append)
+    serv(event_loop)
+    event_loop.run_until_complete(event_loop.run_in_executor(None, send))
+    assert [msg.a for msg in received] == [1, 3]
+
+def test_max_frame_size(sockpath, event_loop):
+    from asyncipc.client import Client
+    serv = Server(sockpath, message_types, max_frame_size=1000)
+    received = []
+    serv.register(Alpha, received.append)
+    serv(event_loop)
+
+    def send(msg):
+        with Client(sockpath) as client:
+            client.send(msg)
+            client.request(Alpha(3, 4))
+    with pytest.raises(OSError):
+        event_loop.run_until_complete(
+            event_loop.run_in_executor(None, send, Alpha('x' * 2000, 1)))
+    event_loop.run_until_complete(event_loop.run_in_executor(None, send, Alpha(1, 2)))
+    assert [msg.a for msg in received] == [1, 3]
+
+def test_bounded_inbox(sockpath, event_loop):
+    serv = Server(sockpath, message_types, maxsize=2, overload='drop-newest')
+    received = []
+    async def slow(msg):
+        await release.wait()
+        received.append(msg.a)
+    obs = serv.register(Alpha, slow, concurrency=1)
+    serv(event_loop)
+
+    async def offer():
+        for i in range(10):
+            serv.offer((Alpha(i, 0), None), FakeProtocol())
+            await asyncio.sleep(0.01)
+            assert obs.inbox.qsize() <= 1
+        release.set()
+    release = asyncio.Event()
+    event_loop.run_until_complete(offer())
+    run_until(event_loop, lambda: len(received) >= 5)
+    event_loop.run_until_complete(asyncio.sleep(0.05))
+    # One message running, one in the inbox, one held back waiting for
+    # room in it and two in the server's queue
+    assert received == [0, 1, 2, 3, 4]
+
+def test_full_inbox_holds_back_only_its_messages(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    serv.serial.add_type(Unobserved)
+    slow_received, others = [], []
+    async def slow(msg):
+        await release.wait()
+        slow_received.append(msg.a)
+    obs = serv.register(Alpha, slow, ordered=True)
+    serv.register(Unobserved, others.append)
+    serv(event_loop)
+    release = asyncio.Event()
+
+    for i in range(2):
+        serv.offer((Alpha(i, 0), None), FakeProtocol())
+    serv.offer((Unobserved(9), None), FakeProtocol())
+    run_until(event_loop, lambda: others)
+    assert obs.full() and not slow_received
+    release.set()
+    run_until(event_loop, lambda: len(slow_received) == 2)
+
+@pytest.mark.parametrize('overflow, expected', (
+    ('drop-newest', [0, 1]),
+    ('drop-oldest', [0, 4]),
+))
+def test_observer_overflow(sockpath, event_loop, overflow, expected):
+    serv = Server(sockpath, message_types)
+    serv.serial.add_type(Unobserved)
+    received, others = [], []
+    async def slow(msg):
+        await release.wait()
+        received.append(msg.a)
+    obs = serv.register(Alpha, slow, ordered=True, overflow=overflow)
+    serv.register(Unobserved, others.append)
+    serv(event_loop)
+    release = asyncio.Event()
+
+    reply = FakeReply()
+    serv.offer((Alpha(0, 0), None), FakeProtocol())
+    run_until(event_loop, lambda: obs.inbox is not None and not obs.inbox.qsize())
+    for i in range(1, 4):
+        serv.offer((Alpha(i, 0), None), FakeProtocol())
+    serv.offer((Alpha(4, 0), reply), FakeProtocol())
+    serv.offer((Unobserved(9), None), FakeProtocol())
+    run_until(event_loop, lambda: others)
+    assert obs.dropped == 3
+    assert reply.errors == ([] if overflow == 'drop-oldest' else ['Observer is overloaded'])
+    release.set()
+    run_until(event_loop, lambda: len(received) == 2)
+    assert received == expected
+
+def test_unknown_overflow_policy(sockpath):
+    serv = Server(sockpath, message_types)
+    with pytest.raises(ValueError):
+        serv.register(Alpha, print, concurrency=1, overflow='nope')
+
+def test_empty_batch(sockpath, event_loop):
+    from asyncipc.client import Client
+    serv = Server(sockpath, message_types)
+    received = []
+    serv.register(Alpha, received.append)
+    serv(event_loop)
+
+    def send():
+        with Client(sockpath) as client:
+            client.send_batch([])
+            client.request(Alpha(1, 2))
+    event_loop.run_until_complete(event_loop.run_in_executor(None, send))
+    assert [msg.a for msg in received] == [1]
+    assert serv.messages.empty()
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+from fixtures import *
+
+from asyncipc import shm
+from asyncipc.message import message_types
+from asyncipc.serializer import FLAG_SHM, Serialize
+
+
+@pytest.mark.parametrize('data', (b'', b'abc', bytes(range(256)) * 4096))
+def test_segment_roundtrip(data):
+    handle = shm.write_segment(data)
+    path = os.path.join(RUNTIME_DIR, handle.decode())
+    assert os.path.exists(path)
+    with shm.open_segment(handle) as view:
+        assert view == data
+    assert not os.path.exists(path)
+
+@pytest.mark.parametrize('handle', (b'../etc/passwd', b'asyncipc-shm-/../x', b'other'))
+def test_invalid_handle(handle):
+    with pytest.raises(ValueError):
+        with shm.open_segment(handle):
+            pass
+
+def test_discard_segment():
+    handle = shm.write_segment(b'abc')
+    shm.discard_segment(handle)
+    assert not os.path.exists(os.path.join(RUNTIME_DIR, handle.decode()))
+    # Already gone
+    shm.discard_segment(handle)
+    with pytest.raises(ValueError):
+        shm.discard_segment(b'../etc/passwd')
+
+@pytest.mark.parametrize('formatter', ('json', 'pickle'))
+def test_serialize_through_shm(formatter):
+    serial = Serialize(shm_threshold=1000, formatters=[formatter], **message_types)
+    small, big = Alpha(1, 2), Alpha('x' * 5000, 2)
+    b_header, b_data = serial.dump_iter(small, formatter)
+    assert not serial.load(b_header).flags & FLAG_SHM
+    b_header, b_data = serial.dump_iter(big, formatter)
+    header = serial.load(b_header)
+    assert header.flags & FLAG_SHM
+    assert len(b_data) < 100
+    assert header.data_loader(b_data).as_dict == big.as_dict
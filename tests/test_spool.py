@@ -0,0 +1,158 @@
+import asyncio
+import os
+
+import pytest
+from fixtures import *
+
+from asyncipc.client import AsyncClient, Client
+from asyncipc.message import message_types
+from asyncipc.serializer import Serialize
+from asyncipc.server import Server
+from asyncipc.spool import Spool
+
+
+def test_append_and_reopen(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=4096)
+    seqs = [spool.append(b'record %d' % i * 20) for i in range(500)]
+    assert seqs == list(range(500))
+    assert len(os.listdir(tmp_path)) > 3
+    for seq, data in spool.pending():
+        assert data == b'record %d' % seq * 20
+        if seq != 7 and seq < 400:
+            spool.done(seq)
+    spool.close()
+
+    # Only the oldest record not done is kept track of across restarts
+    spool = Spool(str(tmp_path), segment_size=4096)
+    assert [seq for seq, _ in spool.pending()] == list(range(7, 500))
+    assert spool.append(b'more') == 500
+    for seq in range(7, 400):
+        spool.done(seq)
+    spool.sync()
+    # Segments of done records are deleted
+    assert [seq for seq, _ in spool.pending()][0] == 400
+    assert len(os.listdir(tmp_path)) < 8
+    spool.close()
+
+def test_torn_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(b'first')
+    spool.append(b'second')
+    spool._map[20] ^= 0xff  # Corrupt the second record
+    spool.close()
+    spool = Spool(str(tmp_path))
+    assert list(spool.pending()) == [(0, b'first')]
+    assert spool.append(b'third') == 1
+
+def test_retention(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=1024, max_bytes=4096)
+    for i in range(100):
+        spool.append(b'x' * 100)
+    pending = [seq for seq, _ in spool.pending()]
+    assert pending[-1] == 99
+    assert 0 < len(pending) <= 40
+    assert len(spool) == len(pending)
+
+def test_server_replays_spool(sockpath, event_loop, tmp_path):
+    # Frames a server spooled but never dispatched before it died
+    spool_dir = str(tmp_path / 'server')
+    spool = Spool(spool_dir)
+    serial = Serialize(**message_types)
+    for i in range(5):
+        spool.append(b''.join(serial.dump_iter(Alpha(i, 0), 'json')))
+    spool.append(b''.join(serial.dump_batch_iter([Alpha(5, 0), Beta(6, 0, 0)], 'msgpack')))
+    spool.close()
+
+    # More spooled messages than fit in the queue
+    serv = Server(sockpath, message_types, spool=spool_dir, maxsize=2)
+    received = []
+    serv.register(Alpha, received.append)
+    serv(event_loop)
+
+    def send():
+        with Client(sockpath) as client:
+            client.send(Alpha(7, 0))
+    # New messages only arrive once the old ones are queued
+    event_loop.run_until_complete(event_loop.run_in_executor(None, send))
+    run_until(event_loop, lambda: len(received) == 8)
+    assert [m.a for m in received] == [0, 1, 2, 3, 4, 5, 0, 7]
+    run_until(event_loop, lambda: not len(serv.spool))
+    serv.spool.close()
+    assert not list(Spool(spool_dir).pending())
+
+def test_client_spools_while_server_is_down(sockpath, event_loop, tmp_path):
+    if os.path.exists(sockpath):
+        os.unlink(sockpath)
+    spool_dir = str(tmp_path / 'client')
+    with Client(sockpath, spool=spool_dir) as client:
+        client.send(Alpha(1, 0))
+        client.send_batch([Alpha(2, 0), Alpha(3, 0)])
+
+    serv = Server(sockpath, message_types)
+    received = []
+    serv.register(Alpha, received.append)
+    serv(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath, spool=spool_dir) as client:
+            await client.send(Alpha(4, 0))
+        while len(received) < 4:
+            await asyncio.sleep(0.005)
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    assert [m.a for m in received] == [1, 2, 3, 4]
+    assert not list(Spool(spool_dir).pending())
+
+def test_done_once_handled(sockpath, event_loop, tmp_path):
+    serv = Server(sockpath, message_types, spool=str(tmp_path))
+    started, handled = [], []
+    async def slow(msg):
+        started.append(msg)
+        await release.wait()
+        handled.append(msg)
+    serv.register(Alpha, slow)
+    serv.register(Alpha, lambda msg: None, concurrency=1)
+    serv(event_loop)
+    release = asyncio.Event()
+
+    def send():
+        with Client(sockpath) as client:
+            client.send(Alpha(1, 0))
+    event_loop.run_until_complete(event_loop.run_in_executor(None, send))
+    run_until(event_loop, lambda: started)
+    event_loop.run_until_complete(asyncio.sleep(0.05))
+    assert len(serv.spool) == 1
+    release.set()
+    run_until(event_loop, lambda: handled and not len(serv.spool))
+    serv.spool.close()
+
+class BreakingSocket:
+    "Fake socket taking limit bytes, then failing like a closed connection"
+    def __init__(self, limit):
+        self.limit = limit
+
+    def sendmsg(self, buffers):
+        nbytes = min(self.limit, sum(len(x) for x in buffers))
+        if not nbytes:
+            raise BrokenPipeError
+        self.limit -= nbytes
+        return nbytes
+
+    def close(self):
+        pass
+
+def test_client_spools_unsent_frames(tmp_path):
+    serial = Serialize(**message_types)
+    msgs = [Alpha(i, 0) for i in range(3)]
+    frame_size = len(b''.join(serial.dump_iter(msgs[0], 'json')))
+    client = Client('unused', spool=str(tmp_path))
+    # The first frame is sent, the second in part
+    client.sock = BreakingSocket(frame_size + 5)
+    client.send_many(msgs)
+    assert client.sock is None
+    frames = [frame for _, frame in client.spool.pending()]
+    loaded = []
+    for frame in frames:
+        header = serial.load(frame)
+        loaded.append(header.data_loader(frame[serial.header_length:]))
+    assert [m.a for m in loaded] == [1, 2]
+    client.spool.close()
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+from fixtures import *
+
+from asyncipc.client import AsyncClient, Client
+from asyncipc.message import message_types
+from asyncipc.serializer import CHUNK, Serialize
+from asyncipc.server import Server
+from asyncipc.streams import Stream
+
+
+def chunked(data, size=1 << 16):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+class Digest:
+    "Stream observer hashing the body and watching how much is buffered"
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.digests = []
+        self.max_buffered = 0
+        self.message = None
+        self.error = None
+
+    async def __call__(self, stream):
+        self.message = stream.message
+        digest = hashlib.sha256()
+        try:
+            async for chunk in stream:
+                self.max_buffered = max(self.max_buffered, len(stream._chunks))
+                digest.update(chunk)
+                await asyncio.sleep(self.delay)
+        except ConnectionError as e:
+            self.error = e
+            return
+        self.digests.append(digest.hexdigest())
+
+def test_chunk_frames():
+    serial = Serialize(**message_types)
+    b_header, b_data = serial.dump_chunk_iter(7, b'abc')
+    header = serial.load(b_header)
+    assert (header.kind, header.msg_id) == (CHUNK, 7)
+    assert header.data_loader(memoryview(b_data)) == b'abc'
+
+def test_blocking_stream(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    digest = Digest()
+    serv.register(Alpha, digest)
+    serv(event_loop)
+    data = os.urandom(1 << 22)
+
+    def send():
+        with Client(sockpath) as client:
+            client.send_stream(Alpha(1, 2), chunked(data))
+            client.send_stream(Alpha(3, 4), [b'', b'small'])
+    event_loop.run_until_complete(event_loop.run_in_executor(None, send))
+    run_until(event_loop, lambda: len(digest.digests) == 2)
+    assert digest.digests == [
+        hashlib.sha256(data).hexdigest(), hashlib.sha256(b'small').hexdigest(),
+    ]
+    assert digest.message.as_dict == Alpha(3, 4).as_dict
+
+def test_slow_observer_bounds_memory(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    digest = Digest(delay=0.001)
+    serv.register(Alpha, digest)
+    serv(event_loop)
+    data = os.urandom(1 << 21)
+
+    async def agen():
+        for chunk in chunked(data, 1 << 14):
+            yield chunk
+
+    async def run():
+        async with AsyncClient(sockpath) as client:
+            await client.send_stream(Alpha(1, 2), agen())
+            while not digest.digests:
+                await asyncio.sleep(0.005)
+            protocol, = serv.connections
+            assert len(protocol._buf) < 1 << 20
+    event_loop.run_until_complete(asyncio.wait_for(run(), 10.0))
+    assert digest.digests == [hashlib.sha256(data).hexdigest()]
+    assert digest.max_buffered <= Stream.maxsize
+
+def test_unread_stream_is_discarded(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    received = []
+    async def ignore(stream):
+        received.append(stream.message)
+    serv.register(Alpha, ignore)
+    serv.register(Beta, received.append)
+    serv(event_loop)
+
+    async def run():
+        async with AsyncClient(sockpath) as client:
+            await client.send_stream(Alpha(1, 2), chunked(b'x' * (1 << 20), 1024))
+            await client.send(Beta(1, 2, 3))
+            while len(received) < 2:
+                await asyncio.sleep(0.005)
+    event_loop.run_until_complete(asyncio.wait_for(run(), 5.0))
+    assert [m.__class__ for m in received] == [Alpha, Beta]
+
+def test_sender_failure(sockpath, event_loop):
+    serv = Server(sockpath, message_types)
+    digest = Digest()
+    serv.register(Alpha, digest)
+    serv(event_loop)
+
+    def failing():
+        yield b'abc'
+        raise RuntimeError('disk on fire')
+
+    async def run():
+        client = AsyncClient(sockpath)
+        with pytest.raises(RuntimeError):
+            await client.send_stream(Alpha(1, 2), failing())
+        while digest.error is None:
+            await asyncio.sleep(0.005)
+    event_loop.run_until_complete(asyncio.wait_for(run(), 2.0))
+    assert not digest.digests
@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from fixtures import *
+
+from asyncipc.client import Client
+from asyncipc.message import message_types
+from asyncipc.server import Server
+from asyncipc.supervisor import Supervisor
+
+
+def worker_pid(msg):
+    return os.getpid()
+
+@pytest.fixture
+def supervisor(sockpath):
+    serv = Server(sockpath, message_types)
+    serv.register(Alpha, worker_pid)
+    sup = Supervisor(serv, workers=2, grace=0.5)
+    # Don't let ask_pid connect to a socket left behind by an earlier test
+    # before the supervisor binds its own
+    if os.path.exists(sockpath):
+        os.unlink(sockpath)
+    proc = multiprocessing.get_context('fork').Process(target=sup.run)
+    proc.start()
+    yield proc
+    if proc.is_alive():
+        os.kill(proc.pid, signal.SIGTERM)
+    proc.join(5)
+
+def ask_pid(sockpath, timeout=3.0):
+    "Ask a worker for its pid, retrying while the workers start up"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with Client(sockpath) as client:
+                return client.request(Alpha(1, 2))
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def test_workers_serve_and_restart(supervisor, sockpath):
+    pids = {ask_pid(sockpath) for _ in range(40)}
+    assert supervisor.pid not in pids
+    assert 1 <= len(pids) <= 2
+    for pid in pids:
+        os.kill(pid, signal.SIGKILL)
+    time.sleep(0.3)
+    new_pids = {ask_pid(sockpath) for _ in range(40)}
+    assert not new_pids & pids
+    os.kill(supervisor.pid, signal.SIGHUP)
+    time.sleep(0.3)
+    restarted = {ask_pid(sockpath) for _ in range(40)}
+    assert not restarted & new_pids
+    os.kill(supervisor.pid, signal.SIGTERM)
+    supervisor.join(5)
+    assert supervisor.exitcode == 0
+    assert not os.path.exists(sockpath)
+
+def test_refuses_spool(sockpath, tmp_path):
+    serv = Server(sockpath, message_types, spool=str(tmp_path))
+    with pytest.raises(ValueError, match='spool'):
+        Supervisor(serv)
+    serv.spool.close()